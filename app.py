@@ -1,16 +1,32 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from elasticsearch import Elasticsearch, exceptions
 from elasticsearch.exceptions import ConnectionError, AuthenticationException
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from indexMapping import PRODUCT_INDEX
+from indexVersions import ProductIndex, ensure_product_index
+from documentPreparation import embedding_cache, validateFields, validateProduct
+from bulkIngest import extract_products, extract_updates, index_products
+from duplicateDetection import DuplicateDetector, DuplicateProductError
+from indexingQueue import IndexingQueue, QueueFullError
+from queryEncoder import query_encoder, encode_queries
+from helperMethod import SellerLookup, SELLER_LOOKUP_SIZE, SELLER_LOOKUP_MAX_SIZE
+from catalogueExport import (EXPORT_FORMATS, LISTING_DEFAULT_SIZE, LISTING_MAX_SIZE, ListingExpiredError,
+                             export_products, list_seller_products, parse_export_request, parse_fields)
+from localVectorIndex import local_index
+from resultCache import result_cache
+from userProfiles import UserProfileStore
+from chatEngine import ChatEngine
+from instrumentation import METRICS_CONTENT_TYPE, instrument_app, instrument_elasticsearch, log_payload, metrics, stage
+from modelRegistry import LazyModel, registry
 import os
 import logging
 import uuid
 
-# Initialize Flask app
+# Initialize Flask app; requests are timed per stage and exported on /metrics
 app = Flask(__name__)
+instrument_app(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,10 +40,10 @@ FIREBASE_CREDENTIALS_PATH = os.getenv('FIREBASE_CREDENTIALS_PATH')
 
 # Initialize Elasticsearch connection using Elastic Cloud
 try:
-    es = Elasticsearch(
+    es = instrument_elasticsearch(Elasticsearch(
         cloud_id=ELASTICSEARCH_CLOUD_ID,
         basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PASSWORD)
-    )
+    ))
     if es.ping():
         logger.info("Connected to Elasticsearch")
     else:
@@ -52,59 +68,100 @@ except Exception as e:
     logger.error(f"An error occurred with Firestore: {e}")
     db = None  # Ensure 'db' is not used if the connection fails
 
-# Create the index with the mapping if it doesn't exist
-if es and not es.indices.exists(index="all_products"):
-    es.indices.create(index="all_products", body=indexMapping)
-    logger.info("Index 'all_products' created")
+# Create the first versioned index behind the alias if neither exists
+if es:
+    ensure_product_index(es)
+product_index = ProductIndex(es) if es else None
 
-# Function to index a new product in Elasticsearch
-def index_new_product(product):
-    try:
-        product_id = product.get('id', str(uuid.uuid4()))
-        doc = prepareDocument(product)
-        res = es.index(index="all_products", id=product_id, document=doc)
-        es.indices.refresh(index="all_products")  # Refresh the index to make the document searchable immediately
-        logger.info(f"Product indexed successfully: {res['result']}")
-    except Exception as e:
-        logger.error(f"Error indexing product: {e}")
+# Writes are coalesced into bulk requests by a background worker
+indexing_queue = IndexingQueue(es, versions=product_index) if es else None
+
+# "Who sells X" answers are one cached terms aggregation per product name
+seller_lookup = SellerLookup(es, encode_queries) if es else None
+
+# Reposts of a seller's product are rejected, merged or linked as variants
+duplicate_detector = DuplicateDetector(es, db) if es else None
 
-# Function to get user query history from Firestore
-def get_user_query_history(user_id):
+# Function to queue a new product for indexing in Elasticsearch; also returns the
+# product it duplicates, if any
+def index_new_product(product):
+    product_id = product.get('id', str(uuid.uuid4()))
+    duplicate = None
+    if duplicate_detector:
+        product_id, product, duplicate = duplicate_detector.resolve(product_id, product)
+    write_id = indexing_queue.enqueue_product(product_id, product)
+    logger.info(f"Product {product_id} queued for indexing: {write_id}")
+    return product_id, write_id, duplicate
+
+# Function to diff an update against the stored product: only existing fields whose value changes
+def changed_fields(existing, updated_data):
+    return {key: value for key, value in updated_data.items() if key in existing and value != existing[key]}
+
+# Function to queue a partial re-index of the changed fields; the description is only
+# re-embedded when it is one of them
+def queue_product_update(product_id, existing, fields_to_update):
+    write_id = indexing_queue.enqueue_update(product_id, fields_to_update, product={**existing, **fields_to_update})
+    logger.info(f"Product {product_id} update queued: {write_id} ({', '.join(sorted(fields_to_update))})")
+    return write_id
+
+FIRESTORE_BATCH_LIMIT = 500
+
+# Per-user profile vectors replace scanning search history on every request
+user_profiles = UserProfileStore(db, encode_queries) if db else None
+
+# Function to get a user's most recent queries from Firestore
+def get_user_query_history(user_id, limit=20):
     try:
         searches_ref = db.collection('searchHistory').document(user_id).collection('searches')
-        query_docs = searches_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).stream()
-        query_history = [doc.to_dict().get('query', '') for doc in query_docs]
-        logger.info(f"Query history for user {user_id}: {query_history}")
+        with stage("firestore.query"):
+            query_docs = searches_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit).stream()
+            query_history = [doc.to_dict().get('query', '') for doc in query_docs]
+        log_payload(logger, f"Query history for user {user_id}", query_history)
         return query_history
     except Exception as e:
         logger.error(f"Error fetching user query history: {e}")
         return []
 
-# Function to recommend products based on user query history
-def recommend_products(user_id):
-    try:
-        query_history = get_user_query_history(user_id)
-        if not query_history:
-            return []
+# Fields returned by /recommendations
+RECOMMENDATION_FIELDS = ["productName", "productDescription", "currency", "imageUrls", "videoUrls", "userId", "productPrice"]
 
-        latest_query = query_history[-1]  # Most recent query
-        query_vector = model.encode(latest_query).tolist()
+# Function to run the kNN query for a user's cached profile vector
+def search_recommendations(user_id):
+    query_vector = user_profiles.profile_vector(user_id)
+    if query_vector is None:
+        return []
 
-        knn_query = {
-            "field": "DescriptionVector",
-            "query_vector": query_vector,
-            "k": 5,  # Adjust the number of recommendations as needed
-            "num_candidates": 10
-        }
+    # Small catalogues, or an unreachable cluster, are served from the local index
+    if not es or (local_index is not None and local_index.serves_queries()):
+        return local_index.search_sources(query_vector, 5, RECOMMENDATION_FIELDS, with_id=True)
 
-        res = es.knn_search(
-            index="all_products",
-            knn=knn_query,
-            _source=["productName", "productDescription", "currency", "imageUrls", "videoUrls", "userId", "productPrice"]
-        )
+    knn_query = {
+        "field": "DescriptionVector",
+        "query_vector": query_vector,
+        "k": 5,  # Adjust the number of recommendations as needed
+        "num_candidates": 10
+    }
+
+    res = es.knn_search(index=PRODUCT_INDEX, knn=knn_query, _source=RECOMMENDATION_FIELDS)
+    return [{"id": hit["_id"], **hit["_source"]} for hit in res["hits"]["hits"]]
 
-        results = [{"id": hit["_id"], **hit["_source"]} for hit in res["hits"]["hits"]]
-        logger.info(f"Recommendations for user {user_id}: {results}")
+# Function to recommend products, cached until the next index write or the user's next search
+def recommend_products(user_id):
+    try:
+        version = user_profiles.profile_version(user_id) if user_profiles else None
+        if version is None:
+            return []
+        # Local-index fallbacks after a connection error are not cached
+        try:
+            results = result_cache.get_or_compute("recommendations", lambda: search_recommendations(user_id),
+                                                  user_id=user_id, profile=version)
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            logger.warning(f"Elasticsearch unreachable, recommending from the local index: {e}")
+            results = local_index.search_sources(user_profiles.profile_vector(user_id), 5, RECOMMENDATION_FIELDS,
+                                                 with_id=True)
+        log_payload(logger, f"Recommendations for user {user_id}", results)
         return results
     except Exception as e:
         logger.error(f"Error recommending products: {e}")
@@ -112,22 +169,31 @@ def recommend_products(user_id):
 
 # Initialize the Swahili model and tokenizer
 model_name = "Mollel/swahili-serengeti-E250-nli-matryoshka"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-# Ensure eos_token is set; otherwise, set it to a default
-if tokenizer.eos_token is None:
-    tokenizer.eos_token = tokenizer.sep_token if tokenizer.sep_token else tokenizer.pad_token
+def load_chat_tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-try:
-    chat_model = AutoModelForCausalLM.from_pretrained(model_name)
-except Exception as e:
-    logger.error(f"Model loading failed: {e}")
-    chat_model = None
+    # Ensure eos_token is set; otherwise, set it to a default
+    if tokenizer.eos_token is None:
+        tokenizer.eos_token = tokenizer.sep_token if tokenizer.sep_token else tokenizer.pad_token
+    return tokenizer
+
+def load_chat_model():
+    return AutoModelForCausalLM.from_pretrained(model_name)
+
+# Both are loaded on first use, or before fork under gunicorn
+registry.register("chat_tokenizer", load_chat_tokenizer)
+registry.register("chat_model", load_chat_model)
+tokenizer = LazyModel("chat_tokenizer")
+chat_model = LazyModel("chat_model")
+
+# Chat turns are batched and streamed by a background generation loop
+chat_engine = ChatEngine(chat_model, tokenizer, db)
 
 # API route for chatbot interaction
 @app.route('/chat', methods=['POST'])
 def chat():
-    if chat_model is None:
+    if registry.failed("chat_model") or registry.failed("chat_tokenizer"):
         return jsonify({"error": "Model is not loaded"}), 500
 
     user_id = request.json.get('user_id')
@@ -136,44 +202,27 @@ def chat():
     if not user_input or not user_id:
         return jsonify({"error": "User ID and message are required"}), 400
 
-    # Encode user input with EOS token
-    inputs = tokenizer.encode(user_input + tokenizer.eos_token, return_tensors='pt')
-
-    # Generate response using the model
-    reply_ids = chat_model.generate(
-        inputs,
-        max_length=100,
-        pad_token_id=tokenizer.eos_token_id,
-        temperature=0.7,
-        top_p=0.9,
-        top_k=50,
-        repetition_penalty=1.2
-    )
-
-    reply = tokenizer.decode(reply_ids[:, inputs.shape[-1]:][0], skip_special_tokens=True)
-
-    # Store message and response in Firestore
-    chat_id = uuid.uuid4().hex
-    message_data = {
-        'sender_id': user_id,
-        'message': user_input,
-        'timestamp': datetime.utcnow()
-    }
-    response_data = {
-        'sender_id': 'bot',
-        'message': reply,
-        'timestamp': datetime.utcnow()
-    }
+    # One conversation per user unless the client names one
+    chat_id = request.json.get('chat_id') or user_id
+    turn = chat_engine.submit(chat_id, user_id, user_input)
 
-    db.collection('chats').document(chat_id).collection('messages').add(message_data)
-    db.collection('chats').document(chat_id).collection('messages').add(response_data)
+    # Stream tokens as server-sent events when the client asks for it
+    if request.json.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(turn.sse()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    try:
+        reply = turn.result()
+    except RuntimeError as e:
+        logger.error(f"Error generating chat reply: {e}")
+        return jsonify({"error": f"Error generating reply: {e}"}), 500
 
-    return jsonify({'response': reply})
+    return jsonify({'response': reply, 'chat_id': chat_id})
 
 # API route to get recommendations based on user query history
 @app.route('/recommendations/<user_id>', methods=['GET'])
 def get_recommendations(user_id):
-    if not es:
+    if not es and local_index is None:
         return jsonify({"error": "Elasticsearch is not available"}), 500
 
     try:
@@ -186,70 +235,299 @@ def get_recommendations(user_id):
 # API route to add a new product
 @app.route('/add_product', methods=['POST'])
 def add_product():
-    if not es:
-        return jsonify({"error": "Elasticsearch is not available"}), 500
+    if not indexing_queue:
+        return jsonify({"error": "Elasticsearch is not available, retry later"}), 503
 
     try:
         product = request.json
-        logger.info(f"Received product data: {product}")
+        log_payload(logger, "Received product data", product)
 
         # Validate input
-        required_fields = ["productName", "productDescription", "currency", "userId", "productPrice"]
-        for field in required_fields:
-            if field not in product:
-                return jsonify({"error": f"{field} is required"}), 400
-
-        index_new_product(product)
-        return jsonify({"message": "Product added and indexed successfully"}), 201
+        error = validateProduct(product)
+        if error:
+            return jsonify({"error": error}), 400
+
+        product_id, write_id, duplicate = index_new_product(product)
+        body = {"message": "Product queued for indexing", "id": product_id, "write_id": write_id}
+        if duplicate:
+            body["duplicate_of"] = duplicate
+        return jsonify(body), 202
+    except DuplicateProductError as e:
+        return jsonify({"error": str(e), "duplicate_of": e.duplicate}), 409
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         logger.error(f"Error adding product: {e}")
         return jsonify({"error": f"Error adding product: {e}"}), 500
 
+# API route to add many products in one request
+@app.route('/add_products', methods=['POST'])
+def add_products():
+    if not es:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        products = extract_products(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        results = index_products(es, products, versions=product_index, duplicates=duplicate_detector)
+        failed = sum(1 for result in results if result["status"] == "failed")
+        status = 201 if not failed else (400 if failed == len(results) else 207)
+        return jsonify({"indexed": len(results) - failed, "failed": failed, "results": results}), status
+    except Exception as e:
+        logger.error(f"Error adding products: {e}")
+        return jsonify({"error": f"Error adding products: {e}"}), 500
+
+# API route to look up the status of a queued write
+@app.route('/index_status/<write_id>', methods=['GET'])
+def index_status(write_id):
+    if not indexing_queue:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    status = indexing_queue.status(write_id)
+    if status is None:
+        return jsonify({"error": "Unknown write id"}), 404
+    return jsonify(status), 200
+
 # API route to update an existing product
 @app.route('/update_product/<product_id>', methods=['PUT'])
 def update_product(product_id):
-    if not es:
-        return jsonify({"error": "Elasticsearch is not available"}), 500
+    if not indexing_queue:
+        return jsonify({"error": "Elasticsearch is not available, retry later"}), 503
 
     try:
         updated_data = request.json
-        logger.info(f"Received updated product data: {updated_data}")
+        log_payload(logger, f"Received updated data for product {product_id}", updated_data)
 
         # Validate input
-        if not updated_data:
+        if not updated_data or not isinstance(updated_data, dict):
             return jsonify({"error": "No update data provided"}), 400
+        error = validateFields(updated_data)
+        if error:
+            return jsonify({"error": error}), 400
 
         # Get existing document from Firestore
         doc_ref = db.collection('posts').document(product_id)
-        existing_data = doc_ref.get()
+        with stage("firestore.get"):
+            existing_data = doc_ref.get()
         if not existing_data.exists:
             return jsonify({"error": "Product not found"}), 404
 
         # Update only the fields that are provided and different from existing ones
-        fields_to_update = {}
-        for key, value in updated_data.items():
-            if key in existing_data.to_dict() and value != existing_data.to_dict()[key]:
-                fields_to_update[key] = value
-
+        existing = existing_data.to_dict()
+        fields_to_update = changed_fields(existing, updated_data)
         if not fields_to_update:
             return jsonify({"message": "No fields updated"}), 200
 
         # Update Firestore document
-        doc_ref.update(fields_to_update)
+        with stage("firestore.update"):
+            doc_ref.update(fields_to_update)
+
+        # Queue only the changed fields for a partial update in Elasticsearch
+        write_id = queue_product_update(product_id, existing, fields_to_update)
+
+        return jsonify({
+            "message": "Product updated successfully",
+            "write_id": write_id,
+            "updated_fields": sorted(fields_to_update),
+            "reembedded": "productDescription" in fields_to_update
+        }), 200
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logger.error(f"Error updating product: {e}")
+        return jsonify({"error": f"Error updating product: {e}"}), 500
 
-        # Prepare the document for Elasticsearch
-        updated_data['id'] = product_id  # Ensure the document has an ID for Elasticsearch
-        doc = prepareDocument(updated_data)
+# API route to update many products in one request: one Firestore read, batched writes,
+# and partial re-indexing of the changed fields only
+@app.route('/update_products', methods=['PUT'])
+def update_products():
+    if not indexing_queue or not db:
+        return jsonify({"error": "Elasticsearch is not available, retry later"}), 503
 
-        # Index the updated document in Elasticsearch
-        res = es.index(index="all_products", id=product_id, document=doc)
-        es.indices.refresh(index="all_products")  # Refresh the index to make the document searchable immediately
-        logger.info(f"Product updated successfully: {res['result']}")
+    try:
+        updates = extract_updates(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        return jsonify({"message": "Product updated successfully"}), 200
+    try:
+        posts = db.collection('posts')
+        with stage("firestore.get_all"):
+            snapshots = {snapshot.id: snapshot
+                         for snapshot in db.get_all([posts.document(product_id) for product_id in updates])}
+
+        results = []
+        changes = []
+        for product_id, updated_data in updates.items():
+            snapshot = snapshots.get(product_id)
+            if snapshot is None or not snapshot.exists:
+                results.append({"id": product_id, "status": "failed", "error": "Product not found"})
+                continue
+            existing = snapshot.to_dict()
+            fields_to_update = changed_fields(existing, updated_data)
+            if not fields_to_update:
+                results.append({"id": product_id, "status": "unchanged"})
+                continue
+            error = validateFields(fields_to_update)
+            if error:
+                results.append({"id": product_id, "status": "failed", "error": error})
+                continue
+            changes.append((product_id, existing, fields_to_update))
+
+        for start in range(0, len(changes), FIRESTORE_BATCH_LIMIT):
+            chunk = changes[start:start + FIRESTORE_BATCH_LIMIT]
+            batch = db.batch()
+            for product_id, _, fields_to_update in chunk:
+                batch.update(posts.document(product_id), fields_to_update)
+            try:
+                with stage("firestore.commit"):
+                    batch.commit()
+            except Exception as e:
+                logger.error(f"Error updating products in Firestore: {e}")
+                results.extend({"id": product_id, "status": "failed", "error": str(e)} for product_id, _, _ in chunk)
+                continue
+
+            for product_id, existing, fields_to_update in chunk:
+                try:
+                    write_id = queue_product_update(product_id, existing, fields_to_update)
+                    results.append({"id": product_id, "status": "updated", "write_id": write_id,
+                                    "updated_fields": sorted(fields_to_update),
+                                    "reembedded": "productDescription" in fields_to_update})
+                except QueueFullError as e:
+                    results.append({"id": product_id, "status": "failed", "error": str(e)})
+
+        failed = sum(1 for result in results if result["status"] == "failed")
+        status = 200 if not failed else (400 if failed == len(results) else 207)
+        return jsonify({
+            "updated": sum(1 for result in results if result["status"] == "updated"),
+            "unchanged": sum(1 for result in results if result["status"] == "unchanged"),
+            "failed": failed,
+            "results": results
+        }), status
     except Exception as e:
-        logger.error(f"Error updating product: {e}")
-        return jsonify({"error": f"Error updating product: {e}"}), 500
+        logger.error(f"Error updating products: {e}")
+        return jsonify({"error": f"Error updating products: {e}"}), 500
+
+# API route to find the sellers of a product, e.g. /sellers?q=who sells rice
+@app.route('/sellers', methods=['GET'])
+def sellers():
+    if not seller_lookup:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    query = request.args.get('q', '')
+    semantic = request.args.get('semantic', '0').lower() in ('1', 'true')
+    try:
+        size = min(int(request.args.get('size', SELLER_LOOKUP_SIZE)), SELLER_LOOKUP_MAX_SIZE)
+    except ValueError:
+        return jsonify({"error": "size must be an integer"}), 400
+
+    try:
+        result = seller_lookup.lookup(query, semantic=semantic, size=max(size, 1))
+        if result is None:
+            return jsonify({"error": "A product to look up is required"}), 400
+        return jsonify(result), 200
+    except Exception as e:
+        logger.error(f"Error finding sellers: {e}")
+        return jsonify({"error": f"Error finding sellers: {e}"}), 500
+
+# API route to stream the catalogue, or part of it, as NDJSON or CSV, e.g.
+# /export/products?category=phones&fields=productName,productPrice&format=csv
+@app.route('/export/products', methods=['GET'])
+def export_catalogue():
+    if not es:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        params = parse_export_request(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        chunks = export_products(es, params)
+    except Exception as e:
+        logger.error(f"Error exporting products: {e}")
+        return jsonify({"error": f"Error exporting products: {e}"}), 500
+    return Response(chunks, content_type=EXPORT_FORMATS[params["format"]],
+                    headers={"Content-Disposition": f"attachment; filename=products.{params['format']}"})
+
+# API route to list a seller's products a page at a time; pass the returned cursor for the next page
+@app.route('/sellers/<user_id>/products', methods=['GET'])
+def seller_products(user_id):
+    if not es:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        size = min(int(request.args.get('size', LISTING_DEFAULT_SIZE)), LISTING_MAX_SIZE)
+    except ValueError:
+        return jsonify({"error": "size must be an integer"}), 400
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        result = list_seller_products(es, user_id, max(size, 1), request.args.get('cursor'), fields)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ListingExpiredError as e:
+        return jsonify({"error": str(e)}), 410
+    except Exception as e:
+        logger.error(f"Error listing products of seller {user_id}: {e}")
+        return jsonify({"error": f"Error listing products: {e}"}), 500
+
+# API route to report embedding cache hit/miss counters
+@app.route('/stats/embedding_cache', methods=['GET'])
+def embedding_cache_stats():
+    return jsonify(embedding_cache.stats()), 200
+
+# API route to report query micro-batching counters
+@app.route('/stats/query_encoder', methods=['GET'])
+def query_encoder_stats():
+    return jsonify(query_encoder.stats()), 200
+
+# API route to report result cache hit rates per endpoint
+@app.route('/stats/result_cache', methods=['GET'])
+def result_cache_stats():
+    return jsonify(result_cache.stats()), 200
+
+# API route to report seller lookup cache counters
+@app.route('/stats/seller_lookup', methods=['GET'])
+def seller_lookup_stats():
+    if not seller_lookup:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+    return jsonify(seller_lookup.stats()), 200
+
+# API route to report how many new products duplicated an existing one, per policy
+@app.route('/stats/duplicates', methods=['GET'])
+def duplicate_stats():
+    if not duplicate_detector:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+    return jsonify(duplicate_detector.stats()), 200
+
+# Cache and batching counters are exported next to the request and stage metrics
+metrics.register_stats("embedding_cache", embedding_cache.stats)
+metrics.register_stats("query_encoder", query_encoder.stats)
+metrics.register_stats("result_cache", result_cache.stats)
+if seller_lookup:
+    metrics.register_stats("seller_lookup", seller_lookup.stats)
+if duplicate_detector:
+    metrics.register_stats("duplicates", duplicate_detector.stats)
+
+# API route exposing request latency, per-stage timings and cache counters for Prometheus
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+# API route reporting model warm-up state, startup time and memory of this worker
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = registry.status()
+    if product_index is not None:
+        # Not ready while the index behind the alias holds vectors of another model
+        status["index"] = product_index.status()
+        status["ready"] = status["ready"] and status["index"]["compatible"]
+    return jsonify(status), 200 if status["ready"] else 503
 
 if __name__ == '__main__':
+    registry.warm_up_async()
     app.run(debug=True)
@@ -0,0 +1,395 @@
+"""
+ASGI serving mode for the hot routes, with the same JSON contracts as the
+Flask apps:
+
+    POST /search, POST /add_product, PUT /update_product/<id>,
+    GET /recommendations/<user_id>, POST /chat, GET /index_status/<write_id>
+
+    uvicorn asgiApp:app --host 0.0.0.0 --port 5000 --workers 2
+
+Handlers never block the event loop. Elasticsearch reads go through one
+AsyncElasticsearch client with a shared connection pool and Firestore
+reads/writes through the async Firestore client, so a worker can hold
+hundreds of requests waiting on the network. Query encoding is awaited on
+the micro-batcher's own thread, chat generation on the chat engine's, and
+other CPU-bound work runs on a small inference executor whose queue is
+bounded by a semaphore. Blocking helpers shared with the Flask apps (the
+indexing queue, user profiles) run on the default thread pool.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import firebase_admin
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elasticsearch.exceptions import ConnectionError
+from firebase_admin import credentials, firestore, firestore_async
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from chatEngine import ChatEngine
+from documentPreparation import validateFields, validateProduct
+from duplicateDetection import DuplicateDetector, DuplicateProductError
+from hybridSearch import adaptive_num_candidates
+from indexMapping import PRODUCT_INDEX
+from indexingQueue import IndexingQueue, QueueFullError
+from indexVersions import ProductIndex, ensure_product_index
+from instrumentation import (METRICS_CONTENT_TYPE, ASGIInstrumentation, instrument_elasticsearch,
+                             log_payload, metrics, stage)
+from localVectorIndex import local_index
+from modelRegistry import LazyModel, registry
+from queryEncoder import encode_queries, query_encoder
+from resultCache import normalize_query, result_cache
+from searchHistory import SearchHistoryLog
+from userProfiles import UserProfileStore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Connection settings: Elastic Cloud when a cloud id is given, otherwise a URL
+ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200')
+ELASTICSEARCH_CLOUD_ID = os.getenv('ELASTICSEARCH_CLOUD_ID')
+ELASTICSEARCH_USERNAME = os.getenv('ELASTICSEARCH_USERNAME')
+ELASTICSEARCH_PASSWORD = os.getenv('ELASTICSEARCH_PASSWORD')
+FIREBASE_CREDENTIALS = os.getenv('FIREBASE_CREDENTIALS_PATH', os.getenv('FIREBASE_CREDENTIALS'))
+
+# Pooled connections the async client keeps open per Elasticsearch node
+ES_CONNECTIONS_PER_NODE = int(os.getenv('ES_CONNECTIONS_PER_NODE', '64'))
+# Threads for CPU-bound work, and how many tasks may wait for them before callers queue
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', '2'))
+INFERENCE_MAX_PENDING = int(os.getenv('INFERENCE_MAX_PENDING', '64'))
+
+SEARCH_FIELDS = ["productName", "productDescription", "currency", "imageUrls", "videoUrls", "userId", "productPrice"]
+RECOMMENDATION_FIELDS = SEARCH_FIELDS
+FIRESTORE_TIMEOUT = 10
+
+
+def _client_options():
+    if ELASTICSEARCH_CLOUD_ID:
+        return {"cloud_id": ELASTICSEARCH_CLOUD_ID, "basic_auth": (ELASTICSEARCH_USERNAME, ELASTICSEARCH_PASSWORD)}
+    return {"hosts": [ELASTICSEARCH_URL]}
+
+
+# Initialize Elasticsearch: the async client serves reads, the sync one feeds the
+# background indexing queue
+try:
+    write_es = instrument_elasticsearch(Elasticsearch(**_client_options()))
+    if not write_es.ping():
+        raise ConnectionError("Failed to connect to Elasticsearch")
+    es = instrument_elasticsearch(AsyncElasticsearch(**_client_options(), connections_per_node=ES_CONNECTIONS_PER_NODE))
+    logger.info("Connected to Elasticsearch")
+except Exception as e:
+    logger.error(f"Error connecting to Elasticsearch: {e}")
+    write_es = es = None
+
+# Initialize Firestore: async client for handlers, sync client for the background helpers
+try:
+    firebase_admin.initialize_app(credentials.Certificate(FIREBASE_CREDENTIALS))
+    db = firestore.client()
+    async_db = firestore_async.client()
+    logger.info("Connected to Firestore")
+except Exception as e:
+    logger.error(f"An error occurred with Firestore: {e}")
+    db = async_db = None
+
+# Create the first versioned index behind the alias if neither exists
+if write_es:
+    ensure_product_index(write_es)
+product_index = ProductIndex(write_es) if write_es else None
+
+indexing_queue = IndexingQueue(write_es, versions=product_index) if write_es else None
+duplicate_detector = DuplicateDetector(write_es, db) if write_es else None
+user_profiles = UserProfileStore(db, encode_queries) if db else None
+search_history = SearchHistoryLog(db) if db else None
+
+# Chat models load on first use, or before the workers start
+model_name = "Mollel/swahili-serengeti-E250-nli-matryoshka"
+
+
+def load_chat_tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if tokenizer.eos_token is None:
+        tokenizer.eos_token = tokenizer.sep_token if tokenizer.sep_token else tokenizer.pad_token
+    return tokenizer
+
+
+def load_chat_model():
+    return AutoModelForCausalLM.from_pretrained(model_name)
+
+
+registry.register("chat_tokenizer", load_chat_tokenizer)
+registry.register("chat_model", load_chat_model)
+chat_engine = ChatEngine(LazyModel("chat_model"), LazyModel("chat_tokenizer"), db)
+
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+_inference_slots = None
+
+
+# Run CPU-bound work on the inference executor; at most INFERENCE_MAX_PENDING calls
+# are handed to it at once, later callers wait without holding a thread
+async def run_inference(fn, *args):
+    global _inference_slots
+    if _inference_slots is None:
+        _inference_slots = asyncio.Semaphore(INFERENCE_MAX_PENDING)
+    context = contextvars.copy_context()  # Keeps the caller's stage breakdown
+    async with _inference_slots:
+        return await asyncio.get_running_loop().run_in_executor(inference_executor, context.run, fn, *args)
+
+
+async def encode_query(text):
+    with stage("encode.query"):
+        return await asyncio.wrap_future(query_encoder.submit(text))
+
+
+def json_response(content, status_code=200):
+    with stage("serialize"):
+        return JSONResponse(content, status_code=status_code)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+# Function to run the /search kNN query, as in backend.py
+async def search_products(keyword, k=4):
+    query_vector = await encode_query(keyword)
+    if not es or (local_index is not None and local_index.serves_queries()):
+        return {"vector": query_vector,
+                "results": await run_inference(local_index.search_sources, query_vector, k, SEARCH_FIELDS)}
+
+    knn_query = {
+        "field": "DescriptionVector",
+        "query_vector": query_vector,
+        "k": k,
+        "num_candidates": adaptive_num_candidates(k)
+    }
+    res = await es.knn_search(index=PRODUCT_INDEX, knn=knn_query, _source=SEARCH_FIELDS)
+    return {"vector": query_vector, "results": [hit["_source"] for hit in res["hits"]["hits"]]}
+
+
+async def search(request):
+    if not es and local_index is None:
+        return json_response({"error": "Elasticsearch is not available"}, 500)
+
+    payload = await read_json(request)
+    input_keyword = payload.get('keyword') if isinstance(payload, dict) else None
+    if not input_keyword:
+        return json_response({"error": "Keyword is required"}, 400)
+
+    try:
+        try:
+            result = await result_cache.get_or_compute_async(
+                "search", lambda: search_products(input_keyword), query=normalize_query(input_keyword), k=4)
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            logger.warning(f"Elasticsearch unreachable, searching the local index: {e}")
+            query_vector = await encode_query(input_keyword)
+            result = {"vector": query_vector,
+                      "results": await run_inference(local_index.search_sources, query_vector, 4, SEARCH_FIELDS)}
+
+        user_id = payload.get('user_id')
+        if user_id and user_profiles:
+            user_profiles.record_search(user_id, result["vector"])  # Only queues the search
+        if user_id and search_history:
+            search_history.record(user_id, input_keyword)  # Only queues the event
+
+        return json_response(result["results"])
+    except Exception as e:
+        logger.error(f"Error performing KNN search: {e}")
+        return json_response({"error": f"Error performing KNN search: {e}"}, 500)
+
+
+async def add_product(request):
+    if not indexing_queue:
+        return json_response({"error": "Elasticsearch is not available, retry later"}, 503)
+
+    product = await read_json(request)
+    log_payload(logger, "Received product data", product)
+    error = validateProduct(product)
+    if error:
+        return json_response({"error": error}, 400)
+
+    try:
+        product_id = product.get('id', str(uuid.uuid4()))
+        duplicate = None
+        if duplicate_detector:
+            product_id, product, duplicate = await run_in_threadpool(duplicate_detector.resolve, product_id, product)
+        # The put waits up to INDEX_QUEUE_PUT_TIMEOUT when the queue is full
+        write_id = await run_in_threadpool(indexing_queue.enqueue_product, product_id, product)
+        body = {"message": "Product queued for indexing", "id": product_id, "write_id": write_id}
+        if duplicate:
+            body["duplicate_of"] = duplicate
+        return json_response(body, 202)
+    except DuplicateProductError as e:
+        return json_response({"error": str(e), "duplicate_of": e.duplicate}, 409)
+    except QueueFullError as e:
+        return json_response({"error": str(e)}, 503)
+    except Exception as e:
+        logger.error(f"Error adding product: {e}")
+        return json_response({"error": f"Error adding product: {e}"}, 500)
+
+
+async def update_product(request):
+    if not indexing_queue or not async_db:
+        return json_response({"error": "Elasticsearch is not available, retry later"}, 503)
+
+    product_id = request.path_params["product_id"]
+    updated_data = await read_json(request)
+    if not updated_data or not isinstance(updated_data, dict):
+        return json_response({"error": "No update data provided"}, 400)
+    error = validateFields(updated_data)
+    if error:
+        return json_response({"error": error}, 400)
+    log_payload(logger, f"Received updated data for product {product_id}", updated_data)
+
+    try:
+        doc_ref = async_db.collection('posts').document(product_id)
+        with stage("firestore.get"):
+            snapshot = await doc_ref.get(timeout=FIRESTORE_TIMEOUT)
+        if not snapshot.exists:
+            return json_response({"error": "Product not found"}, 404)
+
+        existing = snapshot.to_dict()
+        fields_to_update = {key: value for key, value in updated_data.items()
+                            if key in existing and value != existing[key]}
+        if not fields_to_update:
+            return json_response({"message": "No fields updated"})
+
+        with stage("firestore.update"):
+            await doc_ref.update(fields_to_update, timeout=FIRESTORE_TIMEOUT)
+
+        write_id = await run_in_threadpool(indexing_queue.enqueue_update, product_id, fields_to_update,
+                                           {**existing, **fields_to_update})
+        return json_response({
+            "message": "Product updated successfully",
+            "write_id": write_id,
+            "updated_fields": sorted(fields_to_update),
+            "reembedded": "productDescription" in fields_to_update
+        })
+    except QueueFullError as e:
+        return json_response({"error": str(e)}, 503)
+    except Exception as e:
+        logger.error(f"Error updating product: {e}")
+        return json_response({"error": f"Error updating product: {e}"}, 500)
+
+
+# Function to run the kNN query for a user's profile vector, as in app.py
+async def search_recommendations(user_id):
+    query_vector = await run_in_threadpool(user_profiles.profile_vector, user_id)
+    if query_vector is None:
+        return []
+
+    if not es or (local_index is not None and local_index.serves_queries()):
+        return await run_inference(local_index.search_sources, query_vector, 5, RECOMMENDATION_FIELDS, True)
+
+    knn_query = {"field": "DescriptionVector", "query_vector": query_vector, "k": 5, "num_candidates": 10}
+    res = await es.knn_search(index=PRODUCT_INDEX, knn=knn_query, _source=RECOMMENDATION_FIELDS)
+    return [{"id": hit["_id"], **hit["_source"]} for hit in res["hits"]["hits"]]
+
+
+async def recommendations(request):
+    if not es and local_index is None:
+        return json_response({"error": "Elasticsearch is not available"}, 500)
+
+    user_id = request.path_params["user_id"]
+    try:
+        version = await run_in_threadpool(user_profiles.profile_version, user_id) if user_profiles else None
+        if version is None:
+            return json_response([])
+        # Local-index fallbacks after a connection error are not cached
+        try:
+            results = await result_cache.get_or_compute_async(
+                "recommendations", lambda: search_recommendations(user_id), user_id=user_id, profile=version)
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            logger.warning(f"Elasticsearch unreachable, recommending from the local index: {e}")
+            query_vector = await run_in_threadpool(user_profiles.profile_vector, user_id)
+            results = await run_inference(local_index.search_sources, query_vector, 5, RECOMMENDATION_FIELDS, True)
+        log_payload(logger, f"Recommendations for user {user_id}", results)
+        return json_response(results)
+    except Exception as e:
+        logger.error(f"Error recommending products: {e}")
+        return json_response([])
+
+
+async def chat(request):
+    if registry.failed("chat_model") or registry.failed("chat_tokenizer"):
+        return json_response({"error": "Model is not loaded"}, 500)
+
+    payload = await read_json(request) or {}
+    user_id = payload.get('user_id')
+    user_input = payload.get('message')
+    if not user_input or not user_id:
+        return json_response({"error": "User ID and message are required"}, 400)
+
+    chat_id = payload.get('chat_id') or user_id
+    turn = chat_engine.submit(chat_id, user_id, user_input, loop=asyncio.get_running_loop())
+
+    if payload.get('stream') or 'text/event-stream' in request.headers.get('accept', ''):
+        return StreamingResponse(turn.asse(), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    try:
+        reply = await turn.aresult()
+    except RuntimeError as e:
+        logger.error(f"Error generating chat reply: {e}")
+        return json_response({"error": f"Error generating reply: {e}"}, 500)
+    return json_response({'response': reply, 'chat_id': chat_id})
+
+
+async def index_status(request):
+    if not indexing_queue:
+        return json_response({"error": "Elasticsearch is not available"}, 500)
+    status = indexing_queue.status(request.path_params["write_id"])
+    if status is None:
+        return json_response({"error": "Unknown write id"}, 404)
+    return json_response(status)
+
+
+async def ready(request):
+    status = registry.status()
+    if product_index is not None:
+        # Not ready while the index behind the alias holds vectors of another model
+        status["index"] = await run_in_threadpool(product_index.status)
+        status["ready"] = status["ready"] and status["index"]["compatible"]
+    return json_response(status, 200 if status["ready"] else 503)
+
+
+async def prometheus_metrics(request):
+    return Response(metrics.render(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    registry.warm_up_async()
+    yield
+    if es is not None:
+        await es.close()
+    inference_executor.shutdown(wait=False)
+
+
+routes = [
+    Route('/search', search, methods=['POST']),
+    Route('/add_product', add_product, methods=['POST']),
+    Route('/update_product/{product_id}', update_product, methods=['PUT']),
+    Route('/recommendations/{user_id}', recommendations, methods=['GET']),
+    Route('/chat', chat, methods=['POST']),
+    Route('/index_status/{write_id}', index_status, methods=['GET']),
+    Route('/ready', ready, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[Middleware(ASGIInstrumentation, routes=routes)])
@@ -1,15 +1,32 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from elasticsearch import Elasticsearch, exceptions
 from elasticsearch.exceptions import ConnectionError, AuthenticationException
 import firebase_admin
 from firebase_admin import credentials, firestore
-from indexMapping import indexMapping
-from documentPreparation import prepareDocument, model
+from indexMapping import PRODUCT_INDEX
+from indexVersions import ProductIndex, ensure_product_index
+from documentPreparation import embedding_cache, validateProduct
+from bulkIngest import extract_products, index_products
+from duplicateDetection import DuplicateDetector, DuplicateProductError
+from indexingQueue import IndexingQueue, QueueFullError
+from queryEncoder import query_encoder, encode_queries
+from hybridSearch import HybridSearcher, adaptive_num_candidates, local_hybrid_search, parse_search_request
+from resultCache import result_cache, normalize_query
+from helperMethod import SellerLookup, SELLER_LOOKUP_SIZE, SELLER_LOOKUP_MAX_SIZE
+from catalogueExport import (EXPORT_FORMATS, LISTING_DEFAULT_SIZE, LISTING_MAX_SIZE, ListingExpiredError,
+                             export_products, list_seller_products, parse_export_request, parse_fields)
+from localVectorIndex import local_index
+from modelRegistry import registry
+from userProfiles import UserProfileStore
+from searchHistory import SearchHistoryLog
+from instrumentation import METRICS_CONTENT_TYPE, instrument_app, instrument_elasticsearch, log_payload, metrics
 import os
 import logging
 import uuid
 
+# Requests are timed per stage and exported on /metrics
 app = Flask(__name__)
+instrument_app(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,7 +38,7 @@ FIREBASE_CREDENTIALS = os.getenv('FIREBASE_CREDENTIALS', '/home/chumvi/Developme
 
 # Initialize Elasticsearch connection
 try:
-    es = Elasticsearch(ELASTICSEARCH_URL)
+    es = instrument_elasticsearch(Elasticsearch(ELASTICSEARCH_URL))
     if es.ping():
         logger.info("Connected to Elasticsearch")
     else:
@@ -46,50 +63,134 @@ except Exception as e:
     logger.error(f"An error occurred with Firestore: {e}")
     db = None  # Ensuring 'db' is not used if the connection fails
 
-# Create the index with the mapping if it doesn't exist
-if es and not es.indices.exists(index="all_products"):
-    es.indices.create(index="all_products", body=indexMapping)
-    logger.info("Index 'all_products' created")
+# Create the first versioned index behind the alias if neither exists
+if es:
+    ensure_product_index(es)
+product_index = ProductIndex(es) if es else None
 
-# Function to index a new product in Elasticsearch
+# Searches made with a user_id feed that user's recommendation profile
+user_profiles = UserProfileStore(db, encode_queries) if db else None
+# and are logged to searchHistory in batches, off the request path
+search_history = SearchHistoryLog(db) if db else None
+
+# Fields returned by /search
+SEARCH_FIELDS = ["productName", "productDescription", "currency", "imageUrls", "videoUrls", "userId", "productPrice"]
+
+# Writes are coalesced into bulk requests by a background worker
+indexing_queue = IndexingQueue(es, versions=product_index) if es else None
+
+# Filtered BM25 + kNN search behind /search/hybrid
+hybrid_searcher = HybridSearcher(es) if es else None
+
+# "Who sells X" answers are one cached terms aggregation per product name
+seller_lookup = SellerLookup(es, encode_queries) if es else None
+
+# Reposts of a seller's product are rejected, merged or linked as variants
+duplicate_detector = DuplicateDetector(es, db) if es else None
+
+# Function to queue a new product for indexing in Elasticsearch; also returns the
+# product it duplicates, if any
 def index_new_product(product):
-    try:
-        product_id = str(uuid.uuid4())  # Generate a unique ID for the product
-        doc = prepareDocument(product)
-        res = es.index(index="all_products", id=product_id, document=doc)
-        es.indices.refresh(index="all_products")  # Refresh the index to make the document searchable immediately
-        logger.info(f"Product indexed successfully: {res['result']}")
-    except Exception as e:
-        logger.error(f"Error indexing product: {e}")
+    product_id = str(uuid.uuid4())  # Generate a unique ID for the product
+    duplicate = None
+    if duplicate_detector:
+        product_id, product, duplicate = duplicate_detector.resolve(product_id, product)
+    write_id = indexing_queue.enqueue_product(product_id, product)
+    logger.info(f"Product {product_id} queued for indexing: {write_id}")
+    return product_id, write_id, duplicate
 
 # API route to add a new product
 @app.route('/add_product', methods=['POST'])
 def add_product():
-    if not es:
-        return jsonify({"error": "Elasticsearch is not available"}), 500
+    if not indexing_queue:
+        return jsonify({"error": "Elasticsearch is not available, retry later"}), 503
 
     try:
         product = request.json
-        logger.info(f"Received product data: {product}")
+        log_payload(logger, "Received product data", product)
 
         # Validate input
-        if not product:
-            return jsonify({"error": "No product data provided"}), 400
-        required_fields = ["productName", "productDescription", "currency", "userId", "productPrice"]
-        for field in required_fields:
-            if field not in product:
-                return jsonify({"error": f"{field} is required"}), 400
-
-        index_new_product(product)
-        return jsonify({"message": "Product added and indexed successfully"}), 201
+        error = validateProduct(product)
+        if error:
+            return jsonify({"error": error}), 400
+
+        product_id, write_id, duplicate = index_new_product(product)
+        body = {"message": "Product queued for indexing", "id": product_id, "write_id": write_id}
+        if duplicate:
+            body["duplicate_of"] = duplicate
+        return jsonify(body), 202
+    except DuplicateProductError as e:
+        return jsonify({"error": str(e), "duplicate_of": e.duplicate}), 409
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         logger.error(f"Error adding product: {e}")
         return jsonify({"error": f"Error adding product: {e}"}), 500
 
+# API route to add many products in one request
+@app.route('/add_products', methods=['POST'])
+def add_products():
+    if not es:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        products = extract_products(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        results = index_products(es, products, versions=product_index, duplicates=duplicate_detector)
+        failed = sum(1 for result in results if result["status"] == "failed")
+        status = 201 if not failed else (400 if failed == len(results) else 207)
+        return jsonify({"indexed": len(results) - failed, "failed": failed, "results": results}), status
+    except Exception as e:
+        logger.error(f"Error adding products: {e}")
+        return jsonify({"error": f"Error adding products: {e}"}), 500
+
+# API route to look up the status of a queued write
+@app.route('/index_status/<write_id>', methods=['GET'])
+def index_status(write_id):
+    if not indexing_queue:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    status = indexing_queue.status(write_id)
+    if status is None:
+        return jsonify({"error": "Unknown write id"}), 404
+    return jsonify(status), 200
+
+# Function to run the /search kNN query; the query vector is returned with the
+# results so that cache hits can still feed user profiles
+def search_products(keyword, k=4):
+    query_vector = query_encoder.encode(keyword)
+
+    # Small catalogues, or an unreachable cluster, are served from the local index
+    if not es or (local_index is not None and local_index.serves_queries()):
+        return {"vector": query_vector, "results": local_index.search_sources(query_vector, k, SEARCH_FIELDS)}
+
+    knn_query = {
+        "field": "DescriptionVector",
+        "query_vector": query_vector,
+        "k": k,
+        "num_candidates": adaptive_num_candidates(k)
+    }
+    res = es.knn_search(index=PRODUCT_INDEX, knn=knn_query, _source=SEARCH_FIELDS)
+    return {"vector": query_vector, "results": [hit["_source"] for hit in res["hits"]["hits"]]}
+
+# Function to run a hybrid search; returns the query vector alongside the response
+def search_products_hybrid(params):
+    query_vector = query_encoder.encode(params["keyword"])
+    if not es or (local_index is not None and local_index.serves_queries()):
+        result = local_hybrid_search(local_index, query_vector, params["k"], params["filters"],
+                                     params["search_after"], SEARCH_FIELDS)
+    else:
+        result = hybrid_searcher.search(params["keyword"], query_vector, params["k"], params["filters"],
+                                        params["search_after"], SEARCH_FIELDS)
+    return {"vector": query_vector, "result": result}
+
 # API route to perform KNN search
 @app.route('/search', methods=['POST'])
 def knn_search():
-    if not es:
+    if not es and local_index is None:
         return jsonify({"error": "Elasticsearch is not available"}), 500
 
     try:
@@ -97,24 +198,192 @@ def knn_search():
         if not input_keyword:
             return jsonify({"error": "Keyword is required"}), 400
 
-        vector_of_input_keyword = model.encode(input_keyword)
-
-        knn_query = {
-            "field": "DescriptionVector",
-            "query_vector": vector_of_input_keyword,
-            "k": 4,
-            "num_candidates": 500
-        }
+        # Repeated queries are answered from the result cache until the next index write
+        try:
+            search = result_cache.get_or_compute("search", lambda: search_products(input_keyword),
+                                                 query=normalize_query(input_keyword), k=4)
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            logger.warning(f"Elasticsearch unreachable, searching the local index: {e}")
+            query_vector = query_encoder.encode(input_keyword)
+            search = {"vector": query_vector, "results": local_index.search_sources(query_vector, 4, SEARCH_FIELDS)}
 
-        res = es.knn_search(index="all_products", knn=knn_query,
-                            _source=["productName", "productDescription", "currency", "imageUrls", "videoUrls",
-                                     "userId", "productPrice"])
+        user_id = request.json.get('user_id')
+        if user_id and user_profiles:
+            user_profiles.record_search(user_id, search["vector"])
+        if user_id and search_history:
+            search_history.record(user_id, input_keyword)
 
-        results = [hit["_source"] for hit in res["hits"]["hits"]]
-        return jsonify(results), 200
+        return jsonify(search["results"]), 200
     except Exception as e:
         logger.error(f"Error performing KNN search: {e}")
         return jsonify({"error": f"Error performing KNN search: {e}"}), 500
 
+# API route for filtered hybrid search: BM25 and kNN fused with reciprocal rank fusion,
+# paged with the search_after cursor of the previous response
+@app.route('/search/hybrid', methods=['POST'])
+def hybrid_search():
+    if not es and local_index is None:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        params = parse_search_request(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        try:
+            search = result_cache.get_or_compute("hybrid", lambda: search_products_hybrid(params),
+                                                 query=normalize_query(params["keyword"]), k=params["k"],
+                                                 filters=params["filters"], search_after=params["search_after"])
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            logger.warning(f"Elasticsearch unreachable, searching the local index: {e}")
+            query_vector = query_encoder.encode(params["keyword"])
+            search = {"vector": query_vector,
+                      "result": local_hybrid_search(local_index, query_vector, params["k"], params["filters"],
+                                                    params["search_after"], SEARCH_FIELDS)}
+
+        user_id = request.json.get('user_id')
+        if user_id and user_profiles and params["search_after"] is None:
+            user_profiles.record_search(user_id, search["vector"])
+        if user_id and search_history and params["search_after"] is None:
+            search_history.record(user_id, params["keyword"])
+
+        return jsonify(search["result"]), 200
+    except Exception as e:
+        logger.error(f"Error performing hybrid search: {e}")
+        return jsonify({"error": f"Error performing hybrid search: {e}"}), 500
+
+# API route to find the sellers of a product, e.g. /sellers?q=who sells rice
+@app.route('/sellers', methods=['GET'])
+def sellers():
+    if not seller_lookup:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    query = request.args.get('q', '')
+    semantic = request.args.get('semantic', '0').lower() in ('1', 'true')
+    try:
+        size = min(int(request.args.get('size', SELLER_LOOKUP_SIZE)), SELLER_LOOKUP_MAX_SIZE)
+    except ValueError:
+        return jsonify({"error": "size must be an integer"}), 400
+
+    try:
+        result = seller_lookup.lookup(query, semantic=semantic, size=max(size, 1))
+        if result is None:
+            return jsonify({"error": "A product to look up is required"}), 400
+        return jsonify(result), 200
+    except Exception as e:
+        logger.error(f"Error finding sellers: {e}")
+        return jsonify({"error": f"Error finding sellers: {e}"}), 500
+
+# API route to stream the catalogue, or part of it, as NDJSON or CSV, e.g.
+# /export/products?category=phones&fields=productName,productPrice&format=csv
+@app.route('/export/products', methods=['GET'])
+def export_catalogue():
+    if not es:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        params = parse_export_request(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        chunks = export_products(es, params)
+    except Exception as e:
+        logger.error(f"Error exporting products: {e}")
+        return jsonify({"error": f"Error exporting products: {e}"}), 500
+    return Response(chunks, content_type=EXPORT_FORMATS[params["format"]],
+                    headers={"Content-Disposition": f"attachment; filename=products.{params['format']}"})
+
+# API route to list a seller's products a page at a time; pass the returned cursor for the next page
+@app.route('/sellers/<user_id>/products', methods=['GET'])
+def seller_products(user_id):
+    if not es:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+
+    try:
+        size = min(int(request.args.get('size', LISTING_DEFAULT_SIZE)), LISTING_MAX_SIZE)
+    except ValueError:
+        return jsonify({"error": "size must be an integer"}), 400
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        result = list_seller_products(es, user_id, max(size, 1), request.args.get('cursor'), fields)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ListingExpiredError as e:
+        return jsonify({"error": str(e)}), 410
+    except Exception as e:
+        logger.error(f"Error listing products of seller {user_id}: {e}")
+        return jsonify({"error": f"Error listing products: {e}"}), 500
+
+# API route to report embedding cache hit/miss counters
+@app.route('/stats/embedding_cache', methods=['GET'])
+def embedding_cache_stats():
+    return jsonify(embedding_cache.stats()), 200
+
+# API route to report query micro-batching counters
+@app.route('/stats/query_encoder', methods=['GET'])
+def query_encoder_stats():
+    return jsonify(query_encoder.stats()), 200
+
+# API route to report result cache hit rates per endpoint
+@app.route('/stats/result_cache', methods=['GET'])
+def result_cache_stats():
+    return jsonify(result_cache.stats()), 200
+
+# API route to report seller lookup cache counters
+@app.route('/stats/seller_lookup', methods=['GET'])
+def seller_lookup_stats():
+    if not seller_lookup:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+    return jsonify(seller_lookup.stats()), 200
+
+# API route to report how many new products duplicated an existing one, per policy
+@app.route('/stats/duplicates', methods=['GET'])
+def duplicate_stats():
+    if not duplicate_detector:
+        return jsonify({"error": "Elasticsearch is not available"}), 500
+    return jsonify(duplicate_detector.stats()), 200
+
+# API route to report search history logging counters: written, spilled, dropped, trimmed
+@app.route('/stats/search_history', methods=['GET'])
+def search_history_stats():
+    if not search_history:
+        return jsonify({"error": "Firestore is not available"}), 500
+    return jsonify(search_history.stats()), 200
+
+# Cache and batching counters are exported next to the request and stage metrics
+metrics.register_stats("embedding_cache", embedding_cache.stats)
+metrics.register_stats("query_encoder", query_encoder.stats)
+metrics.register_stats("result_cache", result_cache.stats)
+if seller_lookup:
+    metrics.register_stats("seller_lookup", seller_lookup.stats)
+if duplicate_detector:
+    metrics.register_stats("duplicates", duplicate_detector.stats)
+if search_history:
+    metrics.register_stats("search_history", search_history.stats)
+
+# API route exposing request latency, per-stage timings and cache counters for Prometheus
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+# API route reporting model warm-up state, startup time and memory of this worker
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = registry.status()
+    if product_index is not None:
+        # Not ready while the index behind the alias holds vectors of another model
+        status["index"] = product_index.status()
+        status["ready"] = status["ready"] and status["index"]["compatible"]
+    return jsonify(status), 200 if status["ready"] else 503
+
 if __name__ == '__main__':
+    registry.warm_up_async()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,155 @@
+"""
+Deterministic synthetic catalogue in the biashara.csv schema.
+
+    python -m benchmarks.catalogue --products 100000 --out synthetic.csv
+
+Vocabulary, currencies and the price range are taken from the seed CSV; the
+optional fields indexMapping declares (category, brand, color, size) are
+filled from fixed lists. The same seed always yields the same products,
+sellers and queries, so runs on different commits see identical data. The
+CSV output can be fed to catalogueLoader.py for ingest runs.
+"""
+import argparse
+import ast
+import csv
+import math
+import os
+import random
+import re
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.harness import REPO_ROOT
+
+SEED_CSV = os.path.join(REPO_ROOT, "biashara.csv")
+COLUMNS = ["productDescription", "userId", "currency", "imageUrls", "videoUrls",
+           "productPrice", "timestamp", "productName"]
+
+CATEGORIES = ["electronics", "phones", "computers", "fashion", "shoes", "home", "kitchen",
+              "beauty", "groceries", "furniture", "sports", "toys", "books", "auto"]
+BRANDS = ["Tecno", "Samsung", "Infinix", "HP", "Lenovo", "Nike", "Adidas", "Sayona",
+          "Hisense", "Azam", "Bata", "Apple", "Xiaomi", "Generic"]
+COLORS = ["black", "white", "red", "blue", "green", "silver", "gold", "brown"]
+SIZES = ["S", "M", "L", "XL", "38", "40", "42", "44"]
+ADJECTIVES = ["new", "used", "original", "durable", "portable", "wireless", "classic", "premium",
+              "cheap", "modern", "small", "large", "smart", "fast", "quality"]
+EXTRA_NAMES = ["Phone", "Laptop", "Shoes", "Shirt", "Television", "Fridge", "Blender", "Sofa",
+               "Watch", "Headphones", "Charger", "Speaker", "Rice", "Maize flour", "Bicycle", "Mattress"]
+
+_WORD = re.compile(r"[A-Za-z]{3,}")
+
+
+class CatalogueSchema:
+    def __init__(self, names, words, currencies, price_range, image_prefix):
+        self.names = names
+        self.words = words
+        self.currencies = currencies
+        self.price_range = price_range
+        self.image_prefix = image_prefix
+
+
+def load_schema(path=SEED_CSV):
+    names, words, currencies, prices = set(EXTRA_NAMES), set(), set(), []
+    image_prefix = "https://firebasestorage.googleapis.com/v0/b/biashara-app.appspot.com/o/posts%2F"
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                names.add(row["productName"].strip())
+                words.update(word.lower() for word in _WORD.findall(row["productDescription"]))
+                currencies.add(row["currency"].strip())
+                try:
+                    prices.append(float(row["productPrice"]))
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return CatalogueSchema(
+        names=sorted(name for name in names if name),
+        words=sorted(words) or ["best", "quality", "product", "use", "good"],
+        currencies=sorted(currencies) or ["Tshs"],
+        price_range=(max(min(prices, default=500.0), 1.0), max(max(prices, default=100000.0), 10.0)),
+        image_prefix=image_prefix,
+    )
+
+
+def _seller_ids(rng, count):
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    return ["".join(rng.choice(alphabet) for _ in range(28)) for _ in range(count)]
+
+
+# Sellers follow a Zipf-like distribution: a few large shops and a long tail
+def generate_products(count, seed=0, sellers=None, schema=None):
+    schema = schema or load_schema()
+    rng = random.Random(seed)
+    seller_ids = _seller_ids(rng, sellers or max(1, count // 20))
+    weights = [1.0 / (rank + 1) for rank in range(len(seller_ids))]
+    low, high = map(math.log, schema.price_range)
+    started = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+    products = []
+    for i in range(count):
+        base = rng.choice(schema.names)
+        name = f"{rng.choice(ADJECTIVES).capitalize()} {base}"
+        description = f"This is the best {base.lower()} " + " ".join(rng.choices(schema.words, k=rng.randint(6, 24)))
+        product = {
+            "id": f"bench-{seed}-{i}",
+            "productName": name,
+            "productDescription": description,
+            "userId": rng.choices(seller_ids, weights=weights)[0],
+            "currency": rng.choice(schema.currencies),
+            "productPrice": round(math.exp(rng.uniform(low, high)), -1),
+            "imageUrls": [f"{schema.image_prefix}{base.replace(' ', '')}%2F{seed}{i}{n}.png" for n in range(rng.randint(1, 3))],
+            "videoUrls": [],
+            "timestamp": (started + timedelta(seconds=i * 37)).isoformat(),
+            "category": rng.choice(CATEGORIES),
+            "brand": rng.choice(BRANDS),
+        }
+        if rng.random() < 0.4:
+            product["color"] = rng.choice(COLORS)
+        if rng.random() < 0.2:
+            product["size"] = rng.choice(SIZES)
+        products.append(product)
+    return products
+
+
+# Queries mix exact product names, name fragments and description phrases
+def generate_queries(products, count, seed=0):
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(count):
+        product = rng.choice(products)
+        kind = rng.random()
+        if kind < 0.4:
+            queries.append(product["productName"])
+        elif kind < 0.7:
+            queries.append(product["productName"].split(" ", 1)[-1])
+        else:
+            words = product["productDescription"].split()
+            start = rng.randrange(max(1, len(words) - 4))
+            queries.append(" ".join(words[start:start + 4]))
+    return queries
+
+
+def write_csv(products, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for product in products:
+            writer.writerow({**product, "imageUrls": repr(product["imageUrls"]), "videoUrls": repr(product["videoUrls"])})
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [{**row, "imageUrls": ast.literal_eval(row["imageUrls"]), "videoUrls": ast.literal_eval(row["videoUrls"]),
+                 "productPrice": float(row["productPrice"])} for row in csv.DictReader(f)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic catalogue in the biashara.csv schema")
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--sellers", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="synthetic.csv")
+    args = parser.parse_args()
+
+    write_csv(generate_products(args.products, args.seed, args.sellers), args.out)
+    print(f"Wrote {args.products} products to {args.out}")
@@ -0,0 +1,63 @@
+"""
+Compare two result files written with --out, e.g. from two commits:
+
+    python -m benchmarks.compare before.json after.json
+
+Rows are matched by name; the change is shown as a percentage of the first
+file's value, so for latencies negative is better and for throughput
+positive is better.
+"""
+import argparse
+import json
+
+METRICS = ["p50_ms", "p95_ms", "p99_ms", "items_per_second", "requests_per_second", "errors"]
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _change(before, after):
+    if before is None or after is None:
+        return None
+    if before == 0:
+        return None if after == 0 else "new"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def compare(before, after):
+    rows = []
+    after_results = {result["name"]: result for result in after["results"]}
+    for result in before["results"]:
+        other = after_results.get(result["name"])
+        if other is None:
+            continue
+        for metric in METRICS:
+            if metric in result or metric in other:
+                rows.append({"name": result["name"], "metric": metric, "before": result.get(metric),
+                             "after": other.get(metric), "change": _change(result.get(metric), other.get(metric))})
+    return rows
+
+
+if __name__ == "__main__":
+    from benchmarks.harness import print_table
+
+    parser = argparse.ArgumentParser(description="Show metric changes between two benchmark result files")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    before, after = _load(args.before), _load(args.after)
+    if before["kind"] != after["kind"]:
+        raise SystemExit(f"Cannot compare a {before['kind']} run with a {after['kind']} run")
+    for label, report in (("before", before), ("after", after)):
+        environment = report["environment"]
+        print(f"{label}: commit {environment['commit']}, python {environment['python']}, {environment['cpus']} cpus")
+    if before["settings"] != after["settings"]:
+        print(f"warning: settings differ: {before['settings']} vs {after['settings']}")
+    rows = compare(before, after)
+    if rows:
+        print_table(rows, ["name", "metric", "before", "after", "change"])
+    else:
+        print("No results in common")
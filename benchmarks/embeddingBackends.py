@@ -0,0 +1,59 @@
+"""
+Throughput per core and fp32 parity of the embedding backends (see
+embeddingBackend.py) on synthetic catalogue descriptions.
+
+    python -m benchmarks.embeddingBackends --threads 1,4 --out backends.json
+    python -m benchmarks.embeddingBackends --backends torch,onnx-int8 --docs 1024
+
+Each backend is timed at every thread count; items_per_core divides the
+throughput by the threads given to the runtime. Parity is the cosine
+similarity to the fp32 torch vectors of the same descriptions.
+"""
+import argparse
+import os
+
+from benchmarks.catalogue import generate_products
+from benchmarks.harness import measure, print_table, write_results
+
+
+def run(model_name, backends, threads_list, docs=256, batch_size=32, repeat=3):
+    from embeddingBackend import load_encoder, parity_report
+
+    descriptions = [product["productDescription"] for product in generate_products(docs, seed=2)]
+    expected = None
+    results = []
+    for backend in backends:
+        for threads in threads_list:
+            encoder = load_encoder(model_name, backend, threads)
+            result = measure(f"{backend}/threads={threads}",
+                             lambda: encoder.encode(descriptions, batch_size=batch_size),
+                             repeat=repeat, items=docs)
+            result["threads"] = threads
+            result["items_per_core"] = round(result["items_per_second"] / threads, 2)
+            vectors = encoder.encode(descriptions, batch_size=batch_size)
+            if expected is None and backend == "torch":
+                expected = vectors
+            if expected is not None:
+                parity = parity_report(expected, vectors)
+                result["min_cosine"], result["mean_cosine"] = parity["min_cosine"], parity["mean_cosine"]
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embedding backend throughput and parity")
+    parser.add_argument("--model", default=os.getenv('EMBEDDING_MODEL', "all-mpnet-base-v2"))
+    parser.add_argument("--backends", default="torch,torch-int8,onnx,onnx-int8",
+                        help="Comma separated; keep torch first to measure parity against it")
+    parser.add_argument("--threads", default=f"1,{os.cpu_count() or 1}")
+    parser.add_argument("--docs", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="Write the results as JSON for benchmarks.compare")
+    args = parser.parse_args()
+
+    backends = args.backends.split(",")
+    threads_list = sorted({int(threads) for threads in args.threads.split(",")})
+    results = run(args.model, backends, threads_list, args.docs, args.batch_size, args.repeat)
+    print_table(results, ["name", "items_per_second", "items_per_core", "p50_ms", "min_cosine", "mean_cosine"])
+    write_results(args.out, "embedding_backends", vars(args), results)
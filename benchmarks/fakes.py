@@ -0,0 +1,572 @@
+"""
+In-process stand-ins for Elasticsearch, Firestore and the embedding model,
+good enough to drive the entry points offline. They implement only the calls
+this repository makes, with brute-force kNN and a simple term-overlap score
+for lexical queries, so absolute latencies are not cluster latencies; use
+them to compare commits and entry points against each other.
+"""
+import hashlib
+import json
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+
+_TOKEN = re.compile(r"\w+")
+
+
+def _tokens(text):
+    return _TOKEN.findall(str(text).lower())
+
+
+class HashEncoder:
+    """Deterministic bag-of-words feature hashing with the SentenceTransformer encode() signature."""
+
+    def __init__(self, dims=768):
+        self.dims = dims
+
+    def _vector(self, text):
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for token in _tokens(text):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dims
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if isinstance(sentences, str):
+            return self._vector(sentences)
+        return np.stack([self._vector(text) for text in sentences]) if len(sentences) else np.zeros((0, self.dims), np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dims
+
+
+class FakeResponse(dict):
+    @property
+    def body(self):
+        return self
+
+
+class _Serializer:
+    def dumps(self, data):
+        return json.dumps(data).encode("utf-8")
+
+
+class _Transport:
+    class serializers:
+        @staticmethod
+        def get_serializer(mimetype):
+            return _Serializer()
+
+
+class _Indices:
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index):
+        return index in self.es.docs or index in self.es.aliases
+
+    def exists_alias(self, name, **kwargs):
+        return name in self.es.aliases
+
+    def create(self, index, body=None, **kwargs):
+        body = body or {}
+        self.es.docs.setdefault(index, {})
+        self.es.mappings[index] = body.get("mappings", {})
+        for alias, options in body.get("aliases", {}).items():
+            self.es.aliases.setdefault(alias, {})[index] = options
+        return FakeResponse(acknowledged=True)
+
+    def get_alias(self, name, **kwargs):
+        if name not in self.es.aliases:
+            from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+            from elasticsearch import NotFoundError
+            meta = ApiResponseMeta(404, "1.1", HttpHeaders(), 0.0, NodeConfig("http", "localhost", 9200))
+            raise NotFoundError(f"alias [{name}] missing", meta, {"error": f"alias [{name}] missing", "status": 404})
+        return FakeResponse({index: {"aliases": {name: options}} for index, options in self.es.aliases[name].items()})
+
+    def get_mapping(self, index, **kwargs):
+        index = self.es._resolve(index)
+        return FakeResponse({index: {"mappings": self.es.mappings.get(index, {})}})
+
+    def put_mapping(self, index, properties=None, **kwargs):
+        index = self.es._resolve(index)
+        mappings = self.es.mappings.setdefault(index, {})
+        mappings.setdefault("properties", {}).update(properties or {})
+        return FakeResponse(acknowledged=True)
+
+    def refresh(self, index=None, **kwargs):
+        return FakeResponse(_shards={"successful": 1})
+
+
+class FakeElasticsearch:
+    def __init__(self, *args, **kwargs):
+        self.docs = {}          # index -> {id: source}
+        self.mappings = {}      # index -> mappings
+        self.aliases = {}       # alias -> {index: alias options}
+        self.transport = _Transport()
+        self.indices = _Indices(self)
+        self._lock = threading.RLock()
+        self._matrices = {}     # index -> (ids, matrix), rebuilt after writes
+        self.calls = {}
+        self.pits = {}          # point in time id -> index
+
+    def options(self, **kwargs):
+        return self
+
+    def ping(self):
+        return True
+
+    def _count_call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    # The write index of an alias, or the index itself
+    def _resolve(self, index):
+        targets = self.aliases.get(index)
+        if not targets:
+            return index
+        return next((name for name, options in targets.items() if options.get("is_write_index")), next(iter(targets)))
+
+    # Writes
+
+    def _apply(self, index, op, doc_id, body):
+        index = self._resolve(index)
+        documents = self.docs.setdefault(index, {})
+        self._matrices.pop(index, None)
+        if op in ("index", "create"):
+            documents[doc_id] = body
+            return 201
+        if op == "update":
+            if doc_id not in documents:
+                return 404
+            documents[doc_id] = {**documents[doc_id], **body.get("doc", {})}
+            return 200
+        if op == "delete":
+            return 200 if documents.pop(doc_id, None) is not None else 404
+        return 400
+
+    def bulk(self, operations=None, body=None, index=None, **kwargs):
+        self._count_call("bulk")
+        lines = [json.loads(line) if isinstance(line, (bytes, str)) else line for line in (operations or body)]
+        items = []
+        errors = False
+        position = 0
+        with self._lock:
+            while position < len(lines):
+                header = lines[position]
+                op, meta = next(iter(header.items()))
+                position += 1
+                payload = None
+                if op != "delete":
+                    payload = lines[position]
+                    position += 1
+                doc_id = meta.get("_id") or uuid.uuid4().hex
+                status = self._apply(meta.get("_index", index), op, doc_id, payload)
+                item = {"_id": doc_id, "status": status}
+                if status >= 300:
+                    errors = True
+                    item["error"] = {"type": "document_missing_exception" if status == 404 else "illegal_argument_exception"}
+                items.append({op: item})
+        return FakeResponse(errors=errors, items=items)
+
+    def index(self, index, id=None, document=None, body=None, **kwargs):
+        with self._lock:
+            self._apply(index, "index", id or uuid.uuid4().hex, document or body)
+        return FakeResponse(result="created", _id=id)
+
+    def delete(self, index, id, **kwargs):
+        with self._lock:
+            self._apply(index, "delete", id, None)
+        return FakeResponse(result="deleted")
+
+    # Reads
+
+    def _matches(self, source, query):
+        if not query or "match_all" in query:
+            return True
+        if "bool" in query:
+            clauses = query["bool"]
+            must = clauses.get("must", [])
+            must = must if isinstance(must, list) else [must]
+            filters = clauses.get("filter", [])
+            filters = filters if isinstance(filters, list) else [filters]
+            must_not = clauses.get("must_not", [])
+            must_not = must_not if isinstance(must_not, list) else [must_not]
+            return (all(self._matches(source, clause) for clause in must + filters)
+                    and not any(self._matches(source, clause) for clause in must_not))
+        if "exists" in query:
+            return source.get(query["exists"]["field"]) is not None
+        if "terms" in query:
+            field, values = next(iter(query["terms"].items()))
+            value = source.get(field)
+            if isinstance(value, list):
+                return any(item in values for item in value)
+            return value in values
+        if "term" in query:
+            field, value = next(iter(query["term"].items()))
+            return source.get(field) == (value["value"] if isinstance(value, dict) else value)
+        if "range" in query:
+            field, bounds = next(iter(query["range"].items()))
+            value = source.get(field)
+            if value is None:
+                return False
+            return all({"gte": value >= bound, "gt": value > bound, "lte": value <= bound, "lt": value < bound}[op]
+                       for op, bound in bounds.items())
+        return self._score(source, query) > 0
+
+    def _score(self, source, query):
+        if "bool" in query:
+            must = query["bool"].get("must", [])
+            must = must if isinstance(must, list) else [must]
+            return sum(self._score(source, clause) for clause in must) if must else 1.0
+        if "match" in query:
+            field, spec = next(iter(query["match"].items()))
+            text = spec["query"] if isinstance(spec, dict) else spec
+            operator = spec.get("operator", "or") if isinstance(spec, dict) else "or"
+            terms, present = _tokens(text), set(_tokens(source.get(field, "")))
+            hits = sum(1 for term in terms if term in present)
+            if operator == "and" and hits < len(terms):
+                return 0.0
+            return float(hits)
+        if "multi_match" in query:
+            text = query["multi_match"]["query"]
+            score = 0.0
+            for field in query["multi_match"]["fields"]:
+                name, _, boost = field.partition("^")
+                present = set(_tokens(source.get(name, "")))
+                score += float(boost or 1) * sum(1 for term in _tokens(text) if term in present)
+            return score
+        return 1.0 if self._matches(source, query) else 0.0
+
+    def _project(self, source, fields):
+        if fields is False:
+            return None
+        if isinstance(fields, dict):
+            if "includes" in fields:
+                return self._project(source, fields["includes"])
+            return {field: value for field, value in source.items() if field not in fields.get("excludes", [])}
+        if not fields:
+            return dict(source)
+        return {field: source[field] for field in fields if field in source}
+
+    def _knn(self, index, knn):
+        with self._lock:
+            documents = self.docs.get(index, {})
+            if index not in self._matrices:
+                ids = [doc_id for doc_id, source in documents.items() if knn["field"] in source]
+                matrix = np.asarray([documents[doc_id][knn["field"]] for doc_id in ids], dtype=np.float32).reshape(len(ids), -1)
+                matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+                self._matrices[index] = (ids, matrix)
+            ids, matrix = self._matrices[index]
+        if not ids:
+            return []
+        query = np.asarray(knn["query_vector"], dtype=np.float32)
+        scores = matrix @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        order = np.argsort(-scores)
+        hits = []
+        for position in order:
+            source = documents.get(ids[position])
+            if source is None or ("filter" in knn and not self._matches(source, {"bool": {"filter": knn["filter"]}})):
+                continue
+            hits.append((ids[position], float((1 + scores[position]) / 2)))
+            if len(hits) >= knn["k"]:
+                break
+        return hits
+
+    def _search(self, index, body):
+        body = body or {}
+        if "pit" in body:
+            index = self.pits[body["pit"]["id"]]
+        index = self._resolve(index)
+        documents = self.docs.get(index, {})
+        scored = {}
+        if "query" in body or "knn" not in body:
+            query = body.get("query", {"match_all": {}})
+            for doc_id, source in list(documents.items()):
+                if self._matches(source, query):
+                    scored[doc_id] = self._score(source, query)
+        if "knn" in body:
+            for doc_id, score in self._knn(index, body["knn"]):
+                scored[doc_id] = scored.get(doc_id, 0.0) + score
+        ranked = sorted(scored.items(), key=lambda item: (-item[1], item[0]))
+        if "sort" in body:
+            # Only document order is supported: ids stand in for _shard_doc
+            ranked = sorted(scored.items())
+            if body.get("search_after"):
+                ranked = [item for item in ranked if item[0] > body["search_after"][0]]
+        size = body.get("size", 10)
+        hits = []
+        for doc_id, score in ranked[:size]:
+            hit = {"_index": index, "_id": doc_id, "_score": score}
+            if "sort" in body:
+                hit["sort"] = [doc_id]
+            source = self._project(documents[doc_id], body.get("_source"))
+            if source is not None:
+                hit["_source"] = source
+            hits.append(hit)
+        response = {"hits": {"total": {"value": len(ranked), "relation": "eq"}, "hits": hits}}
+        if "aggs" in body:
+            response["aggregations"] = {}
+            for name, aggregation in body["aggs"].items():
+                field, limit = aggregation["terms"]["field"], aggregation["terms"].get("size", 10)
+                counts = {}
+                for doc_id, _ in ranked:
+                    value = documents[doc_id].get(field)
+                    if value is not None:
+                        counts[value] = counts.get(value, 0) + 1
+                buckets = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+                response["aggregations"][name] = {
+                    "buckets": [{"key": key, "doc_count": count} for key, count in buckets[:limit]],
+                    "sum_other_doc_count": sum(count for _, count in buckets[limit:]),
+                }
+        return response
+
+    def search(self, index=None, body=None, **kwargs):
+        self._count_call("search")
+        body = dict(body or {})
+        body.update({key: value for key, value in kwargs.items()
+                     if key in ("query", "knn", "size", "aggs", "_source", "pit", "sort", "search_after")})
+        return FakeResponse(self._search(index, body))
+
+    def open_point_in_time(self, index, keep_alive=None, **kwargs):
+        with self._lock:
+            self._count_call("open_point_in_time")
+            pit = f"pit-{self.calls['open_point_in_time']}"
+            self.pits[pit] = self._resolve(index)
+        return FakeResponse(id=pit)
+
+    def close_point_in_time(self, id=None, **kwargs):
+        self._count_call("close_point_in_time")
+        return FakeResponse(succeeded=self.pits.pop(id, None) is not None, num_freed=1)
+
+    def knn_search(self, index, knn, _source=None, **kwargs):
+        self._count_call("knn_search")
+        index = self._resolve(index)
+        documents = self.docs.get(index, {})
+        hits = [{"_index": index, "_id": doc_id, "_score": score,
+                 "_source": self._project(documents[doc_id], _source)}
+                for doc_id, score in self._knn(index, knn) if doc_id in documents]
+        return FakeResponse(hits={"total": {"value": len(hits), "relation": "eq"}, "hits": hits})
+
+    def msearch(self, body=None, searches=None, **kwargs):
+        self._count_call("msearch")
+        lines = body or searches
+        return FakeResponse(responses=[self._search(lines[i].get("index"), lines[i + 1]) for i in range(0, len(lines), 2)])
+
+    def count(self, index=None, body=None, **kwargs):
+        self._count_call("count")
+        query = (body or {}).get("query", {"match_all": {}})
+        index = self._resolve(index)
+        return FakeResponse(count=sum(1 for source in self.docs.get(index, {}).values() if self._matches(source, query)))
+
+    def mget(self, index=None, ids=None, _source=None, _source_excludes=None, **kwargs):
+        self._count_call("mget")
+        index = self._resolve(index)
+        documents = self.docs.get(index, {})
+        excludes = set(_source_excludes or ())
+        return FakeResponse(docs=[
+            {"_index": index, "_id": doc_id, "found": True,
+             "_source": {key: value for key, value in self._project(documents[doc_id], _source).items()
+                         if key not in excludes}}
+            if doc_id in documents else {"_index": index, "_id": doc_id, "found": False}
+            for doc_id in ids
+        ])
+
+    def get(self, index, id, **kwargs):
+        index = self._resolve(index)
+        source = self.docs.get(index, {}).get(id)
+        return FakeResponse(_id=id, found=source is not None, _source=source)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+        self.update_time = datetime.now(timezone.utc) if data is not None else None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, store, path, doc_id):
+        self._store = store
+        self.path = f"{path}/{doc_id}"
+        self.id = doc_id
+
+    def collection(self, name):
+        return FakeCollection(self._store, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        with self._store.lock:
+            if transaction is not None:
+                transaction._read(self.path)
+            return FakeSnapshot(self, self._store.documents.get(self.path))
+
+    def set(self, data, merge=False):
+        with self._store.lock:
+            current = self._store.documents.get(self.path) if merge else None
+            self._store.documents[self.path] = {**(current or {}), **data}
+            self._store.touch(self.path)
+
+    def update(self, fields):
+        with self._store.lock:
+            if self.path not in self._store.documents:
+                raise KeyError(f"No document to update: {self.path}")
+            self._store.documents[self.path] = {**self._store.documents[self.path], **fields}
+            self._store.touch(self.path)
+
+    def delete(self):
+        with self._store.lock:
+            self._store.documents.pop(self.path, None)
+            self._store.touch(self.path)
+
+
+class FakeCollection:
+    def __init__(self, store, path, order=None, limit=None, offset=0):
+        self._store = store
+        self.path = path
+        self._order = order
+        self._limit = limit
+        self._offset = offset
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self._store, self.path, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+    def order_by(self, field, direction="ASCENDING"):
+        return FakeCollection(self._store, self.path, (field, direction == "DESCENDING"), self._limit, self._offset)
+
+    def limit(self, count):
+        return FakeCollection(self._store, self.path, self._order, count, self._offset)
+
+    def offset(self, count):
+        return FakeCollection(self._store, self.path, self._order, self._limit, count)
+
+    # Documents that exist or have subcollections, as in Firestore
+    def list_documents(self):
+        prefix = self.path + "/"
+        with self._store.lock:
+            ids = {path[len(prefix):].split("/", 1)[0] for path in self._store.documents if path.startswith(prefix)}
+        return [self.document(doc_id) for doc_id in sorted(ids)]
+
+    def stream(self):
+        prefix = self.path + "/"
+        with self._store.lock:
+            rows = [(path[len(prefix):], data) for path, data in self._store.documents.items()
+                    if path.startswith(prefix) and "/" not in path[len(prefix):]]
+        if self._order:
+            field, descending = self._order
+            rows.sort(key=lambda row: row[1].get(field) or 0, reverse=descending)
+        end = None if self._limit is None else self._offset + self._limit
+        for doc_id, data in rows[self._offset:end]:
+            yield FakeSnapshot(self.document(doc_id), data)
+
+
+class FakeBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference.set(data, merge=merge))
+
+    def update(self, reference, fields):
+        self._writes.append(lambda: reference.update(fields))
+
+    def delete(self, reference):
+        self._writes.append(reference.delete)
+
+    def commit(self, **kwargs):
+        with self._store.lock:
+            for write in self._writes:
+                write()
+        self._writes = []
+
+
+class FakeTransaction(FakeBatch):
+    """
+    Optimistic concurrency, enough for firestore.transactional: the commit is
+    aborted (and the decorator retries) if a document read in the transaction
+    was written since.
+    """
+
+    def __init__(self, store, max_attempts=5):
+        super().__init__(store)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        self._reads = {}
+
+    def _read(self, path):
+        self._reads.setdefault(path, self._store.versions.get(path, 0))
+
+    def _clean_up(self):
+        self._writes, self._reads, self._id = [], {}, None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().hex
+
+    def _commit(self):
+        from google.api_core.exceptions import Aborted
+
+        with self._store.lock:
+            if any(self._store.versions.get(path, 0) != version for path, version in self._reads.items()):
+                self._clean_up()
+                raise Aborted("Transaction contention")
+            self.commit()
+        self._clean_up()
+
+    def _rollback(self):
+        self._clean_up()
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.documents = {}     # "collection/doc/collection/doc" -> data
+        self.versions = {}      # path -> number of writes, for transaction conflicts
+        self.lock = threading.RLock()
+
+    def touch(self, path):
+        self.versions[path] = self.versions.get(path, 0) + 1
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self, max_attempts=5):
+        return FakeTransaction(self, max_attempts)
+
+    def get_all(self, references):
+        return [reference.get() for reference in references]
+
+
+# Make the entry points' module-level Elasticsearch(...) and firestore.client() calls
+# return the stand-ins; import the entry point inside this context
+@contextmanager
+def installed(es, db):
+    import elasticsearch
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    saved = (elasticsearch.Elasticsearch, credentials.Certificate, firebase_admin.initialize_app, firestore.client)
+    elasticsearch.Elasticsearch = lambda *args, **kwargs: es
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: db
+    try:
+        yield
+    finally:
+        (elasticsearch.Elasticsearch, credentials.Certificate, firebase_admin.initialize_app, firestore.client) = saved
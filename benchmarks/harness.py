@@ -0,0 +1,97 @@
+"""
+Shared pieces of the benchmark runners: isolated on-disk state, timing and
+percentiles, and JSON result files that can be compared across commits with
+`python -m benchmarks.compare`.
+"""
+import importlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Point every on-disk cache and index at a scratch directory so runs start cold and
+# never touch the working tree. Must run before any repository module is imported.
+def isolate_state(directory=None, result_cache="none"):
+    directory = directory or tempfile.mkdtemp(prefix="biashara-bench-")
+    os.environ['EMBEDDING_CACHE_DIR'] = os.path.join(directory, "embeddings")
+    os.environ['LOCAL_INDEX_DIR'] = os.path.join(directory, "local_index")
+    os.environ['INDEX_GENERATION_PATH'] = os.path.join(directory, "index_generation")
+    os.environ['SYNC_STATE_DIR'] = os.path.join(directory, "sync")
+    os.environ['RESULT_CACHE_BACKEND'] = result_cache
+    os.environ.setdefault('MODEL_WARMUP', '0')
+    return directory
+
+
+# Swap the registered embedding model for a stand-in before anything loads it
+def use_encoder(kind, dims=768):
+    from modelRegistry import registry
+    importlib.import_module("documentPreparation")  # Registers the real loader first
+
+    if kind == "hash":
+        from benchmarks.fakes import HashEncoder
+        registry.register("embedding", lambda: HashEncoder(dims))
+    elif kind != "real":
+        raise ValueError(f"Unknown encoder '{kind}', expected real or hash")
+
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    if not len(samples):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3), "mean_ms": round(float(samples.mean()), 3)}
+
+
+# Call fn() repeatedly; each call handles `items` units of work
+def measure(name, fn, repeat=5, items=1, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    total_seconds = sum(samples) / 1000
+    return {"name": name, "items": items, "repeat": repeat,
+            "items_per_second": round(items * repeat / total_seconds, 2) if total_seconds else None,
+            **percentiles(samples)}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "vector_profile": os.getenv('VECTOR_PROFILE', 'hnsw:768'),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def write_results(path, kind, settings, results):
+    report = {"kind": kind, "environment": environment(), "settings": settings, "results": results}
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+    return report
+
+
+def print_table(results, columns):
+    widths = {column: max(len(column), *(len(str(row.get(column))) for row in results)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in results:
+        print("  ".join(str(row.get(column)).ljust(widths[column]) for column in columns))
@@ -0,0 +1,200 @@
+"""
+Concurrent HTTP load driver for the Flask entry points, run against the
+in-process Elasticsearch/Firestore stand-ins in benchmarks.fakes.
+
+    python -m benchmarks.load --app backend --scenario search --requests 2000 --concurrency 16
+    python -m benchmarks.load --app app --scenario recommendations --result-cache memory --out rec.json
+
+The entry module is imported with the stand-ins installed, seeded with a
+synthetic catalogue (through its own indexing queue, so the write path is
+exercised too) and served by werkzeug on a local port. Each client thread
+keeps one HTTP/1.1 connection open. Latency percentiles, requests per second
+and the error count are printed and optionally written for benchmarks.compare.
+"""
+import argparse
+import http.client
+import importlib
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.catalogue import generate_products, generate_queries
+from benchmarks.harness import isolate_state, percentiles, print_table, use_encoder, write_results
+
+HISTORY_USERS = 200
+HISTORY_QUERIES = 10
+
+
+# Each scenario maps a request number to (method, path, JSON body or None)
+def _scenarios(products, queries, users, seed):
+    rng = random.Random(seed)
+    new_products = generate_products(len(queries), seed=seed + 1000)
+    filters = [{}, {"category": "phones"}, {"brand": ["Samsung", "Tecno"]}, {"max_price": 50000}]
+
+    def sellers_query(i):
+        return "/sellers?" + urllib.parse.urlencode({"q": f"who sells {products[i % len(products)]['productName']}"})
+
+    return {
+        "add_product": lambda i: ("POST", "/add_product", new_products[i % len(new_products)]),
+        "search": lambda i: ("POST", "/search", {"keyword": queries[i % len(queries)],
+                                                 "user_id": users[i % len(users)]}),
+        "hybrid": lambda i: ("POST", "/search/hybrid", {"keyword": queries[i % len(queries)], "k": 10,
+                                                        "filters": filters[i % len(filters)]}),
+        "recommendations": lambda i: ("GET", f"/recommendations/{rng.choice(users)}", None),
+        "sellers": lambda i: ("GET", sellers_query(i), None),
+    }
+
+
+def _seed(module, db, products, queries, users):
+    queue = getattr(module, "indexing_queue", None)
+    if queue is None:
+        raise RuntimeError(f"{module.__name__} has no indexing queue to seed the catalogue through")
+    for product in products:
+        queue.enqueue_product(product["id"], product, timeout=None)
+    if not queue.flush(timeout=600):
+        raise RuntimeError("Seeding did not finish within 10 minutes")
+
+    now = datetime.now(timezone.utc)
+    batch = db.batch()
+    for u, user_id in enumerate(users):
+        searches = db.collection('searchHistory').document(user_id).collection('searches')
+        for n in range(HISTORY_QUERIES):
+            batch.set(searches.document(), {"query": queries[(u * HISTORY_QUERIES + n) % len(queries)],
+                                            "timestamp": now - timedelta(minutes=n)})
+    batch.commit()
+
+
+def _serve(app):
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # No access log line per request
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _drive(port, make_request, total, concurrency):
+    local = threading.local()
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    samples, statuses = [], {}
+    record_lock = threading.Lock()
+
+    def connection():
+        if getattr(local, "conn", None) is None:
+            local.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        return local.conn
+
+    def send(method, path, body):
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        try:
+            conn = connection()
+            conn.request(method, path, body=payload, headers=headers)
+        except (http.client.HTTPException, OSError):
+            local.conn = None  # The server closed the kept-alive connection; retry once on a new one
+            conn = connection()
+            conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.getheader("Connection", "").lower() == "close":
+            conn.close()
+            local.conn = None
+        return response.status
+
+    def worker():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            try:
+                status = send(*make_request(i))
+            except (http.client.HTTPException, OSError):
+                local.conn = None
+                status = "connection_error"
+            elapsed = (time.perf_counter() - started) * 1000
+            with record_lock:
+                samples.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - started
+    return samples, statuses, wall
+
+
+def run(app_name, scenario, requests=1000, concurrency=8, catalogue=2000, encoder="hash",
+        warmup=50, seed=0):
+    from benchmarks.fakes import FakeElasticsearch, FakeFirestore, installed
+
+    es, db = FakeElasticsearch(), FakeFirestore()
+    with installed(es, db):
+        module = importlib.import_module(app_name)
+    use_encoder(encoder)
+
+    products = generate_products(catalogue, seed=seed)
+    queries = generate_queries(products, max(requests, 100), seed=seed)
+    users = [f"bench-user-{n}" for n in range(HISTORY_USERS)]
+    scenarios = _scenarios(products, queries, users, seed)
+    routes = {rule.rule.split("<")[0] for rule in module.app.url_map.iter_rules()}
+    method, path, _ = scenarios[scenario](0)
+    if not any(path.split("?")[0] == route or (route.endswith("/") and path.startswith(route)) for route in routes):
+        raise SystemExit(f"{app_name}.py has no route for the '{scenario}' scenario ({method} {path.split('?')[0]})")
+
+    seeding_started = time.perf_counter()
+    _seed(module, db, products, queries, users)
+    seeding = time.perf_counter() - seeding_started
+
+    server = _serve(module.app)
+    try:
+        port = server.server_port
+        if warmup:
+            _drive(port, lambda i: scenarios[scenario](requests + i), warmup, min(concurrency, warmup))
+        samples, statuses, wall = _drive(port, scenarios[scenario], requests, concurrency)
+    finally:
+        server.shutdown()
+
+    errors = sum(count for status, count in statuses.items() if not isinstance(status, int) or status >= 400)
+    return {
+        "name": f"{app_name}/{scenario}",
+        "requests": len(samples),
+        "concurrency": concurrency,
+        "requests_per_second": round(len(samples) / wall, 2) if wall else None,
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "seed_seconds": round(seeding, 3),
+        "es_calls": dict(es.calls),
+        **percentiles(samples),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline HTTP load test of an entry point")
+    parser.add_argument("--app", choices=["app", "backend", "server"], default="backend")
+    parser.add_argument("--scenario", choices=["add_product", "search", "hybrid", "recommendations", "sellers"],
+                        default="search")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--catalogue", type=int, default=2000, help="Products seeded before the run")
+    parser.add_argument("--encoder", choices=["hash", "real"], default="hash")
+    parser.add_argument("--result-cache", choices=["none", "memory"], default="none")
+    parser.add_argument("--warmup", type=int, default=50, help="Untimed requests sent first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Write the result as JSON for benchmarks.compare")
+    args = parser.parse_args()
+
+    isolate_state(result_cache=args.result_cache)
+    result = run(args.app, args.scenario, args.requests, args.concurrency, args.catalogue, args.encoder,
+                 args.warmup, args.seed)
+    print_table([result], ["name", "requests", "concurrency", "requests_per_second", "errors",
+                           "p50_ms", "p95_ms", "p99_ms"])
+    write_results(args.out, "load", vars(args), [result])
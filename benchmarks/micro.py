@@ -0,0 +1,86 @@
+"""
+Microbenchmarks for the per-product ingest path: description encoding at
+several batch sizes, document preparation with a cold and a warm embedding
+cache, and serialization of documents and _bulk bodies.
+
+    python -m benchmarks.micro --encoder hash --out micro.json
+    python -m benchmarks.micro --encoder real --docs 256
+
+--encoder hash swaps the SentenceTransformer for a feature-hashing stand-in
+(see benchmarks.fakes.HashEncoder), which isolates the repository's own
+overhead from model inference and runs without the model download.
+"""
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+from benchmarks.harness import isolate_state, measure, print_table, use_encoder, write_results
+from benchmarks.catalogue import generate_products
+
+BATCH_SIZES = [1, 8, 32, 128]
+_unique = itertools.count()
+
+
+# Products with descriptions no earlier call has seen, so the embedding cache misses
+def _fresh(products):
+    run = next(_unique)
+    return [{**product, "productDescription": f"{product['productDescription']} r{run}"} for product in products]
+
+
+def run(docs=128, repeat=5, encoder="hash"):
+    use_encoder(encoder)
+    from documentPreparation import model, prepareDocument, prepareDocuments, _encode
+    from vectorProfile import to_index_vector
+
+    products = generate_products(docs, seed=1)
+    descriptions = [product["productDescription"] for product in products]
+    model.encode(descriptions[:1])  # Load outside the timings
+
+    results = []
+    for batch_size in BATCH_SIZES:
+        results.append(measure(f"encode/batch={batch_size}", lambda: _encode(descriptions, batch_size=batch_size),
+                               repeat=repeat, items=docs))
+
+    results.append(measure("prepareDocument/cold", lambda: [prepareDocument(p) for p in _fresh(products)],
+                           repeat=repeat, items=docs))
+    warm = products[:]
+    prepareDocuments(warm)
+    results.append(measure("prepareDocument/warm", lambda: [prepareDocument(p) for p in warm],
+                           repeat=repeat, items=docs))
+    results.append(measure("prepareDocuments/cold", lambda: prepareDocuments(_fresh(products)),
+                           repeat=repeat, items=docs))
+    results.append(measure("prepareDocuments/warm", lambda: prepareDocuments(warm),
+                           repeat=repeat, items=docs))
+
+    documents = prepareDocuments(warm)
+    vectors = np.asarray(_encode(descriptions), dtype=np.float32)
+
+    def bulk_body():
+        lines = []
+        for product, document in zip(products, documents):
+            lines.append(json.dumps({"index": {"_index": "all_products", "_id": product["id"]}}))
+            lines.append(json.dumps(document))
+        return "\n".join(lines) + "\n"
+
+    results.append(measure("serialize/to_index_vector", lambda: [to_index_vector(v) for v in vectors],
+                           repeat=repeat, items=docs))
+    results.append(measure("serialize/json_document", lambda: [json.dumps(d) for d in documents],
+                           repeat=repeat, items=docs))
+    results.append(measure("serialize/bulk_ndjson", bulk_body, repeat=repeat, items=docs))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode, document preparation and serialization microbenchmarks")
+    parser.add_argument("--docs", type=int, default=128, help="Products per timed call")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--encoder", choices=["hash", "real"], default="hash")
+    parser.add_argument("--out", help="Write the results as JSON for benchmarks.compare")
+    args = parser.parse_args()
+
+    isolate_state()
+    results = run(args.docs, args.repeat, args.encoder)
+    print_table(results, ["name", "items", "items_per_second", "p50_ms", "p95_ms", "p99_ms"])
+    write_results(args.out, "micro", vars(args), results)
@@ -0,0 +1,135 @@
+"""
+Compare vector storage profiles (see vectorProfile.VECTOR_PROFILE) on a
+synthetic catalogue: recall@k against exact float32 768-dim search, estimated
+Elasticsearch vector memory and brute-force query latency.
+
+    python -m benchmarks.vectorStorage --docs 50000 --k 10
+    python -m benchmarks.vectorStorage --vectors embeddings.npy   # real model output
+
+Synthetic vectors concentrate variance in the leading dimensions the way
+Matryoshka-trained models do; pass --vectors with embeddings from the real
+model for numbers that reflect it. Recall is measured with exact search over
+the stored representation, so it isolates truncation/quantization loss from
+HNSW approximation.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from vectorProfile import parse_profile, to_index_vector
+
+DEFAULT_PROFILES = ["hnsw:768", "int8_hnsw:768", "int8_hnsw:256", "int8_hnsw:128",
+                    "int4_hnsw:256", "byte:256", "byte:128"]
+HNSW_M = 16  # Elasticsearch default graph degree
+
+
+def synthetic_catalogue(docs, queries, dims=768, clusters=200, seed=0):
+    rng = np.random.default_rng(seed)
+    scale = 1.0 / np.sqrt(1.0 + np.arange(dims) / 32.0)
+    centers = rng.normal(size=(clusters, dims)) * scale
+    corpus = centers[rng.integers(clusters, size=docs)] + 0.6 * rng.normal(size=(docs, dims)) * scale
+    picks = rng.integers(docs, size=queries)
+    probes = corpus[picks] + 0.3 * rng.normal(size=(queries, dims)) * scale
+    return corpus.astype(np.float32), probes.astype(np.float32)
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+# Elasticsearch-style scalar quantization: clip to a confidence interval and bucket
+def _scalar_quantize(vectors, bits):
+    low, high = np.quantile(vectors, [0.0005, 0.9995])
+    levels = 2 ** bits - 1
+    codes = np.rint((np.clip(vectors, low, high) - low) / (high - low) * levels)
+    return (codes / levels * (high - low) + low).astype(np.float32), codes.astype(np.int8 if bits <= 7 else np.uint8)
+
+
+def stored_vectors(vectors, profile):
+    if profile.index_type == "byte":
+        codes = np.array([to_index_vector(vector, profile) for vector in vectors], dtype=np.int8)
+        return codes.astype(np.float32), codes
+    truncated = _normalize(vectors[:, :profile.dims])
+    if profile.index_type.startswith("int8"):
+        return _scalar_quantize(truncated, 7)
+    if profile.index_type.startswith("int4"):
+        return _scalar_quantize(truncated, 4)
+    return truncated, truncated
+
+
+# Approximate off-heap bytes per Elasticsearch's dense_vector sizing guidance
+def estimated_memory(profile, docs):
+    dims = profile.dims
+    per_vector = {
+        "hnsw": 4 * dims, "flat": 4 * dims,
+        "int8_hnsw": dims + 4, "int8_flat": dims + 4,
+        "int4_hnsw": dims / 2 + 4,
+        "byte": dims,
+    }[profile.index_type]
+    graph = 0 if profile.index_type.endswith("flat") else 4 * HNSW_M
+    return int(docs * (per_vector + graph))
+
+
+def top_k(matrix, queries, k):
+    scores = queries @ matrix.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return top
+
+
+def run(profiles, corpus, probes, k):
+    truth = top_k(_normalize(corpus), _normalize(probes), k)
+    results = []
+    for name in profiles:
+        profile = parse_profile(name)
+        decoded, _ = stored_vectors(corpus, profile)
+        queries = np.array([to_index_vector(probe, profile) for probe in probes], dtype=np.float32)
+        if profile.index_type != "byte":
+            queries = _normalize(queries)
+
+        start = time.perf_counter()
+        found = top_k(decoded, queries, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(probes)
+
+        recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(probes))])
+        results.append({
+            "profile": name,
+            f"recall@{k}": round(float(recall), 4),
+            "memory_mb": round(estimated_memory(profile, len(corpus)) / 2 ** 20, 1),
+            "bytes_per_doc": round(estimated_memory(profile, len(corpus)) / len(corpus), 1),
+            "query_ms": round(latency_ms, 3),
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall/memory/latency of vector storage profiles")
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--vectors", help="Use these .npy embeddings (float32, N x 768) instead of synthetic ones")
+    parser.add_argument("--profiles", nargs="+", default=DEFAULT_PROFILES)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.vectors:
+        corpus = np.load(args.vectors).astype(np.float32)
+        rng = np.random.default_rng(0)
+        picks = corpus[rng.integers(len(corpus), size=args.queries)]
+        probes = picks + 0.05 * rng.normal(size=picks.shape).astype(np.float32) * np.abs(picks).mean()
+    else:
+        corpus, probes = synthetic_catalogue(args.docs, args.queries)
+
+    results = run(args.profiles, corpus, probes, args.k)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = list(results[0])
+    print("  ".join(f"{column:>16}" for column in columns))
+    for row in results:
+        print("  ".join(f"{str(row[column]):>16}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import logging
+import os
+import uuid
+
+from elasticsearch import helpers
+from documentPreparation import prepareDocuments, validateProduct
+from duplicateDetection import DuplicateProductError
+from indexGeneration import write_generation
+from indexMapping import PRODUCT_INDEX
+from localVectorIndex import local_index
+
+logger = logging.getLogger(__name__)
+
+# Bulk ingestion tuning
+BULK_MAX_PRODUCTS = int(os.getenv('BULK_MAX_PRODUCTS', '1000'))
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '500'))
+BULK_MAX_CHUNK_BYTES = int(os.getenv('BULK_MAX_CHUNK_BYTES', str(10 * 1024 * 1024)))
+
+
+# Function to pull the product list out of an /add_products request body
+def extract_products(payload):
+    if isinstance(payload, dict):
+        payload = payload.get("products")
+    if not isinstance(payload, list) or not payload:
+        raise ValueError("A non-empty list of products is required")
+    if len(payload) > BULK_MAX_PRODUCTS:
+        raise ValueError(f"At most {BULK_MAX_PRODUCTS} products can be added per request")
+    return payload
+
+
+# Function to pull {id: fields} out of an /update_products request body; repeated ids are merged in order
+def extract_updates(payload):
+    if isinstance(payload, dict):
+        payload = payload.get("updates")
+    if not isinstance(payload, list) or not payload:
+        raise ValueError("A non-empty list of updates is required")
+    if len(payload) > BULK_MAX_PRODUCTS:
+        raise ValueError(f"At most {BULK_MAX_PRODUCTS} products can be updated per request")
+    updates = {}
+    for position, update in enumerate(payload):
+        if not isinstance(update, dict) or not update.get("id") or not isinstance(update.get("fields"), dict):
+            raise ValueError(f"Update {position} needs an id and a fields object")
+        updates.setdefault(str(update["id"]), {}).update(update["fields"])
+    return updates
+
+
+# Function to index many products with one batched encode, chunked _bulk writes and one refresh;
+# with a DuplicateDetector, reposts are rejected, merged or indexed as variants
+def index_products(es, products, index=PRODUCT_INDEX, refresh=True, versions=None, duplicates=None):
+    results = [None] * len(products)
+    valid = []
+    ids = []
+    resolved = []
+    matched = {}
+    for position, product in enumerate(products):
+        error = validateProduct(product)
+        if error:
+            results[position] = {"index": position, "status": "failed", "error": error}
+            continue
+        product_id = str(product.get('id', uuid.uuid4()))
+        if duplicates is not None:
+            try:
+                product_id, product, matched[position] = duplicates.resolve(product_id, product)
+            except DuplicateProductError as e:
+                results[position] = {"index": position, "status": "failed", "error": str(e),
+                                     "duplicate_of": e.duplicate}
+                continue
+        valid.append(position)
+        ids.append(product_id)
+        resolved.append(product)
+
+    if valid:
+        docs = prepareDocuments(resolved)
+        actions = (
+            {"_index": index, "_id": product_id, "_source": doc}
+            for product_id, doc in zip(ids, docs)
+        )
+        responses = helpers.streaming_bulk(
+            es, actions,
+            chunk_size=BULK_CHUNK_SIZE,
+            max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+            raise_on_error=False,
+            raise_on_exception=False
+        )
+
+        indexed = []
+        local_docs = []
+        for position, product_id, doc, (ok, item) in zip(valid, ids, docs, responses):
+            if ok:
+                indexed.append(product_id)
+                if "DescriptionVector" in doc:
+                    local_docs.append((product_id, doc["DescriptionVector"], doc))
+                results[position] = {"index": position, "id": product_id, "status": "indexed"}
+                if matched.get(position):
+                    results[position]["duplicate_of"] = matched[position]
+            else:
+                error = item.get("index", {}).get("error", "Unknown bulk error")
+                results[position] = {"index": position, "id": product_id, "status": "failed", "error": str(error)}
+
+        if versions is not None:
+            versions.record_changes(indexed)  # A reindex replays these
+        if local_index is not None and local_docs:
+            local_index.upsert_many(local_docs)
+        if indexed and refresh:
+            es.indices.refresh(index=index)  # One refresh for the whole batch
+        if indexed:
+            write_generation.bump()
+        logger.info(f"Bulk indexed {len(indexed)} of {len(products)} products")
+
+    return results
@@ -0,0 +1,196 @@
+"""
+Reads of the whole catalogue, or of one seller's part of it, that do not
+depend on a query:
+
+    GET /export/products?userId=u1&category=phones&fields=productName,productPrice&format=csv
+    GET /sellers/<user_id>/products?size=20&cursor=...
+
+Both walk the product alias with a point in time and search_after on
+_shard_doc, so pages stay consistent while products are written (and across
+an alias cutover) and no page is read twice. The export streams one
+EXPORT_PAGE_SIZE page at a time as NDJSON lines or CSV rows; only that page
+is held in memory, however large the catalogue. DescriptionVector and
+dedupBands are left out of _source unless they are asked for by name.
+"""
+import base64
+import binascii
+import csv
+import io
+import json
+import logging
+import os
+
+from elasticsearch import NotFoundError
+
+from indexMapping import PRODUCT_INDEX, indexMapping
+
+logger = logging.getLogger(__name__)
+
+# Export and listing configuration
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '1000'))
+EXPORT_KEEP_ALIVE = os.getenv('EXPORT_KEEP_ALIVE', '1m')
+LISTING_DEFAULT_SIZE = int(os.getenv('LISTING_DEFAULT_SIZE', '20'))
+LISTING_MAX_SIZE = int(os.getenv('LISTING_MAX_SIZE', '100'))
+LISTING_KEEP_ALIVE = os.getenv('LISTING_KEEP_ALIVE', '5m')
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_FILTERS = ["userId", "category"]
+EXPORT_EXCLUDES = ["DescriptionVector", "dedupBands"]
+PRODUCT_FIELDS = list(indexMapping["mappings"]["properties"])
+DEFAULT_FIELDS = [field for field in PRODUCT_FIELDS if field not in EXPORT_EXCLUDES]
+
+
+# Function to validate the fields= parameter, a comma separated list of product fields
+def parse_fields(raw):
+    if not raw:
+        return None
+    fields = [field.strip() for field in raw.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in PRODUCT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}, expected some of {PRODUCT_FIELDS}")
+    return fields
+
+
+# Function to validate the query string of /export/products; filters may repeat
+# (category=a&category=b) or be comma separated
+def parse_export_request(args):
+    export_format = args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {list(EXPORT_FORMATS)}")
+    filters = {}
+    for field in EXPORT_FILTERS:
+        values = [value for raw in args.getlist(field) for value in raw.split(",") if value]
+        if values:
+            filters[field] = values
+    return {"format": export_format, "filters": filters, "fields": parse_fields(args.get("fields"))}
+
+
+def export_query(filters):
+    if not filters:
+        return {"match_all": {}}
+    return {"bool": {"filter": [{"terms": {field: values}} for field, values in filters.items()]}}
+
+
+def _source_filter(fields):
+    return {"includes": fields} if fields else {"excludes": EXPORT_EXCLUDES}
+
+
+# Function to page through every product matching a query in a point in time;
+# yields lists of hits and closes the point in time when done or abandoned
+def scan_pages(es, query, fields=None, index=PRODUCT_INDEX, page_size=EXPORT_PAGE_SIZE,
+               keep_alive=EXPORT_KEEP_ALIVE, pit=None):
+    if pit is None:
+        pit = es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    search_after = None
+    try:
+        while True:
+            res = es.search(pit={"id": pit, "keep_alive": keep_alive}, query=query, size=page_size,
+                            sort=["_shard_doc"], search_after=search_after, _source=_source_filter(fields),
+                            track_total_hits=False)
+            pit = res.get("pit_id", pit)
+            hits = res["hits"]["hits"]
+            if hits:
+                yield hits
+            if len(hits) < page_size:
+                return
+            search_after = hits[-1]["sort"]
+    finally:
+        try:
+            es.close_point_in_time(id=pit)
+        except Exception as e:
+            logger.warning(f"Could not close point in time: {e}")
+
+
+def _product(hit):
+    return {"id": hit["_id"], **hit.get("_source", {})}
+
+
+# Lists and objects (image urls, vectors) are written as JSON inside the cell
+def _cell(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+# Function to render pages of hits as NDJSON or CSV text, one chunk per page
+def export_chunks(pages, export_format="ndjson", fields=None):
+    if export_format == "csv":
+        columns = ["id"] + (fields or DEFAULT_FIELDS)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for hits in pages:
+            buffer.seek(0)
+            buffer.truncate()
+            for hit in hits:
+                product = _product(hit)
+                writer.writerow([_cell(product.get(column, "")) for column in columns])
+            yield buffer.getvalue()
+    else:
+        for hits in pages:
+            yield "".join(json.dumps(_product(hit), ensure_ascii=False) + "\n" for hit in hits)
+
+
+# Function to start the export for a parsed request; the point in time is opened
+# here, so an unreachable cluster fails the request before the response starts
+def export_products(es, params, index=PRODUCT_INDEX, page_size=EXPORT_PAGE_SIZE):
+    pit = es.open_point_in_time(index=index, keep_alive=EXPORT_KEEP_ALIVE)["id"]
+    pages = scan_pages(es, export_query(params["filters"]), params["fields"], index, page_size, pit=pit)
+    return _stream(export_chunks(pages, params["format"], params["fields"]), params)
+
+
+# A failure mid-export can only be logged and end the stream early
+def _stream(chunks, params):
+    try:
+        yield from chunks
+    except Exception as e:
+        logger.error(f"Catalogue export stopped early: {e}")
+        return
+    logger.info(f"Catalogue export finished ({params['format']}, filters {params['filters']})")
+
+
+# Listing cursors carry the point in time and the sort values of the last product
+def encode_listing_cursor(pit, sort):
+    return base64.urlsafe_b64encode(json.dumps({"pit": pit, "after": sort}).encode("utf-8")).decode("ascii")
+
+
+def decode_listing_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return state["pit"], state["after"]
+    except (ValueError, TypeError, KeyError, AttributeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+class ListingExpiredError(Exception):
+    pass
+
+
+# Function to return one page of a seller's products, variants included; the
+# response's cursor fetches the next page and is None after the last one
+def list_seller_products(es, user_id, size=LISTING_DEFAULT_SIZE, cursor=None, fields=None, index=PRODUCT_INDEX,
+                         keep_alive=LISTING_KEEP_ALIVE):
+    if cursor:
+        pit, search_after = decode_listing_cursor(cursor)
+    else:
+        pit, search_after = es.open_point_in_time(index=index, keep_alive=keep_alive)["id"], None
+    try:
+        res = es.search(pit={"id": pit, "keep_alive": keep_alive}, query={"term": {"userId": user_id}},
+                        size=size, sort=["_shard_doc"], search_after=search_after,
+                        _source=_source_filter(fields), track_total_hits=cursor is None)
+    except NotFoundError:
+        raise ListingExpiredError("The cursor has expired, list again from the first page")
+    pit = res.get("pit_id", pit)
+    hits = res["hits"]["hits"]
+    result = {"products": [_product(hit) for hit in hits], "cursor": None}
+    if cursor is None:
+        result["total"] = res["hits"]["total"]["value"]
+    if len(hits) == size:
+        result["cursor"] = encode_listing_cursor(pit, hits[-1]["sort"])
+    else:
+        try:
+            es.close_point_in_time(id=pit)
+        except Exception as e:
+            logger.warning(f"Could not close point in time: {e}")
+    return result
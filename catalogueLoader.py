@@ -0,0 +1,306 @@
+"""
+Stream a Firestore catalogue export (biashara.csv / output.csv layout) into
+Elasticsearch.
+
+    python catalogueLoader.py biashara.csv --workers 4
+    python catalogueLoader.py output.csv --bulk-out products.ndjson
+
+Rows are parsed one at a time, embedded in a process pool and written as _bulk
+chunks. Progress is checkpointed so an interrupted import resumes where it
+stopped; document ids are deterministic, so replayed rows overwrite instead of
+duplicating.
+
+Writes to Elasticsearch take the same path as /add_products (bulkIngest.py):
+each row's seller duplicate policy is applied before it is embedded (policies
+are read from Firestore with --firebase-credentials, else DEDUP_POLICY
+applies), written ids are recorded for a running reindex, and products are
+mirrored into the local vector index. --bulk-out files skip all three.
+
+Rows are indexed under their "id" column. Exports without one (such as
+biashara.csv) get a uuid5 of userId|timestamp|productName, which is not the
+Firestore document id: load those only into catalogues that the Firestore
+listener (databaseListerner.py) does not also sync, or the same post is
+indexed twice.
+"""
+import argparse
+import ast
+import csv
+import json
+import logging
+import os
+import sys
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from indexMapping import PRODUCT_INDEX
+
+logger = logging.getLogger(__name__)
+
+LIST_COLUMNS = ("imageUrls", "videoUrls")
+FLOAT_COLUMNS = ("productPrice",)
+
+
+# Function to parse a Python-literal list column such as "['https://...']"
+def parse_list(value):
+    if not value:
+        return []
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        logger.warning(f"Could not parse list column value: {value[:80]}")
+        return []
+    return [str(item) for item in parsed] if isinstance(parsed, (list, tuple)) else []
+
+
+# Function to turn a CSV row into a product payload
+def parse_row(row):
+    product = {key: value for key, value in row.items() if key is not None and value != ""}
+    for column in LIST_COLUMNS:
+        product[column] = parse_list(row.get(column))
+    for column in FLOAT_COLUMNS:
+        if column in product:
+            try:
+                product[column] = float(product[column])
+            except ValueError:
+                pass
+    return product
+
+
+# Stable id so re-running a row overwrites the same document
+def product_id(product):
+    if product.get("id"):
+        return str(product["id"])
+    key = "|".join(str(product.get(field, "")) for field in ("userId", "timestamp", "productName"))
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+
+# Generator yielding (row_number, product) from start_row onwards
+def read_rows(path, start_row=0):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row_number, row in enumerate(csv.DictReader(f)):
+            if row_number >= start_row:
+                yield row_number, parse_row(row)
+
+
+def read_chunks(path, chunk_size, start_row=0):
+    chunk = []
+    for item in read_rows(path, start_row):
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_checkpoint(path, source):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("source") != os.path.abspath(source):
+        logger.warning(f"Checkpoint {path} belongs to {state.get('source')}, starting from the beginning")
+        return 0
+    return state.get("rows_done", 0)
+
+
+def save_checkpoint(path, source, rows_done):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"source": os.path.abspath(source), "rows_done": rows_done}, f)
+    os.replace(tmp_path, path)
+
+
+def _init_worker(threads):
+    # One process per core; keep each one from spawning a full set of torch threads
+    import torch
+    torch.set_num_threads(threads)
+
+
+# Runs in a pool process: validate and embed one chunk of rows
+def prepare_chunk(chunk):
+    from documentPreparation import prepareDocuments, validateProduct
+
+    results = []
+    valid = []
+    for row_number, product in chunk:
+        error = validateProduct(product)
+        if error:
+            results.append((row_number, None, None, error))
+        else:
+            valid.append((row_number, product))
+
+    docs = prepareDocuments([product for _, product in valid])
+    for (row_number, product), doc in zip(valid, docs):
+        results.append((row_number, product_id(product), doc, None))
+    return results
+
+
+class ElasticsearchSink:
+    def __init__(self, url, index, db=None):
+        from elasticsearch import Elasticsearch
+        from duplicateDetection import DuplicateDetector
+        from indexVersions import ProductIndex
+        self.es = Elasticsearch(url)
+        self.index = index
+        self.versions = ProductIndex(self.es, index)
+        self.duplicates = DuplicateDetector(self.es, db, index)
+
+    # Applies the sellers' duplicate policies, as bulkIngest.index_products does;
+    # returns the chunk to embed and the (row_number, error) of rejected rows
+    def resolve(self, chunk):
+        from documentPreparation import validateProduct
+        from duplicateDetection import DuplicateProductError
+
+        resolved = []
+        rejected = []
+        for row_number, product in chunk:
+            if validateProduct(product):
+                resolved.append((row_number, product))  # Reported by prepare_chunk
+                continue
+            try:
+                doc_id, product, _ = self.duplicates.resolve(product_id(product), product)
+            except DuplicateProductError as e:
+                rejected.append((row_number, str(e)))
+                continue
+            resolved.append((row_number, {**product, "id": doc_id}))
+        return resolved, rejected
+
+    def write(self, docs):
+        from elasticsearch import helpers
+        from localVectorIndex import local_index
+        actions = ({"_index": self.index, "_id": doc_id, "_source": doc} for doc_id, doc in docs)
+        responses = helpers.streaming_bulk(self.es, actions, raise_on_error=False, raise_on_exception=False)
+        written = []
+        for (doc_id, doc), (ok, item) in zip(docs, responses):
+            if ok:
+                written.append((doc_id, doc))
+            else:
+                logger.error(f"Bulk indexing error: {item}")
+        self.versions.record_changes([doc_id for doc_id, _ in written])  # A reindex replays these
+        if local_index is not None:
+            local_index.upsert_many((doc_id, doc["DescriptionVector"], doc)
+                                    for doc_id, doc in written if "DescriptionVector" in doc)
+        return len(written)
+
+    def close(self):
+        from indexGeneration import write_generation
+        self.es.indices.refresh(index=self.index)
+        write_generation.bump()
+
+
+class NdjsonSink:
+    """Writes _bulk request bodies to a file, for curl or a later upload."""
+
+    def __init__(self, path, index, append):
+        self.f = open(path, "a" if append else "w", encoding="utf-8")
+        self.index = index
+
+    def resolve(self, chunk):
+        return chunk, []
+
+    def write(self, docs):
+        for doc_id, doc in docs:
+            self.f.write(json.dumps({"index": {"_index": self.index, "_id": doc_id}}) + "\n")
+            self.f.write(json.dumps(doc) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return len(docs)
+
+    def close(self):
+        self.f.close()
+
+
+def load(path, sink, workers, chunk_size, checkpoint_path, threads_per_worker=1):
+    start_row = load_checkpoint(checkpoint_path, path)
+    if start_row:
+        logger.info(f"Resuming {path} from row {start_row}")
+
+    # Chunks can finish out of order; the checkpoint only advances over a contiguous prefix
+    finished = {}
+    next_chunk_start = start_row
+    indexed = failed = 0
+    max_in_flight = workers * 2
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        in_flight = {}
+        chunks = read_chunks(path, chunk_size, start_row)
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_in_flight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                span = (chunk[0][0], chunk[-1][0] + 1)
+                chunk, rejected = sink.resolve(chunk)
+                for row_number, error in rejected:
+                    failed += 1
+                    logger.warning(f"Skipping row {row_number}: {error}")
+                in_flight[pool.submit(prepare_chunk, chunk)] = span
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                first_row, end_row = in_flight.pop(future)
+                results = future.result()
+                docs = [(doc_id, doc) for _, doc_id, doc, error in results if doc is not None]
+                for row_number, _, _, error in results:
+                    if error:
+                        failed += 1
+                        logger.warning(f"Skipping row {row_number}: {error}")
+                indexed += sink.write(docs)
+                finished[first_row] = end_row
+
+            while next_chunk_start in finished:
+                next_chunk_start = finished.pop(next_chunk_start)
+            save_checkpoint(checkpoint_path, path, next_chunk_start)
+            logger.info(f"Rows done: {next_chunk_start}, indexed: {indexed}, skipped: {failed}")
+
+    sink.close()
+    return indexed, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load a product CSV export into Elasticsearch")
+    parser.add_argument("csv_path")
+    parser.add_argument("--es-url", default=os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200'))
+    parser.add_argument("--index", default=PRODUCT_INDEX)
+    parser.add_argument("--bulk-out", help="Write _bulk NDJSON to this file instead of Elasticsearch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <csv_path>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="Ignore any existing checkpoint")
+    parser.add_argument("--firebase-credentials", default=os.getenv('FIREBASE_CREDENTIALS'),
+                        help="Read the sellers' duplicate policies from Firestore")
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint or f"{args.csv_path}.checkpoint"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    resuming = load_checkpoint(checkpoint_path, args.csv_path) > 0
+
+    if args.bulk_out:
+        sink = NdjsonSink(args.bulk_out, args.index, append=resuming)
+    else:
+        db = None
+        if args.firebase_credentials:
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+            firebase_admin.initialize_app(credentials.Certificate(args.firebase_credentials))
+            db = firestore.client()
+        sink = ElasticsearchSink(args.es_url, args.index, db)
+
+    indexed, failed = load(args.csv_path, sink, args.workers, args.chunk_size, checkpoint_path,
+                           args.threads_per_worker)
+    logger.info(f"Finished {args.csv_path}: {indexed} indexed, {failed} skipped")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,308 @@
+import asyncio
+import atexit
+import inspect
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+# Generation settings
+CHAT_MAX_NEW_TOKENS = int(os.getenv('CHAT_MAX_NEW_TOKENS', '64'))
+CHAT_MAX_CONTEXT_TOKENS = int(os.getenv('CHAT_MAX_CONTEXT_TOKENS', '512'))
+CHAT_DO_SAMPLE = os.getenv('CHAT_DO_SAMPLE', '0') == '1'
+CHAT_TEMPERATURE = float(os.getenv('CHAT_TEMPERATURE', '0.7'))
+CHAT_TOP_P = float(os.getenv('CHAT_TOP_P', '0.9'))
+CHAT_TOP_K = int(os.getenv('CHAT_TOP_K', '50'))
+CHAT_REPETITION_PENALTY = float(os.getenv('CHAT_REPETITION_PENALTY', '1.2'))
+
+# Batching and cache settings
+CHAT_BATCH_MAX_SIZE = int(os.getenv('CHAT_BATCH_MAX_SIZE', '8'))
+CHAT_BATCH_MAX_WAIT_MS = float(os.getenv('CHAT_BATCH_MAX_WAIT_MS', '20'))
+CHAT_MAX_CONVERSATIONS = int(os.getenv('CHAT_MAX_CONVERSATIONS', '10000'))
+CHAT_KV_CACHE_CONVERSATIONS = int(os.getenv('CHAT_KV_CACHE_CONVERSATIONS', '32'))
+
+_DONE = object()
+
+
+class ChatRequest:
+    """
+    One chat turn. Pieces of the reply are delivered through a thread queue,
+    or through an asyncio queue on the given event loop for async servers.
+    """
+
+    def __init__(self, conversation_id, user_id, message, loop=None):
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.message = message
+        self.received_at = datetime.utcnow()
+        self.reply = ""
+        self.error = None
+        self._loop = loop
+        self._deltas = asyncio.Queue() if loop is not None else queue.Queue()
+
+    # Called from the generation thread
+    def _put(self, item):
+        if self._loop is None:
+            self._deltas.put(item)
+        else:
+            try:
+                self._loop.call_soon_threadsafe(self._deltas.put_nowait, item)
+            except RuntimeError:
+                pass  # The event loop has shut down; nobody is waiting for this reply
+
+    # Generator of text pieces as they are decoded; raises if generation failed
+    def stream(self):
+        while True:
+            delta = self._deltas.get()
+            if delta is _DONE:
+                break
+            yield delta
+        if self.error:
+            raise RuntimeError(self.error)
+
+    def result(self):
+        for _ in self.stream():
+            pass
+        return self.reply
+
+    # Server-sent events: one "token" event per decoded piece, then "done"
+    def sse(self):
+        try:
+            for delta in self.stream():
+                yield f"data: {json.dumps({'token': delta})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'response': self.reply, 'chat_id': self.conversation_id})}\n\n"
+        except RuntimeError as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    # Async counterparts of stream(), result() and sse() for requests submitted with a loop
+    async def astream(self):
+        while True:
+            delta = await self._deltas.get()
+            if delta is _DONE:
+                break
+            yield delta
+        if self.error:
+            raise RuntimeError(self.error)
+
+    async def aresult(self):
+        async for _ in self.astream():
+            pass
+        return self.reply
+
+    async def asse(self):
+        try:
+            async for delta in self.astream():
+                yield f"data: {json.dumps({'token': delta})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'response': self.reply, 'chat_id': self.conversation_id})}\n\n"
+        except RuntimeError as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+
+class ChatEngine:
+    """
+    Batches concurrent chat turns into shared decoding steps and streams each
+    reply as it is produced. Every conversation keeps a bounded token window;
+    a conversation that runs on its own reuses its KV cache from the previous
+    turn instead of re-encoding the whole window. User/bot message pairs are
+    persisted in one Firestore batch on a background thread.
+    """
+
+    def __init__(self, model, tokenizer, db=None):
+        self.torch = None
+        self.model = model
+        self.tokenizer = tokenizer
+        self.db = db
+        self.pad_token_id = None
+        self._accepts_positions = False
+
+        self._queue = queue.Queue()
+        self._conversations = OrderedDict()   # conversation id -> token ids
+        self._kv_cache = OrderedDict()        # conversation id -> (tokens fed, past_key_values)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._persist = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-persist")
+        atexit.register(self._persist.shutdown, wait=True)
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="chat-engine", daemon=True)
+            self._thread.start()
+
+    # Pass the running event loop to consume the reply with astream()/aresult()/asse()
+    def submit(self, conversation_id, user_id, message, loop=None):
+        self._ensure_started()
+        request = ChatRequest(conversation_id, user_id, message, loop)
+        self._queue.put(request)
+        return request
+
+    # Deferred to the worker thread so lazily loaded models are only touched on first use
+    def _setup(self):
+        import torch
+
+        tokenizer = self.tokenizer
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self._accepts_positions = "position_ids" in inspect.signature(self.model.forward).parameters
+        self.torch = torch
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + CHAT_BATCH_MAX_WAIT_MS / 1000.0
+            while len(batch) < CHAT_BATCH_MAX_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                if self.torch is None:
+                    self._setup()
+                with self.torch.inference_mode(), stage("generate"):
+                    self._generate(batch)
+            except Exception as e:
+                logger.error(f"Chat generation failed: {e}")
+                for request in batch:
+                    if request.error is None:
+                        request.error = str(e)
+                    request._put(_DONE)
+
+    # Conversation history plus the new message, trimmed to leave room for the reply
+    def _context(self, request):
+        with self._lock:
+            history = self._conversations.get(request.conversation_id, [])
+        tokens = history + self.tokenizer.encode(request.message + self.tokenizer.eos_token)
+        return tokens[-max(1, CHAT_MAX_CONTEXT_TOKENS - CHAT_MAX_NEW_TOKENS):]
+
+    def _next_tokens(self, logits, seen):
+        torch = self.torch
+        if CHAT_REPETITION_PENALTY != 1.0:
+            scores = torch.gather(logits, 1, seen)
+            scores = torch.where(scores < 0, scores * CHAT_REPETITION_PENALTY, scores / CHAT_REPETITION_PENALTY)
+            logits = logits.scatter(1, seen, scores)
+        if not CHAT_DO_SAMPLE:
+            return torch.argmax(logits, dim=-1)
+
+        logits = logits / CHAT_TEMPERATURE
+        if CHAT_TOP_K > 0:
+            kth = torch.topk(logits, min(CHAT_TOP_K, logits.shape[-1])).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float("-inf"))
+        if CHAT_TOP_P < 1.0:
+            sorted_logits, order = torch.sort(logits, descending=True)
+            cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            drop = cumulative - torch.softmax(sorted_logits, dim=-1) > CHAT_TOP_P
+            logits = logits.masked_fill(drop.scatter(1, order, drop), float("-inf"))
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(1)
+
+    def _generate(self, batch):
+        torch = self.torch
+        contexts = [self._context(request) for request in batch]
+
+        # A lone conversation continues from its cached KV state when the window still lines up
+        past, fed = None, [[] for _ in batch]
+        if len(batch) == 1:
+            with self._lock:
+                cached = self._kv_cache.pop(batch[0].conversation_id, None)
+            if cached and len(cached[0]) < len(contexts[0]) and contexts[0][:len(cached[0])] == cached[0]:
+                fed[0], past = cached
+
+        pending = [context[len(done):] for context, done in zip(contexts, fed)]
+        width = max(len(tokens) for tokens in pending)
+        input_ids = torch.tensor([[self.pad_token_id] * (width - len(tokens)) + tokens for tokens in pending])
+        attention_mask = torch.tensor([[0] * (width - len(tokens)) + [1] * (len(fed[i]) + len(tokens))
+                                       for i, tokens in enumerate(pending)])
+        if past is not None:
+            attention_mask = torch.ones((1, len(contexts[0])), dtype=torch.long)
+        longest = max(len(context) for context in contexts)
+        seen = torch.tensor([[self.pad_token_id] * (longest - len(context)) + context for context in contexts])
+
+        generated = [[] for _ in batch]
+        decoded = ["" for _ in batch]
+        finished = [False] * len(batch)
+
+        for _ in range(CHAT_MAX_NEW_TOKENS):
+            kwargs = {"input_ids": input_ids, "attention_mask": attention_mask,
+                      "past_key_values": past, "use_cache": True}
+            if self._accepts_positions:
+                positions = attention_mask.long().cumsum(-1) - 1
+                kwargs["position_ids"] = positions.clamp(min=0)[:, -input_ids.shape[1]:]
+            output = self.model(**kwargs)
+            past = output.past_key_values
+
+            next_tokens = self._next_tokens(output.logits[:, -1, :], seen)
+            for i, request in enumerate(batch):
+                if finished[i]:
+                    next_tokens[i] = self.pad_token_id
+                    continue
+                token = int(next_tokens[i])
+                if token == self.tokenizer.eos_token_id:
+                    finished[i] = True
+                    continue
+                generated[i].append(token)
+                text = self.tokenizer.decode(generated[i], skip_special_tokens=True)
+                if len(text) > len(decoded[i]) and not text.endswith("�"):
+                    request._put(text[len(decoded[i]):])
+                    decoded[i] = text
+            if all(finished):
+                break
+
+            input_ids = next_tokens.unsqueeze(1)
+            attention_mask = torch.cat([attention_mask, torch.ones((len(batch), 1), dtype=attention_mask.dtype)], dim=1)
+            seen = torch.cat([seen, input_ids], dim=1)
+
+        for i, request in enumerate(batch):
+            request.reply = self.tokenizer.decode(generated[i], skip_special_tokens=True)
+            if len(request.reply) > len(decoded[i]):
+                request._put(request.reply[len(decoded[i]):])
+            history = contexts[i] + generated[i] + [self.tokenizer.eos_token_id]
+            with self._lock:
+                self._conversations[request.conversation_id] = history[-CHAT_MAX_CONTEXT_TOKENS:]
+                self._conversations.move_to_end(request.conversation_id)
+                while len(self._conversations) > CHAT_MAX_CONVERSATIONS:
+                    self._conversations.popitem(last=False)
+            request._put(_DONE)
+            self._persist.submit(self._save_turn, request, datetime.utcnow())
+
+        # Unless the reply ended on EOS, its last token has not been through the model yet
+        if len(batch) == 1:
+            fed_tokens = contexts[0] + (generated[0] if finished[0] else generated[0][:-1])
+            with self._lock:
+                self._kv_cache[batch[0].conversation_id] = (fed_tokens, past)
+                while len(self._kv_cache) > CHAT_KV_CACHE_CONVERSATIONS:
+                    self._kv_cache.popitem(last=False)
+
+    def _save_turn(self, request, replied_at):
+        if self.db is None:
+            return
+        try:
+            messages = self.db.collection('chats').document(request.conversation_id).collection('messages')
+            batch = self.db.batch()
+            batch.set(messages.document(), {
+                'sender_id': request.user_id,
+                'message': request.message,
+                'timestamp': request.received_at
+            })
+            batch.set(messages.document(), {
+                'sender_id': 'bot',
+                'message': request.reply,
+                'timestamp': replied_at
+            })
+            with stage("firestore.commit"):
+                batch.commit()
+        except Exception as e:
+            logger.error(f"Error saving chat turn for {request.conversation_id}: {e}")
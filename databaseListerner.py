@@ -1,32 +1,345 @@
+"""
+Keep the Elasticsearch product index in step with the Firestore `posts`
+collection. Snapshot changes are handed to an IndexingQueue, which coalesces
+repeated changes to a document, embeds descriptions in batches and applies
+upserts and deletes through _bulk. The read_time of the newest fully applied
+snapshot is checkpointed, so a restart skips documents that have not changed
+since.
+
+Created and edited posts go through the seller's duplicate policy first
+(see duplicateDetection.py): a rejected duplicate is not indexed, a merged
+one updates the product it duplicates (and its own stale document is
+deleted), and a variant is indexed with variantOf. Edited posts, and posts
+replayed by the initial snapshot, that are already indexed in their own
+right are not checked again. The check runs on its own thread, in change
+order, so the Firestore watch thread never waits on Elasticsearch.
+
+    python databaseListerner.py [--reset] [--reconcile-deletes]
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
 import firebase_admin
 from firebase_admin import credentials, firestore
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
+
+from documentPreparation import validateProduct
+from duplicateDetection import DuplicateDetector, DuplicateProductError
+from indexingQueue import IndexingQueue
+from indexMapping import PRODUCT_INDEX
+from indexVersions import ProductIndex, ensure_product_index
+
+logger = logging.getLogger(__name__)
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate('/home/chumvi/Development/firebase/biashara-app.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Load environment variables
+ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200')
+FIREBASE_CREDENTIALS = os.getenv('FIREBASE_CREDENTIALS', '/home/chumvi/Development/firebase/biashara-app.json')
 
-# Connect to Elasticsearch
-es = Elasticsearch("http://localhost:9200")
+# Sync configuration
+SYNC_COLLECTION = os.getenv('SYNC_COLLECTION', 'posts')
+SYNC_INDEX = os.getenv('SYNC_INDEX', PRODUCT_INDEX)
+SYNC_STATE_DIR = os.getenv(
+    'SYNC_STATE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'sync')
+)
+SYNC_MAX_RETRIES = int(os.getenv('SYNC_MAX_RETRIES', '5'))
+SYNC_RETRY_BACKOFF = float(os.getenv('SYNC_RETRY_BACKOFF', '2.0'))
+SYNC_METRICS_INTERVAL = float(os.getenv('SYNC_METRICS_INTERVAL', '30'))
 
-def on_firestore_update(doc_snapshot, changes, read_time):
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return datetime.fromisoformat(value)
+
+
+class CollectionSync:
     """
-    Cloud Function triggered when Firestore is updated.
+    Firestore change stream -> IndexingQueue with a persisted checkpoint.
+    Each snapshot's read_time becomes the checkpoint only once every change in
+    it, and in all earlier snapshots, has been written or given up on. Failed
+    writes are retried with backoff unless a newer change to the same document
+    has arrived in the meantime.
     """
-    for change in changes:
-        if change.type.name == 'ADDED' or change.type.name == 'MODIFIED':
-            # Get the document ID and data
-            doc_id = change.document.id
-            doc_data = change.document.to_dict()
-
-            # Index the updated data into Elasticsearch
-            try:
-                es.index(index="all_products", id=doc_id, body=doc_data)
-                print(f"Document with ID {doc_id} indexed successfully.")
-            except Exception as e:
-                print(f"Error indexing document {doc_id} into Elasticsearch: {e}")
-
-# Assign the Cloud Function to the Firestore trigger
-collection_ref = db.collection('posts')
-update_listener = collection_ref.on_snapshot(on_firestore_update)
+
+    def __init__(self, db, es, collection=SYNC_COLLECTION, index=SYNC_INDEX, state_dir=SYNC_STATE_DIR):
+        self.db = db
+        self.es = es
+        self.collection = collection
+        self.index = index
+        # Writes made during a reindex are recorded in its change log, as in the apps
+        self.versions = ProductIndex(es, index)
+        self.queue = IndexingQueue(es, index=index, versions=self.versions)
+        self.duplicates = DuplicateDetector(es, db, index)
+        # One thread keeps the duplicate checks, and so the queued writes, in change order
+        self._dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sync-dedup")
+        os.makedirs(state_dir, exist_ok=True)
+        self.checkpoint_path = os.path.join(state_dir, f"{collection}.checkpoint.json")
+        self.metrics_path = os.path.join(state_dir, f"{collection}.metrics.json")
+        self.checkpoint = self._load_checkpoint()
+
+        self._lock = threading.Lock()
+        self._snapshots = deque()   # [read_time, changes still in flight], oldest first
+        self._versions = {}         # doc id -> sequence of its newest queued change
+        self._sequence = 0
+        self._retries = []          # (due, change)
+        self._live_ids = None       # ids currently in the collection, for reconcile_deletes
+        self._initial_done = threading.Event()
+        self._watch = None
+
+        self.metrics = {
+            "changes_received": 0,
+            "skipped_unchanged": 0,
+            "invalid": 0,
+            "rejected_duplicates": 0,
+            "upserts": 0,
+            "deletes": 0,
+            "retries": 0,
+            "failed": 0,
+            "superseded": 0,
+        }
+        self._applied_since_report = 0
+        self._last_report = time.monotonic()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return _to_datetime(json.load(f)["read_time"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            logger.error(f"Ignoring unreadable checkpoint {self.checkpoint_path}: {e}")
+            return None
+
+    def _save_checkpoint(self, read_time):
+        with open(f"{self.checkpoint_path}.tmp", "w") as f:
+            json.dump({"read_time": read_time.isoformat(), "collection": self.collection}, f)
+        os.replace(f"{self.checkpoint_path}.tmp", self.checkpoint_path)
+        self.checkpoint = read_time
+
+    def reset(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.checkpoint = None
+
+    # Snapshot callback: runs on the Firestore watch thread, so it only queues work
+    def on_snapshot(self, doc_snapshot, changes, read_time):
+        initial = self._live_ids is None
+        if initial:
+            self._live_ids = set()
+
+        # The entry holds one extra count until every change in it has been queued
+        entry = [_to_datetime(read_time), 1]
+        with self._lock:
+            self._snapshots.append(entry)
+        for change in changes:
+            self.metrics["changes_received"] += 1
+            kind = change.type.name
+            document = change.document
+            if kind == "REMOVED":
+                self._live_ids.discard(document.id)
+            else:
+                self._live_ids.add(document.id)
+            if (kind != "REMOVED" and self.checkpoint is not None and document.update_time is not None
+                    and _to_datetime(document.update_time) <= self.checkpoint):
+                self.metrics["skipped_unchanged"] += 1
+                continue
+            data = document.to_dict() if kind != "REMOVED" else None
+            with self._lock:
+                self._sequence += 1
+                self._versions[document.id] = self._sequence
+                entry[1] += 1
+            self._dispatch({"id": document.id, "data": data, "snapshot": entry,
+                            "sequence": self._sequence, "attempts": 0,
+                            "indexed": initial or kind == "MODIFIED"})
+
+        with self._lock:
+            entry[1] -= 1
+        self._advance_checkpoint()
+        if initial:
+            self._initial_done.set()
+            logger.info(f"Initial snapshot of '{self.collection}': {len(changes)} documents, "
+                        f"{self.metrics['skipped_unchanged']} unchanged since checkpoint")
+
+    def _dispatch(self, change):
+        self._dispatcher.submit(self._enqueue, change)
+
+    def _enqueue(self, change):
+        try:
+            if change["data"] is None:
+                self.queue.enqueue_delete(change["id"], on_done=self._make_callback(change), timeout=None)
+            else:
+                product_id, product = change["id"], change["data"]
+                error = validateProduct(product)
+                if error:
+                    raise ValueError(error)
+                product_id, product, _ = self.duplicates.resolve(product_id, product, indexed=change["indexed"])
+                self.queue.enqueue_product(product_id, product, on_done=self._make_callback(change), timeout=None)
+                if product_id != change["id"] and change["indexed"]:
+                    # Merged into the product it duplicates; its own document is stale
+                    self.queue.enqueue_delete(change["id"], timeout=None)
+        except DuplicateProductError as e:
+            self.metrics["rejected_duplicates"] += 1
+            logger.info(f"Not indexing document {change['id']}: {e}")
+            self._complete(change)
+        except ValueError as e:
+            self.metrics["invalid"] += 1
+            logger.error(f"Skipping document {change['id']}: {e}")
+            self._complete(change)
+
+    def _make_callback(self, change):
+        def on_done(op, state, details):
+            if state != "failed":
+                self.metrics["deletes" if change["data"] is None else "upserts"] += 1
+                self._complete(change)
+            elif self._versions.get(change["id"]) != change["sequence"]:
+                self.metrics["superseded"] += 1
+                self._complete(change)
+            elif change["attempts"] < SYNC_MAX_RETRIES:
+                change["attempts"] += 1
+                self.metrics["retries"] += 1
+                due = time.monotonic() + SYNC_RETRY_BACKOFF ** change["attempts"]
+                with self._lock:
+                    self._retries.append((due, change))
+            else:
+                self.metrics["failed"] += 1
+                logger.error(f"Giving up on document {change['id']} after {change['attempts']} retries: "
+                             f"{details.get('error')}")
+                self._complete(change)
+        return on_done
+
+    def _complete(self, change):
+        with self._lock:
+            change["snapshot"][1] -= 1
+            if self._versions.get(change["id"]) == change["sequence"]:
+                del self._versions[change["id"]]
+            self._applied_since_report += 1
+
+    # Move the checkpoint past every leading snapshot that has nothing in flight
+    def _advance_checkpoint(self):
+        read_time = None
+        with self._lock:
+            while self._snapshots and self._snapshots[0][1] == 0:
+                read_time = self._snapshots.popleft()[0]
+        if read_time is not None and (self.checkpoint is None or read_time > self.checkpoint):
+            self._save_checkpoint(read_time)
+
+    def _retry_due(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [change for when, change in self._retries if when <= now]
+            self._retries = [(when, change) for when, change in self._retries if when > now]
+        for change in due:
+            if self._versions.get(change["id"]) != change["sequence"]:
+                self.metrics["superseded"] += 1
+                self._complete(change)
+            else:
+                self._dispatch(change)
+
+    # Deletes made while the listener was down never show up as REMOVED changes;
+    # drop indexed ids the collection no longer has. Only safe when the
+    # collection is the sole writer of the index.
+    def reconcile_deletes(self):
+        self._initial_done.wait()
+        stale = [hit["_id"] for hit in helpers.scan(self.es, index=self.index, _source=False,
+                                                   query={"query": {"match_all": {}}})
+                 if hit["_id"] not in self._live_ids]
+        for doc_id in stale:
+            self.queue.enqueue_delete(doc_id, timeout=None)
+        logger.info(f"Reconcile queued {len(stale)} deletes for documents no longer in '{self.collection}'")
+        return len(stale)
+
+    def report(self):
+        now = time.monotonic()
+        with self._lock:
+            applied, self._applied_since_report = self._applied_since_report, 0
+            oldest = self._snapshots[0][0] if self._snapshots else None
+            in_flight = sum(entry[1] for entry in self._snapshots)
+            retrying = len(self._retries)
+        elapsed = max(now - self._last_report, 1e-9)
+        self._last_report = now
+        wall_clock = datetime.now(timezone.utc)
+        metrics = {
+            **self.metrics,
+            "collection": self.collection,
+            "in_flight": in_flight,
+            "retrying": retrying,
+            "queue_depth": self.queue.pending(),
+            "lag_seconds": round((wall_clock - oldest).total_seconds(), 3) if oldest else 0.0,
+            "checkpoint": self.checkpoint.isoformat() if self.checkpoint else None,
+            "checkpoint_age_seconds": round((wall_clock - self.checkpoint).total_seconds(), 3) if self.checkpoint else None,
+            "throughput_per_second": round(applied / elapsed, 2),
+            "updated_at": wall_clock.isoformat(),
+        }
+        with open(f"{self.metrics_path}.tmp", "w") as f:
+            json.dump(metrics, f)
+        os.replace(f"{self.metrics_path}.tmp", self.metrics_path)
+        return metrics
+
+    def start(self):
+        self._watch = self.db.collection(self.collection).on_snapshot(self.on_snapshot)
+        logger.info(f"Listening to '{self.collection}' from checkpoint {self.checkpoint.isoformat() if self.checkpoint else 'none'}")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+        self._dispatcher.shutdown(wait=True)
+        self.queue.flush()
+        self._advance_checkpoint()
+        self.report()
+
+    def run_forever(self, tick=1.0):
+        self.start()
+        last_log = time.monotonic()
+        try:
+            while True:
+                time.sleep(tick)
+                self._retry_due()
+                self._advance_checkpoint()
+                if time.monotonic() - last_log >= SYNC_METRICS_INTERVAL:
+                    last_log = time.monotonic()
+                    metrics = self.report()
+                    logger.info(f"Sync lag {metrics['lag_seconds']}s, {metrics['throughput_per_second']} docs/s, "
+                                f"{metrics['in_flight']} in flight, {metrics['failed']} failed")
+        except KeyboardInterrupt:
+            logger.info("Stopping sync")
+        finally:
+            self.stop()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sync a Firestore collection into Elasticsearch")
+    parser.add_argument("--collection", default=SYNC_COLLECTION)
+    parser.add_argument("--index", default=SYNC_INDEX)
+    parser.add_argument("--reset", action="store_true", help="Forget the checkpoint and resync every document")
+    parser.add_argument("--reconcile-deletes", action="store_true",
+                        help="Delete indexed ids that are missing from the collection at startup")
+    args = parser.parse_args()
+
+    # Initialize Firebase Admin SDK
+    cred = credentials.Certificate(FIREBASE_CREDENTIALS)
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+
+    # Connect to Elasticsearch
+    es = Elasticsearch(ELASTICSEARCH_URL)
+    ensure_product_index(es, args.index)
+
+    sync = CollectionSync(db, es, collection=args.collection, index=args.index)
+    if args.reset:
+        sync.reset()
+    if args.reconcile_deletes:
+        threading.Thread(target=sync.reconcile_deletes, name="sync-reconcile", daemon=True).start()
+    sync.run_forever()
+
+
+if __name__ == "__main__":
+    main()
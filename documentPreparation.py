@@ -1,14 +1,96 @@
-from sentence_transformers import SentenceTransformer
+import os
 
-model = SentenceTransformer("all-mpnet-base-v2")
+from embeddingBackend import embedding_model_id, load_encoder
+from embeddingCache import EmbeddingCache
+from instrumentation import stage
+from modelRegistry import LazyModel, registry
+from textSignature import signature_bands
+from vectorProfile import to_index_vector
+
+MODEL_NAME = os.getenv('EMBEDDING_MODEL', "all-mpnet-base-v2")
+ENCODE_BATCH_SIZE = int(os.getenv('ENCODE_BATCH_SIZE', '32'))
+
+REQUIRED_FIELDS = ["productName", "productDescription", "currency", "userId", "productPrice"]
+OPTIONAL_FIELDS = ["color", "size", "brand", "category"]
+INDEXED_FIELDS = REQUIRED_FIELDS + OPTIONAL_FIELDS + ["imageUrls", "videoUrls"]
+
+# Optional: reach one shared embedding process over a local socket instead of loading the model here
+EMBEDDING_SIDECAR_SOCKET = os.getenv('EMBEDDING_SIDECAR_SOCKET')
+
+
+def _load_embedding_model():
+    if EMBEDDING_SIDECAR_SOCKET:
+        from embeddingSidecar import RemoteEncoder
+        return RemoteEncoder(EMBEDDING_SIDECAR_SOCKET)
+    return load_encoder(MODEL_NAME)  # EMBEDDING_BACKEND picks torch, torch-int8, onnx or onnx-int8
+
+
+# The model is loaded on first use (or preloaded before fork, see gunicorn.conf.py)
+registry.register("embedding", _load_embedding_model)
+model = LazyModel("embedding")
+
+# Repeated descriptions are served from the cache instead of being re-encoded
+embedding_cache = EmbeddingCache(embedding_model_id(MODEL_NAME))
+
+# Resolving model.encode at call time keeps cache hits from loading the model
+def _encode(texts, batch_size=ENCODE_BATCH_SIZE):
+    with stage("encode"):
+        return model.encode(texts, batch_size=batch_size)
+
+# Function to encode a product description, using the embedding cache
+def encodeDescription(description):
+    return embedding_cache.get_or_encode([description], _encode)[0]
+
+# Types of the fields that are embedded, hashed or indexed with a fixed mapping
+FIELD_TYPES = {"productName": str, "productDescription": str, "currency": str, "userId": str,
+               "productPrice": float, "imageUrls": list, "videoUrls": list}
+TYPE_NAMES = {str: "a string", float: "a number", list: "a list of strings"}
+
+def _has_type(value, expected):
+    if expected is float:
+        # Numeric strings are accepted, as Elasticsearch coerces them
+        try:
+            return not isinstance(value, bool) and float(value) == float(value)
+        except (TypeError, ValueError):
+            return False
+    if expected is list:
+        return isinstance(value, list) and all(isinstance(item, str) for item in value)
+    return isinstance(value, expected)
+
+# Function to check the types of the product fields present, returns an error message or None
+def validateFields(fields):
+    for field, expected in FIELD_TYPES.items():
+        if field in fields and not _has_type(fields[field], expected):
+            return f"{field} must be {TYPE_NAMES[expected]}"
+    return None
+
+# Function to check a product payload, returns an error message or None
+def validateProduct(product):
+    if not isinstance(product, dict) or not product:
+        return "No product data provided"
+    for field in REQUIRED_FIELDS:
+        if field not in product:
+            return f"{field} is required"
+    return validateFields(product)
 
 # Function to prepare document
 def prepareDocument(product):
-    description_vector = model.encode(product["productDescription"]).tolist()
+    return buildDocument(product, encodeDescription(product["productDescription"]))
+
+# Function to prepare many documents with a single batched encode
+def prepareDocuments(products, batch_size=ENCODE_BATCH_SIZE):
+    descriptions = [product["productDescription"] for product in products]
+    vectors = embedding_cache.get_or_encode(descriptions, _encode, batch_size=batch_size)
+    return [buildDocument(product, vector) for product, vector in zip(products, vectors)]
+
+# Function to build the Elasticsearch document from a product and its description vector.
+# Variants of another product (see duplicateDetection.py) are stored without a vector
+def buildDocument(product, description_vector):
     document = {
         "productName": product["productName"],
         "productDescription": product["productDescription"],
-        "DescriptionVector": description_vector,
+        "DescriptionVector": to_index_vector(description_vector),
+        "dedupBands": signature_bands(product["productDescription"]),
         "currency": product["currency"],
         "imageUrls": product.get("imageUrls", []),
         "videoUrls": product.get("videoUrls", []),
@@ -17,13 +99,25 @@ def prepareDocument(product):
     }
 
     # Add optional fields if they are present
-    if "color" in product:
-        document["color"] = product["color"]
-    if "size" in product:
-        document["size"] = product["size"]
-    if "brand" in product:
-        document["brand"] = product["brand"]
-    if "category" in product:
-        document["category"] = product["category"]
+    for field in OPTIONAL_FIELDS:
+        if field in product:
+            document[field] = product[field]
+
+    if product.get("variantOf"):
+        document["variantOf"] = product["variantOf"]
+        del document["DescriptionVector"]
 
     return document
+
+# Function to build partial documents for the _update API from changed fields only;
+# descriptions are re-encoded (in one batch) only for the updates that change them
+def preparePartialDocuments(updates, batch_size=ENCODE_BATCH_SIZE):
+    documents = [{field: fields[field] for field in INDEXED_FIELDS if field in fields} for fields in updates]
+    changed = [document for document in documents if "productDescription" in document]
+    if changed:
+        vectors = embedding_cache.get_or_encode([document["productDescription"] for document in changed],
+                                                _encode, batch_size=batch_size)
+        for document, vector in zip(changed, vectors):
+            document["DescriptionVector"] = to_index_vector(vector)
+            document["dedupBands"] = signature_bands(document["productDescription"])
+    return documents
@@ -0,0 +1,370 @@
+"""
+Near-duplicate detection for products a seller posts again.
+
+Every indexed description carries the LSH band keys of its MinHash signature
+(dedupBands, see textSignature.py), so the candidates for a new post are one
+terms query shared by all workers. A candidate is a duplicate when its text
+is identical after normalization, or when the estimated Jaccard similarity
+of the word shingles reaches DEDUP_JACCARD_THRESHOLD and the cosine
+similarity of the description embeddings reaches DEDUP_COSINE_THRESHOLD.
+Posts by different sellers are never duplicates of each other, and when
+several indexed products match, the one with the smallest id is the
+canonical, so the choice does not depend on search ranking.
+
+What happens to a duplicate is the seller's policy, read from Firestore
+(dedupPolicies/{userId}, field "policy") with DEDUP_POLICY (default off) for
+sellers without one:
+
+    reject   the post is refused
+    merge    the post updates the product it duplicates, keeping that id
+    variant  the post is indexed with variantOf set and no vector, so it
+             takes no space in the kNN graph and no result slot
+    off      no check
+
+The same rules can be applied to the products already indexed. Without
+--delete the scan only marks variants and backfills dedupBands; duplicates
+under "reject" or "merge" are reported but stay live:
+
+    python duplicateDetection.py --dry-run     # report the duplicate rate only
+    python duplicateDetection.py               # mark variants, report the rest
+    python duplicateDetection.py --delete      # also delete rejected and merged duplicates
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from elasticsearch import helpers
+
+from documentPreparation import INDEXED_FIELDS, encodeDescription
+from indexGeneration import write_generation
+from indexMapping import PRODUCT_INDEX
+from localVectorIndex import local_index
+from instrumentation import stage
+from textSignature import band_keys, estimated_jaccard, minhash, normalize_text
+from vectorProfile import to_index_vector
+
+logger = logging.getLogger(__name__)
+
+# Duplicate detection configuration
+DEDUP_POLICY = os.getenv('DEDUP_POLICY', 'off')
+DEDUP_JACCARD_THRESHOLD = float(os.getenv('DEDUP_JACCARD_THRESHOLD', '0.8'))
+DEDUP_COSINE_THRESHOLD = float(os.getenv('DEDUP_COSINE_THRESHOLD', '0.95'))
+DEDUP_CANDIDATES = int(os.getenv('DEDUP_CANDIDATES', '10'))
+DEDUP_POLICY_CACHE_TTL = float(os.getenv('DEDUP_POLICY_CACHE_TTL', '300'))
+DEDUP_BATCH_SIZE = int(os.getenv('DEDUP_BATCH_SIZE', '500'))
+POLICY_COLLECTION = 'dedupPolicies'
+
+POLICIES = ("off", "reject", "merge", "variant")
+
+
+class DuplicateProductError(Exception):
+    def __init__(self, duplicate):
+        self.duplicate = duplicate
+        super().__init__(f"Product duplicates {duplicate['id']}")
+
+
+def _cosine(vector, other):
+    other = np.asarray(other, dtype=np.float32)
+    return float(vector @ other / max(float(np.linalg.norm(vector) * np.linalg.norm(other)), 1e-12))
+
+
+# Function to fold a repeated post into the product it duplicates: the post's
+# fields win, image and video lists are combined
+def merge_products(existing, product):
+    merged = {field: existing[field] for field in INDEXED_FIELDS if field in existing}
+    merged.update({field: value for field, value in product.items() if field != "id"})
+    for field in ("imageUrls", "videoUrls"):
+        merged[field] = list(dict.fromkeys(list(existing.get(field, [])) + list(product.get(field, []))))
+    return merged
+
+
+class DuplicateDetector:
+    """
+    Ingest-time duplicate check with per-seller policies (cached for
+    DEDUP_POLICY_CACHE_TTL seconds) and duplicate-rate counters.
+    """
+
+    def __init__(self, es, db=None, index=PRODUCT_INDEX, default_policy=DEDUP_POLICY,
+                 jaccard_threshold=DEDUP_JACCARD_THRESHOLD, cosine_threshold=DEDUP_COSINE_THRESHOLD,
+                 capacity=10000):
+        if default_policy not in POLICIES:
+            raise ValueError(f"Unknown DEDUP_POLICY '{default_policy}', expected one of {POLICIES}")
+        self.es = es
+        self.db = db
+        self.index = index
+        self.default_policy = default_policy
+        self.jaccard_threshold = jaccard_threshold
+        self.cosine_threshold = cosine_threshold
+        self.capacity = capacity
+        self._policies = OrderedDict()  # user id -> (policy, expires at)
+        self._counts = {"checked": 0, "duplicates": 0, "exact": 0, "rejected": 0, "merged": 0, "variants": 0}
+        self._lock = threading.Lock()
+
+    def policy(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._policies.get(user_id)
+            if cached and cached[1] > now:
+                return cached[0]
+
+        policy = self.default_policy
+        if self.db is not None:
+            try:
+                with stage("firestore.get"):
+                    snapshot = self.db.collection(POLICY_COLLECTION).document(user_id).get()
+                if snapshot.exists:
+                    value = (snapshot.to_dict() or {}).get("policy")
+                    if value in POLICIES:
+                        policy = value
+                    else:
+                        logger.warning(f"Ignoring unknown duplicate policy '{value}' for user {user_id}")
+            except Exception as e:
+                logger.error(f"Error reading duplicate policy for user {user_id}: {e}")
+
+        with self._lock:
+            self._policies[user_id] = (policy, now + DEDUP_POLICY_CACHE_TTL)
+            self._policies.move_to_end(user_id)
+            while len(self._policies) > self.capacity:
+                self._policies.popitem(last=False)
+        return policy
+
+    # Returns the matching product of the same seller with the smallest id as
+    # {"id", "source", "jaccard", "cosine", "exact"}, or None; exclude_id is the
+    # product's own id when it may already be indexed
+    def find(self, product, exclude_id=None):
+        description = product["productDescription"]
+        signature = minhash(description)
+        query = {"bool": {
+            "filter": [{"term": {"userId": product["userId"]}},
+                       {"terms": {"dedupBands": band_keys(signature)}}],
+            "must_not": [{"exists": {"field": "variantOf"}}],
+        }}
+        with stage("dedup.candidates"):
+            hits = self.es.search(index=self.index, query=query, size=DEDUP_CANDIDATES,
+                                  _source_excludes=["dedupBands"])["hits"]["hits"]
+
+        words = normalize_text(description)
+        vector = None
+        for hit in sorted(hits, key=lambda hit: hit["_id"]):
+            if hit["_id"] == exclude_id:
+                continue
+            source = hit["_source"]
+            if normalize_text(source.get("productDescription")) == words:
+                return {"id": hit["_id"], "source": source, "jaccard": 1.0, "cosine": 1.0, "exact": True}
+            jaccard = estimated_jaccard(signature, minhash(source.get("productDescription", "")))
+            if jaccard < self.jaccard_threshold or "DescriptionVector" not in source:
+                continue
+            if vector is None:
+                # Cached, so the indexing queue does not encode the description again
+                vector = np.asarray(to_index_vector(encodeDescription(description)), dtype=np.float32)
+            cosine = _cosine(vector, source["DescriptionVector"])
+            if cosine >= self.cosine_threshold:
+                return {"id": hit["_id"], "source": source, "jaccard": jaccard, "cosine": cosine, "exact": False}
+        return None
+
+    # Whether the product is indexed in its own right, i.e. found and not a variant
+    def _indexed_canonical(self, product_id):
+        with stage("dedup.candidates"):
+            doc = self.es.mget(index=self.index, ids=[product_id], _source_includes=["variantOf"])["docs"][0]
+        return doc.get("found", False) and "variantOf" not in doc.get("_source", {})
+
+    def _count(self, *names):
+        with self._lock:
+            for name in names:
+                self._counts[name] += 1
+
+    # Returns the id and product to index for a post, and the duplicate it
+    # matched (None for a new product); raises DuplicateProductError under
+    # "reject". With indexed, the post may already be in the index (an edit, or
+    # a document replayed by a snapshot): a product indexed in its own right
+    # keeps its place, so indexed copies never become variants of each other
+    def resolve(self, product_id, product, indexed=False):
+        policy = self.policy(product["userId"])
+        if policy == "off":
+            return product_id, product, None
+        try:
+            if indexed and self._indexed_canonical(product_id):
+                return product_id, product, None
+            match = self.find(product, exclude_id=product_id)
+        except Exception as e:
+            logger.error(f"Duplicate check failed, indexing the product as new: {e}")
+            return product_id, product, None
+        if match is None:
+            self._count("checked")
+            return product_id, product, None
+
+        duplicate = {"id": match["id"], "policy": policy, "exact": match["exact"],
+                     "jaccard": round(match["jaccard"], 4), "cosine": round(match["cosine"], 4)}
+        outcome = {"reject": "rejected", "merge": "merged", "variant": "variants"}[policy]
+        self._count("checked", "duplicates", outcome, *(("exact",) if match["exact"] else ()))
+        logger.info(f"Product of user {product['userId']} duplicates {match['id']} ({policy})")
+        if policy == "reject":
+            raise DuplicateProductError(duplicate)
+        if policy == "merge":
+            return match["id"], merge_products(match["source"], product), duplicate
+        return product_id, {**product, "variantOf": match["id"]}, duplicate
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        counts["duplicate_rate"] = counts["duplicates"] / counts["checked"] if counts["checked"] else 0.0
+        return counts
+
+
+def _sellers(es, index):
+    after = None
+    while True:
+        composite = {"size": DEDUP_BATCH_SIZE, "sources": [{"userId": {"terms": {"field": "userId"}}}]}
+        if after:
+            composite["after"] = after
+        res = es.search(index=index, size=0, aggs={"sellers": {"composite": composite}})
+        sellers = res["aggregations"]["sellers"]
+        for bucket in sellers["buckets"]:
+            yield bucket["key"]["userId"]
+        after = sellers.get("after_key")
+        if not sellers["buckets"] or not after:
+            return
+
+
+# Mirrors deduplication writes into the local vector index: variants and
+# deleted duplicates leave it, merged media lists are copied
+def _apply_local(local, actions):
+    for action in actions:
+        if action.get("_op_type") == "delete" or "_source" in action:
+            if local.get(action["_id"]) is not None:
+                local.delete(action["_id"])
+        elif "imageUrls" in action.get("doc", {}):
+            local.update(action["_id"], action["doc"])
+
+
+# Function to apply the duplicate policies to the products already indexed, one
+# seller at a time; returns the report, and only reports with dry_run. Products
+# are deleted (under "reject" and "merge") only with delete
+def deduplicate_index(es, detector, index=PRODUCT_INDEX, dry_run=False, versions=None, delete=False,
+                      local=local_index):
+    report = {"sellers": 0, "products": 0, "duplicates": 0, "exact": 0,
+              "rejected": 0, "merged": 0, "variants": 0, "kept": 0, "backfilled": 0}
+    actions = []
+
+    def flush():
+        if actions and not dry_run:
+            _, errors = helpers.bulk(es, actions, raise_on_error=False, raise_on_exception=False)
+            if errors:
+                logger.error(f"{len(errors)} deduplication writes failed: {errors[0]}")
+            failed = {next(iter(error.values())).get("_id") for error in errors}
+            written = [action for action in actions if action["_id"] not in failed]
+            if versions is not None:
+                versions.record_changes([action["_id"] for action in written])
+            if local is not None:
+                _apply_local(local, written)
+            if written:
+                write_generation.bump()
+        actions.clear()
+
+    vectors = {}
+
+    def vector(doc_id):
+        if doc_id not in vectors:
+            doc = es.get(index=index, id=doc_id, _source_includes=["DescriptionVector"])
+            vectors[doc_id] = doc["_source"].get("DescriptionVector") if doc.get("found") else None
+        return vectors[doc_id]
+
+    for user_id in _sellers(es, index):
+        report["sellers"] += 1
+        policy = detector.policy(user_id)
+        canonical = []
+        buckets = {}
+        vectors.clear()
+        query = {"query": {"bool": {"filter": [{"term": {"userId": user_id}}],
+                                    "must_not": [{"exists": {"field": "variantOf"}}]}}}
+        for hit in helpers.scan(es, index=index, query=query, _source_excludes=["DescriptionVector"]):
+            report["products"] += 1
+            source = hit["_source"]
+            signature = minhash(source.get("productDescription", ""))
+            keys = band_keys(signature)
+            words = normalize_text(source.get("productDescription"))
+
+            match = None
+            if policy != "off":
+                for position in sorted({position for key in keys for position in buckets.get(key, [])}):
+                    candidate = canonical[position]
+                    if candidate["words"] == words:
+                        match = candidate
+                        report["exact"] += 1
+                        break
+                    if estimated_jaccard(signature, candidate["signature"]) < detector.jaccard_threshold:
+                        continue
+                    first, second = vector(hit["_id"]), vector(candidate["id"])
+                    if first is not None and second is not None and \
+                            _cosine(np.asarray(first, dtype=np.float32), second) >= detector.cosine_threshold:
+                        match = candidate
+                        break
+
+            if match is None:
+                for key in keys:
+                    buckets.setdefault(key, []).append(len(canonical))
+                canonical.append({"id": hit["_id"], "signature": signature, "words": words, "source": source})
+                if source.get("dedupBands") != keys:
+                    report["backfilled"] += 1
+                    actions.append({"_op_type": "update", "_index": index, "_id": hit["_id"],
+                                    "doc": {"dedupBands": keys}})
+            else:
+                report["duplicates"] += 1
+                if policy in ("reject", "merge") and not delete:
+                    report["kept"] += 1  # Reported only: deleting a live product needs --delete
+                elif policy == "reject":
+                    report["rejected"] += 1
+                    actions.append({"_op_type": "delete", "_index": index, "_id": hit["_id"]})
+                elif policy == "merge":
+                    # Only the media lists are combined; without post times neither price is newer
+                    report["merged"] += 1
+                    merged = merge_products(match["source"], {field: source.get(field, [])
+                                                              for field in ("imageUrls", "videoUrls")})
+                    match["source"] = {**match["source"], **merged}
+                    actions.append({"_op_type": "update", "_index": index, "_id": match["id"],
+                                    "doc": {"imageUrls": merged["imageUrls"], "videoUrls": merged["videoUrls"]}})
+                    actions.append({"_op_type": "delete", "_index": index, "_id": hit["_id"]})
+                else:
+                    report["variants"] += 1
+                    actions.append({"_index": index, "_id": hit["_id"],
+                                    "_source": {**source, "dedupBands": keys, "variantOf": match["id"]}})
+            if len(actions) >= DEDUP_BATCH_SIZE:
+                flush()
+        flush()
+
+    report["duplicate_rate"] = report["duplicates"] / report["products"] if report["products"] else 0.0
+    logger.info(f"Deduplication {'report' if dry_run else 'done'}: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Find and resolve duplicate products in the index")
+    parser.add_argument("--es-url", default=os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200'))
+    parser.add_argument("--index", default=PRODUCT_INDEX)
+    parser.add_argument("--policy", choices=POLICIES, default=DEDUP_POLICY,
+                        help="Policy for sellers without one in Firestore")
+    parser.add_argument("--firebase-credentials", default=os.getenv('FIREBASE_CREDENTIALS'),
+                        help="Read per-seller policies from Firestore")
+    parser.add_argument("--dry-run", action="store_true", help="Only report duplicates")
+    parser.add_argument("--delete", action="store_true",
+                        help="Delete duplicates of sellers whose policy is reject or merge")
+    args = parser.parse_args()
+
+    from elasticsearch import Elasticsearch
+    from indexVersions import ProductIndex
+    es = Elasticsearch(args.es_url)
+    db = None
+    if args.firebase_credentials:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        firebase_admin.initialize_app(credentials.Certificate(args.firebase_credentials))
+        db = firestore.client()
+    detector = DuplicateDetector(es, db, args.index, args.policy)
+    report = deduplicate_index(es, detector, args.index, args.dry_run, ProductIndex(es, args.index), args.delete)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,259 @@
+"""
+CPU inference backends for the sentence embedding model, all behind the
+SentenceTransformer encode() interface:
+
+    torch       SentenceTransformer, fp32 eager (the reference)
+    torch-int8  the same with Linear layers dynamically quantized to int8
+    onnx        ONNX Runtime on an export of the transformer with pooling and
+                normalization inside the graph
+    onnx-int8   that export with int8 dynamically quantized weights
+
+Exports are built once per model and cached under EMBEDDING_ONNX_DIR. Each
+quantized or exported backend is checked against the fp32 reference when it
+is first built; if the cosine similarity on the probe sentences drops below
+EMBEDDING_PARITY_THRESHOLD the backend is refused and torch is used instead.
+
+    python embeddingBackend.py --backend onnx-int8      # build and check an export
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# Intra-op threads per process for torch or ONNX Runtime (0 = runtime default)
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', '0'))
+EMBEDDING_ONNX_DIR = os.getenv(
+    'EMBEDDING_ONNX_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'onnx')
+)
+EMBEDDING_PARITY_THRESHOLD = float(os.getenv('EMBEDDING_PARITY_THRESHOLD', '0.99'))
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+# Mixed lengths and languages, as in the catalogue
+PARITY_PROBES = [
+    "This is the best rice",
+    "Samsung Galaxy A14 4GB RAM 64GB storage, dual sim, original with warranty",
+    "Viatu vya ngozi vya kiume, size 40 hadi 44, rangi nyeusi na kahawia",
+    "Used HP EliteBook 840 G3 laptop core i5 8GB RAM 256GB SSD, battery lasts four hours, charger included",
+    "Unga wa mahindi",
+    "Brand new sofa set 5 seater, free delivery within Dar es Salaam",
+    "Blender 1.5 litres",
+    "Wireless bluetooth headphones with noise cancellation and a long lasting battery for travel and work " * 3,
+]
+
+
+def _load_reference(model_name):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device="cpu")
+
+
+def _set_torch_threads(threads):
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+
+# Function to compare a backend with the fp32 reference on the same sentences
+def check_parity(candidate, reference, texts=PARITY_PROBES, threshold=EMBEDDING_PARITY_THRESHOLD):
+    return parity_report(reference.encode(texts), candidate.encode(texts), threshold)
+
+
+def parity_report(expected, actual, threshold=EMBEDDING_PARITY_THRESHOLD):
+    expected = np.asarray(expected, dtype=np.float32)
+    actual = np.asarray(actual, dtype=np.float32)
+    expected /= np.maximum(np.linalg.norm(expected, axis=1, keepdims=True), 1e-12)
+    actual /= np.maximum(np.linalg.norm(actual, axis=1, keepdims=True), 1e-12)
+    cosines = (expected * actual).sum(axis=1)
+    return {
+        "min_cosine": round(float(cosines.min()), 6),
+        "mean_cosine": round(float(cosines.mean()), 6),
+        "threshold": threshold,
+        "passed": bool(cosines.min() >= threshold),
+    }
+
+
+# Function to group texts of similar token length into batches, so each batch is
+# padded only to its own longest text; returns lists of positions
+def length_buckets(lengths, batch_size):
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+class OnnxEncoder:
+    """encode() over an ONNX Runtime session of a cached export (see export_onnx)."""
+
+    def __init__(self, directory, threads=EMBEDDING_THREADS, quantized=False):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(directory, "export.json")) as f:
+            self.meta = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+        self.max_length = self.meta["max_seq_length"]
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        path = os.path.join(directory, "model.int8.onnx" if quantized else "model.onnx")
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def get_sentence_embedding_dimension(self):
+        return self.meta["dims"]
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors = np.zeros((len(texts), self.meta["dims"]), dtype=np.float32)
+        if texts:
+            encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)["input_ids"]
+            for positions in length_buckets([len(ids) for ids in encoded], batch_size):
+                batch = self.tokenizer.pad({"input_ids": [encoded[i] for i in positions]}, return_tensors="np")
+                outputs = self.session.run(None, {
+                    "input_ids": batch["input_ids"].astype(np.int64),
+                    "attention_mask": batch["attention_mask"].astype(np.int64),
+                })
+                vectors[positions] = outputs[0]
+        return vectors[0] if single else vectors
+
+
+def _pooling_mode(pooling):
+    mode = getattr(pooling, "pooling_mode", None)
+    if mode is None and hasattr(pooling, "get_pooling_mode_str"):
+        mode = pooling.get_pooling_mode_str()
+    return mode
+
+
+def _export_dir(model_name, directory):
+    return os.path.join(directory, model_name.strip("/").replace("/", "__"))
+
+
+# Export the transformer with pooling and normalization in the graph, then an int8
+# copy, and record parity of both with the reference; reused on later loads
+def export_onnx(model_name, directory=EMBEDDING_ONNX_DIR, reference=None):
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    target = _export_dir(model_name, directory)
+    meta_path = os.path.join(target, "export.json")
+    if os.path.exists(meta_path):
+        return target
+
+    reference = reference or _load_reference(model_name)
+    modules = list(reference)
+    transformer = modules[0]
+    mode = _pooling_mode(modules[1]) if len(modules) > 1 else None
+    if mode not in ("mean", "cls"):
+        raise ValueError(f"Cannot export pooling mode '{mode}' of {model_name}, expected mean or cls")
+    normalize = any(type(module).__name__ == "Normalize" for module in modules)
+
+    class Pooled(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            tokens = self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+            if mode == "cls":
+                pooled = tokens[:, 0]
+            else:
+                mask = attention_mask.unsqueeze(-1).to(tokens.dtype)
+                pooled = (tokens * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+            return torch.nn.functional.normalize(pooled, dim=-1) if normalize else pooled
+
+    os.makedirs(target, exist_ok=True)
+    sample = transformer.tokenizer(["export sample", "a longer export sample sentence"], padding=True,
+                                   return_tensors="pt")
+    model_path = os.path.join(target, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            Pooled(transformer.auto_model.eval()), (sample["input_ids"], sample["attention_mask"]), model_path,
+            input_names=["input_ids", "attention_mask"], output_names=["embedding"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                          "embedding": {0: "batch"}},
+            opset_version=17, dynamo=False,
+        )
+    quantize_dynamic(model_path, os.path.join(target, "model.int8.onnx"), weight_type=QuantType.QInt8)
+    transformer.tokenizer.save_pretrained(target)
+
+    meta = {"model": model_name, "max_seq_length": reference.max_seq_length,
+            "dims": int(np.asarray(reference.encode(["dims"])).shape[1]), "pooling": mode, "normalize": normalize}
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+    meta["parity"] = {backend: check_parity(OnnxEncoder(target, quantized=backend == "onnx-int8"), reference)
+                      for backend in ("onnx", "onnx-int8")}
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+    return target
+
+
+# Quantizes the model's Linear layers in place
+def _quantize_torch(model):
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+# Function to load the embedding model with the configured backend; falls back to
+# the fp32 torch model when the backend is unavailable or fails its parity check
+def load_encoder(model_name, backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}', expected one of {BACKENDS}")
+    _set_torch_threads(threads)
+    if backend == "torch":
+        return _load_reference(model_name)
+
+    try:
+        if backend == "torch-int8":
+            model = _load_reference(model_name)
+            expected = model.encode(PARITY_PROBES)
+            _quantize_torch(model)
+            parity = parity_report(expected, model.encode(PARITY_PROBES))
+            if parity["passed"]:
+                logger.info(f"Embedding backend torch-int8 for {model_name}: {parity}")
+                return model
+            logger.error(f"torch-int8 embeddings drift from fp32 ({parity}), using torch")
+            return _load_reference(model_name)
+
+        directory = export_onnx(model_name)
+        with open(os.path.join(directory, "export.json")) as f:
+            parity = json.load(f).get("parity", {}).get(backend)
+        if parity and not parity["passed"]:
+            logger.error(f"{backend} embeddings drift from fp32 ({parity}), using torch")
+            return _load_reference(model_name)
+        logger.info(f"Embedding backend {backend} for {model_name}: {parity}")
+        return OnnxEncoder(directory, threads, quantized=backend == "onnx-int8")
+    except (ImportError, OSError, ValueError, RuntimeError) as e:
+        logger.error(f"Embedding backend {backend} unavailable, using torch: {e}")
+        return _load_reference(model_name)
+
+
+# Embedding cache namespace: backends other than fp32 torch produce slightly different vectors
+def embedding_model_id(model_name, backend=EMBEDDING_BACKEND):
+    return model_name if backend == "torch" else f"{model_name}+{backend}"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build an embedding backend and check it against fp32")
+    parser.add_argument("--model", default=os.getenv('EMBEDDING_MODEL', "all-mpnet-base-v2"))
+    parser.add_argument("--backend", choices=BACKENDS[1:], default="onnx-int8")
+    args = parser.parse_args()
+
+    reference = _load_reference(args.model)
+    if args.backend == "torch-int8":
+        parity = check_parity(_quantize_torch(_load_reference(args.model)), reference)
+    else:
+        directory = export_onnx(args.model, reference=reference)
+        parity = check_parity(OnnxEncoder(directory, quantized=args.backend == "onnx-int8"), reference)
+    print(json.dumps(parity, indent=2))
+    raise SystemExit(0 if parity["passed"] else 1)
@@ -0,0 +1,215 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+EMBEDDING_CACHE_DIR = os.getenv(
+    'EMBEDDING_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'embeddings')
+)
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '10000'))
+
+KEY_SIZE = 32  # sha256 digest length
+
+
+# Collapse whitespace and unicode forms so trivially different copies share a key
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\x00{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class DiskVectorStore:
+    """
+    Append-only float32 vector file plus a digest table, shared by every process
+    on the host. Writers serialize on an flock; readers memory-map the vectors.
+    The vector size is recorded by the first write, so the model does not have
+    to be loaded to open the store.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = None
+        self.row_bytes = None
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.keys_path = os.path.join(directory, "keys.bin")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.lock_path = os.path.join(directory, "lock")
+        for path in (self.keys_path, self.vectors_path, self.lock_path):
+            open(path, "ab").close()
+
+        self._rows = {}
+        self._keys_offset = 0
+        self._mmap = None
+        self._mapped_rows = 0
+        self._load_meta()
+
+    def _load_meta(self):
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+            self.row_bytes = self.dim * 4
+
+    # Pick up rows appended by other workers since the last look
+    def _refresh(self):
+        size = os.path.getsize(self.keys_path)
+        size -= size % KEY_SIZE
+        if size <= self._keys_offset:
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read(size - self._keys_offset)
+        first_row = self._keys_offset // KEY_SIZE
+        for i in range(len(data) // KEY_SIZE):
+            self._rows[data[i * KEY_SIZE:(i + 1) * KEY_SIZE]] = first_row + i
+        self._keys_offset = size
+
+    def _vector_at(self, row):
+        if row >= self._mapped_rows:
+            rows = os.path.getsize(self.vectors_path) // self.row_bytes
+            if row >= rows:
+                return None
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+            self._mapped_rows = rows
+        return np.array(self._mmap[row])
+
+    def get(self, key):
+        if self.dim is None:
+            self._load_meta()
+            if self.dim is None:
+                return None
+        row = self._rows.get(key)
+        if row is None:
+            self._refresh()
+            row = self._rows.get(key)
+            if row is None:
+                return None
+        return self._vector_at(row)
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+
+        with open(self.lock_path, "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._load_meta()
+                if self.dim is None:
+                    with open(f"{self.meta_path}.tmp", "w") as f:
+                        json.dump({"dim": int(vector.shape[0])}, f)
+                    os.replace(f"{self.meta_path}.tmp", self.meta_path)
+                    self._load_meta()
+                if vector.shape[0] != self.dim:
+                    raise ValueError(f"Expected a {self.dim}-dim vector, got {vector.shape[0]}")
+                self._refresh()
+                if key in self._rows:
+                    return
+                row = self._keys_offset // KEY_SIZE
+                # The vector is written before its key, so a crash can only leave an
+                # orphaned tail on the vector file; trim it before appending.
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(row * self.row_bytes)
+                    f.seek(row * self.row_bytes)
+                    f.write(vector.tobytes())
+                with open(self.keys_path, "ab") as f:
+                    f.write(key)
+                self._rows[key] = row
+                self._keys_offset += KEY_SIZE
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by sha256(model name + normalized text):
+    an in-process LRU in front of a DiskVectorStore shared across workers.
+    """
+
+    def __init__(self, model_name, directory=EMBEDDING_CACHE_DIR, capacity=EMBEDDING_CACHE_SIZE):
+        self.model_name = model_name
+        self.capacity = capacity
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if directory:
+            safe_name = model_name.replace("/", "__")
+            try:
+                self._disk = DiskVectorStore(os.path.join(directory, safe_name))
+            except OSError as e:
+                logger.error(f"Embedding disk cache disabled: {e}")
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def get(self, text):
+        key = cache_key(self.model_name, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return vector
+            if self._disk is not None:
+                vector = self._disk.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, text, vector):
+        key = cache_key(self.model_name, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._disk is not None:
+                try:
+                    self._disk.put(key, vector)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Error writing embedding to disk cache: {e}")
+
+    # Look every text up and encode only the misses, in a single batch
+    def get_or_encode(self, texts, encode, batch_size=32):
+        vectors = [self.get(text) for text in texts]
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(normalize_text(texts[i]), []).append(i)
+        if missing:
+            pending = list(missing)
+            encoded = encode(pending, batch_size=batch_size)
+            for text, vector in zip(pending, encoded):
+                self.put(text, vector)
+                for i in missing[text]:
+                    vectors[i] = np.asarray(vector, dtype=np.float32)
+        return vectors
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "model": self.model_name,
+                "memory_entries": len(self._memory),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,148 @@
+"""
+Host the sentence embedding model in a single process that gunicorn workers
+reach over a Unix socket, so the weights are loaded once per machine.
+
+    python embeddingSidecar.py --socket /tmp/biashara-embedding.sock
+    EMBEDDING_SIDECAR_SOCKET=/tmp/biashara-embedding.sock gunicorn backend:app
+
+Requests are pickled, so only processes of the same user may connect: the
+socket is created with mode 0600, and clients authenticate with
+EMBEDDING_SIDECAR_AUTHKEY or, when it is unset, with a random key the sidecar
+writes to EMBEDDING_SIDECAR_KEY_FILE (<socket>.key by default, mode 0600) at
+startup.
+"""
+import argparse
+import logging
+import os
+import secrets
+import stat
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_SIDECAR_AUTHKEY = os.getenv('EMBEDDING_SIDECAR_AUTHKEY')
+EMBEDDING_SIDECAR_KEY_FILE = os.getenv('EMBEDDING_SIDECAR_KEY_FILE')
+
+
+def _key_path(address):
+    return EMBEDDING_SIDECAR_KEY_FILE or f"{address}.key"
+
+
+# Function to read the sidecar's key; the configured one, else the sidecar's key file
+def load_authkey(address):
+    if EMBEDDING_SIDECAR_AUTHKEY:
+        return EMBEDDING_SIDECAR_AUTHKEY.encode()
+    try:
+        with open(_key_path(address), "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        raise RuntimeError(f"No embedding sidecar key at {_key_path(address)}: start the sidecar "
+                           f"or set EMBEDDING_SIDECAR_AUTHKEY")
+
+
+# Function to return the configured key, or a random key kept in a file only this user can read
+def create_authkey(address):
+    if EMBEDDING_SIDECAR_AUTHKEY:
+        return EMBEDDING_SIDECAR_AUTHKEY.encode()
+    path = _key_path(address)
+    try:
+        st = os.stat(path)
+        if st.st_uid == os.getuid() and not stat.S_IMODE(st.st_mode) & 0o077:
+            return load_authkey(address)
+        os.remove(path)  # Readable by others, or not ours
+    except FileNotFoundError:
+        pass
+    key = secrets.token_hex(32).encode()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+class RemoteEncoder:
+    """Client with the parts of the SentenceTransformer interface the server uses."""
+
+    def __init__(self, address, authkey=None):
+        self.address = address
+        self.authkey = authkey  # None: read on every connect, so a restarted sidecar's key is picked up
+        self._local = threading.local()  # one connection per thread
+        self._dim = None
+
+    def _call(self, request):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            authkey = self.authkey or load_authkey(self.address)
+            connection = self._local.connection = Client(self.address, family="AF_UNIX", authkey=authkey)
+        try:
+            connection.send(request)
+            status, payload = connection.recv()
+        except (EOFError, OSError):
+            self._local.connection = None
+            raise
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        single = isinstance(sentences, str)
+        vectors = self._call(("encode", [sentences] if single else list(sentences), batch_size))
+        return vectors[0] if single else vectors
+
+    def get_sentence_embedding_dimension(self):
+        if self._dim is None:
+            self._dim = self._call(("dim", None, None))
+        return self._dim
+
+
+def _serve_connection(connection, model):
+    with connection:
+        while True:
+            try:
+                command, sentences, batch_size = connection.recv()
+            except EOFError:
+                return
+            try:
+                if command == "encode":
+                    result = np.asarray(model.encode(sentences, batch_size=batch_size), dtype=np.float32)
+                else:
+                    result = model.get_sentence_embedding_dimension()
+                connection.send(("ok", result))
+            except Exception as e:
+                logger.error(f"Sidecar encode failed: {e}")
+                connection.send(("error", str(e)))
+
+
+def serve(address, model_name):
+    from embeddingBackend import load_encoder
+
+    model = load_encoder(model_name)
+    authkey = create_authkey(address)
+    if os.path.exists(address):
+        os.remove(address)
+    umask = os.umask(0o177)  # The socket is created 0600
+    try:
+        listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(umask)
+    with listener:
+        logger.info(f"Embedding sidecar serving {model_name} on {address}")
+        while True:
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                logger.warning("Embedding sidecar refused a client with the wrong key")
+                continue
+            threading.Thread(target=_serve_connection, args=(connection, model), daemon=True).start()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve the embedding model over a Unix socket")
+    parser.add_argument("--socket", default=os.getenv('EMBEDDING_SIDECAR_SOCKET', '/tmp/biashara-embedding.sock'))
+    parser.add_argument("--model", default=os.getenv('EMBEDDING_MODEL', "all-mpnet-base-v2"))
+    args = parser.parse_args()
+    serve(args.socket, args.model)
@@ -0,0 +1,40 @@
+# gunicorn settings, picked up automatically when gunicorn runs from this directory:
+#     gunicorn backend:app
+import gc
+import logging
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+# Import the app and load its models in the master so workers share the weights copy-on-write
+preload_app = os.getenv('PRELOAD_MODELS', '1') == '1'
+
+# Cap torch threads per worker so workers x threads does not oversubscribe the cores
+TORCH_THREADS_PER_WORKER = os.getenv('TORCH_THREADS_PER_WORKER')
+
+logger = logging.getLogger("gunicorn.error")
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from modelRegistry import registry
+
+    registry.preload()
+    # Keep the preloaded objects out of the collector so their pages stay shared
+    gc.freeze()
+    logger.info(f"Models preloaded in master: {registry.status()['models']}")
+
+
+def post_fork(server, worker):
+    if TORCH_THREADS_PER_WORKER:
+        import torch
+        torch.set_num_threads(int(TORCH_THREADS_PER_WORKER))
+
+    from modelRegistry import memory_usage, registry
+
+    # Anything not preloaded (or preload disabled) warms up in the background
+    registry.warm_up_async()
+    logger.info(f"Worker {worker.pid} booted: {memory_usage()}")
@@ -1,24 +1,119 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from indexGeneration import write_generation
+from indexMapping import PRODUCT_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Seller lookup configuration
+SELLER_LOOKUP_SIZE = int(os.getenv('SELLER_LOOKUP_SIZE', '50'))
+SELLER_LOOKUP_MAX_SIZE = int(os.getenv('SELLER_LOOKUP_MAX_SIZE', '1000'))
+SELLER_KNN_K = int(os.getenv('SELLER_KNN_K', '50'))
+SELLER_CACHE_SIZE = int(os.getenv('SELLER_CACHE_SIZE', '5000'))
+SELLER_CACHE_TTL = float(os.getenv('SELLER_CACHE_TTL', '300'))
+
+# Phrasings of "who sells X"; the first group is the product
+INTENT_PATTERNS = [re.compile(pattern) for pattern in (
+    r"\b(?:who|which (?:sellers?|shops?|stores?|vendors?))\s+(?:sells?|has|have|stocks?|offers?)\s+(.+)",
+    r"\b(?:sellers?|vendors?|suppliers?|shops?|stores?)\s+(?:of|for|selling|that sell|who sell)\s+(.+)",
+    r"\bwhere (?:can i|do i|to)\s+(?:buy|get|find)\s+(.+)",
+    r"^(.+?)\s+(?:sellers?|vendors?|suppliers?)$",
+)]
+LEADING_WORDS = re.compile(r"^(?:(?:a|an|the|some|any)\s+)+")
+
+
 def extract_product_name(query):
-    # Implement logic to extract product name from user query
-    # Example implementation (basic, can be enhanced):
-    keywords = ['sellers of', 'who sells']
-    for keyword in keywords:
-        if keyword in query.lower():
-            return query.lower().split(keyword)[-1].strip()
-
-def find_sellers(product_name):
-    try:
-        res = es.search(index="all_products", body={
-            "query": {
-                "match": {
-                    "productName": product_name
-                }
-            }
-        })
+    # Lowercase, drop punctuation and take the product out of "who sells ..." style phrasings;
+    # a query with no such phrasing is taken to be the product itself
+    text = " ".join(re.sub(r"[?!.,;:\"']", " ", query.lower()).split())
+    for pattern in INTENT_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            text = match.group(1)
+            break
+    text = LEADING_WORDS.sub("", text).strip()
+    return text or None
+
 
-        sellers = list(set([hit["_source"]["userId"] for hit in res["hits"]["hits"]]))
-        return sellers
+def find_sellers(es, product_name, size=SELLER_LOOKUP_SIZE, query_vector=None, index=PRODUCT_INDEX):
+    # One size-0 request: a terms aggregation counts every matching product per seller,
+    # so no hits are fetched and no seller is lost to paging
+    body = {
+        "size": 0,
+        "track_total_hits": True,
+        "query": {"match": {"productName": {"query": product_name, "operator": "and"}}},
+        "aggs": {"sellers": {"terms": {"field": "userId", "size": size}}}
+    }
+    # Optionally also count sellers of the semantically closest products
+    if query_vector is not None:
+        body["knn"] = {
+            "field": "DescriptionVector",
+            "query_vector": query_vector,
+            "k": SELLER_KNN_K,
+            "num_candidates": 2 * SELLER_KNN_K
+        }
+    res = es.search(index=index, body=body)
+    aggregation = res["aggregations"]["sellers"]
+    return {
+        "sellers": [{"userId": bucket["key"], "products": bucket["doc_count"]} for bucket in aggregation["buckets"]],
+        "total_products": res["hits"]["total"]["value"],
+        "more_sellers": aggregation["sum_other_doc_count"] > 0
+    }
 
-    except Exception as e:
-        logger.error(f"Error finding sellers for {product_name}: {e}")
-        return []
+
+class SellerLookup:
+    """
+    find_sellers results cached per normalized product name. Entries are valid
+    until the index write generation moves on or the TTL passes.
+    """
+
+    def __init__(self, es, encode=None, capacity=SELLER_CACHE_SIZE, ttl=SELLER_CACHE_TTL):
+        self.es = es
+        self._encode = encode  # list of texts -> list of index-space vectors, for semantic lookups
+        self.capacity = capacity
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query, semantic=False, size=SELLER_LOOKUP_SIZE):
+        product_name = extract_product_name(query)
+        if not product_name:
+            return None
+        semantic = semantic and self._encode is not None
+
+        key = (product_name, semantic, size)
+        generation = write_generation.current()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] == generation and time.monotonic() - entry[1] < self.ttl:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return {"product": product_name, **entry[2], "cached": True}
+            self.misses += 1
+
+        query_vector = self._encode([product_name])[0] if semantic else None
+        result = find_sellers(self.es, product_name, size=size, query_vector=query_vector)
+        with self._lock:
+            self._cache[key] = (generation, time.monotonic(), result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+        return {"product": product_name, **result, "cached": False}
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "generation": write_generation.current(),
+            }
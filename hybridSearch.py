@@ -0,0 +1,285 @@
+import base64
+import binascii
+import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from indexGeneration import write_generation
+from indexMapping import PRODUCT_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Hybrid search configuration
+HYBRID_DEFAULT_K = int(os.getenv('HYBRID_DEFAULT_K', '10'))
+HYBRID_MAX_K = int(os.getenv('HYBRID_MAX_K', '100'))
+HYBRID_RANK_WINDOW = int(os.getenv('HYBRID_RANK_WINDOW', '100'))
+# Deeper pages widen the window up to this; past it there are no more results
+HYBRID_MAX_RANK_WINDOW = int(os.getenv('HYBRID_MAX_RANK_WINDOW', '1000'))
+HYBRID_RRF_K = int(os.getenv('HYBRID_RRF_K', '60'))
+HYBRID_CANDIDATE_FACTOR = float(os.getenv('HYBRID_CANDIDATE_FACTOR', '1.5'))
+HYBRID_MIN_CANDIDATES = int(os.getenv('HYBRID_MIN_CANDIDATES', '50'))
+# The fixed num_candidates this replaced; only a deeper window than that goes past it
+HYBRID_CANDIDATE_CAP = int(os.getenv('HYBRID_CANDIDATE_CAP', '500'))
+HYBRID_MAX_CANDIDATES = 10000  # Elasticsearch's limit for num_candidates
+
+KEYWORD_FILTERS = ["category", "brand", "currency"]
+PRICE_FILTERS = ["min_price", "max_price"]
+LEXICAL_FIELDS = ["productName^2", "productDescription"]
+SOURCE_EXCLUDES = ["DescriptionVector", "dedupBands"]
+
+
+# Function to normalize request filters into {field: [values], "min_price": x, "max_price": y}
+def parse_filters(raw):
+    if raw is None:
+        return {}
+    if not isinstance(raw, dict):
+        raise ValueError("filters must be an object")
+    filters = {}
+    for key, value in raw.items():
+        if key in KEYWORD_FILTERS:
+            values = value if isinstance(value, list) else [value]
+            if not values or not all(isinstance(item, str) for item in values):
+                raise ValueError(f"{key} must be a string or a list of strings")
+            filters[key] = values
+        elif key in PRICE_FILTERS:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{key} must be a number")
+            filters[key] = value
+        else:
+            raise ValueError(f"Unknown filter '{key}', expected one of {KEYWORD_FILTERS + PRICE_FILTERS}")
+    return filters
+
+
+# Function to turn parsed filters into Elasticsearch filter clauses
+def filter_clauses(filters):
+    clauses = [{"terms": {field: filters[field]}} for field in KEYWORD_FILTERS if field in filters]
+    price = {}
+    if "min_price" in filters:
+        price["gte"] = filters["min_price"]
+    if "max_price" in filters:
+        price["lte"] = filters["max_price"]
+    if price:
+        clauses.append({"range": {"productPrice": price}})
+    return clauses
+
+
+# Function to apply parsed filters to a _source, for the local index
+def matches_filters(source, filters):
+    for field in KEYWORD_FILTERS:
+        if field in filters and source.get(field) not in filters[field]:
+            return False
+    price = source.get("productPrice")
+    if "min_price" in filters and (price is None or price < filters["min_price"]):
+        return False
+    if "max_price" in filters and (price is None or price > filters["max_price"]):
+        return False
+    return True
+
+
+# Cursors hold the number of results returned so far and, for each rank window
+# pages were fused over, the [window, score, id] of the last result returned in it
+def encode_cursor(offset, cutoffs):
+    return base64.urlsafe_b64encode(json.dumps([offset, cutoffs]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    if cursor is None:
+        return None
+    try:
+        offset, cutoffs = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return {"offset": int(offset),
+                "cutoffs": [[int(window), float(score), str(doc_id)] for window, score, doc_id in cutoffs]}
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        raise ValueError("Invalid search_after cursor")
+
+
+# Function to size the rank window so it reaches past the requested page, doubling
+# from window; None once the page would start past HYBRID_MAX_RANK_WINDOW
+def rank_window(k, search_after=None, window=HYBRID_RANK_WINDOW):
+    offset = search_after["offset"] if search_after else 0
+    limit = max(HYBRID_MAX_RANK_WINDOW, k)
+    if offset >= limit:
+        return None
+    window = max(window, k)
+    while window <= offset + k:
+        window *= 2
+    return min(window, limit)
+
+
+# Function to validate a /search/hybrid request body
+def parse_search_request(payload):
+    if not isinstance(payload, dict):
+        raise ValueError("A JSON object is required")
+    keyword = payload.get("keyword")
+    if not keyword or not isinstance(keyword, str):
+        raise ValueError("Keyword is required")
+    k = payload.get("k", HYBRID_DEFAULT_K)
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= HYBRID_MAX_K:
+        raise ValueError(f"k must be an integer between 1 and {HYBRID_MAX_K}")
+    return {
+        "keyword": keyword,
+        "k": k,
+        "filters": parse_filters(payload.get("filters")),
+        "search_after": decode_cursor(payload.get("search_after")),
+    }
+
+
+# Function to size the HNSW candidate list from the requested depth and filter selectivity.
+# Candidates scale with the results needed, up to the fixed 500 used before. Restrictive
+# filters disconnect the graph, so they get up to 4x more exploration (the full 4x when
+# filtered is set but the counts are not known yet). The list never exceeds the number
+# of matching documents, which makes small filtered sets an exact search.
+def adaptive_num_candidates(k, matching=None, total=None, filtered=False):
+    candidates = max(HYBRID_MIN_CANDIDATES, math.ceil(k * HYBRID_CANDIDATE_FACTOR))
+    if matching is not None and total:
+        selectivity = max(matching / total, 1e-6)
+        candidates = math.ceil(candidates * min(4.0, 1.0 / math.sqrt(selectivity)))
+        candidates = min(candidates, max(matching, k))
+    elif filtered:
+        candidates *= 4
+    return max(k, min(candidates, HYBRID_CANDIDATE_CAP, HYBRID_MAX_CANDIDATES))
+
+
+# Function to fuse ranked id lists; ties are broken by id so pages are stable
+def reciprocal_rank_fusion(rankings, rank_constant=HYBRID_RRF_K):
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rank_constant + rank)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+# Function to cut one page out of a list fused over window after a cursor.
+# Fused scores change with the window, so a result counts as returned if it was
+# above the cutoff of any window used before; fused_over(window) re-fuses the
+# rankings cut to an earlier, narrower window
+def page_after(fused, k, search_after=None, window=HYBRID_RANK_WINDOW, fused_over=None):
+    offset, cutoffs = (search_after["offset"], search_after["cutoffs"]) if search_after else (0, [])
+    returned = set()
+    for cutoff_window, after_score, after_id in cutoffs:
+        earlier = fused if cutoff_window == window or fused_over is None else fused_over(cutoff_window)
+        returned.update(doc_id for doc_id, score in earlier if (-score, doc_id) <= (-after_score, after_id))
+    remaining = [(doc_id, score) for doc_id, score in fused if doc_id not in returned]
+    page = remaining[:k]
+    cursor = None
+    if len(remaining) > k and offset + len(page) < max(HYBRID_MAX_RANK_WINDOW, k):
+        cutoffs = [cutoff for cutoff in cutoffs if cutoff[0] != window] + [[window, page[-1][1], page[-1][0]]]
+        cursor = encode_cursor(offset + len(page), cutoffs)
+    return page, cursor
+
+
+def _no_more_results():
+    return {"results": [], "search_after": None, "num_candidates": None, "matching": None}
+
+
+class HybridSearcher:
+    """
+    Lexical (BM25) and filtered kNN retrieval in one _msearch, fused with
+    reciprocal rank fusion over a rank window that grows with the page
+    requested. Only the returned page is fetched with _source. Filter match
+    counts used to size num_candidates are cached until the next index write;
+    a missing count is asked for in the same _msearch and used from the next
+    query on.
+    """
+
+    def __init__(self, es, index=PRODUCT_INDEX, window=HYBRID_RANK_WINDOW, capacity=1000):
+        self.es = es
+        self.index = index
+        self.window = window
+        self.capacity = capacity
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached_count(self, clauses, generation):
+        with self._lock:
+            cached = self._counts.get(json.dumps(clauses, sort_keys=True))
+            return cached[1] if cached and cached[0] == generation else None
+
+    def _store_count(self, clauses, generation, count):
+        key = json.dumps(clauses, sort_keys=True)
+        with self._lock:
+            self._counts[key] = (generation, count)
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.capacity:
+                self._counts.popitem(last=False)
+
+    def search(self, keyword, query_vector, k=HYBRID_DEFAULT_K, filters=None, search_after=None, fields=None):
+        window = rank_window(k, search_after, self.window)
+        if window is None:
+            return _no_more_results()
+        clauses = filter_clauses(filters or {})
+        generation = write_generation.current()
+        matching = total = None
+        uncounted = []
+        if clauses:
+            matching, total = self._cached_count(clauses, generation), self._cached_count([], generation)
+            uncounted = [c for c, count in ((clauses, matching), ([], total)) if count is None]
+        num_candidates = adaptive_num_candidates(window, matching, total, filtered=bool(clauses))
+
+        # Variants have no vector, so only the lexical side needs to leave them out
+        lexical = {"bool": {"must": {"multi_match": {"query": keyword, "fields": LEXICAL_FIELDS}},
+                            "must_not": [{"exists": {"field": "variantOf"}}], "filter": clauses}}
+        knn = {"field": "DescriptionVector", "query_vector": query_vector,
+               "k": window, "num_candidates": num_candidates}
+        if clauses:
+            knn["filter"] = clauses
+        body = [
+            {"index": self.index}, {"size": window, "_source": False, "query": lexical},
+            {"index": self.index}, {"size": window, "_source": False, "knn": knn},
+        ]
+        for counted in uncounted:
+            query = {"bool": {"filter": counted}} if counted else {"match_all": {}}
+            body += [{"index": self.index}, {"size": 0, "track_total_hits": True, "query": query}]
+        res = self.es.msearch(body=body)
+        rankings = []
+        for response in res["responses"]:
+            if "error" in response:
+                raise RuntimeError(f"Hybrid search failed: {response['error']}")
+        for response in res["responses"][:2]:
+            rankings.append([hit["_id"] for hit in response["hits"]["hits"]])
+        for counted, response in zip(uncounted, res["responses"][2:]):
+            count = response["hits"]["total"]["value"]
+            self._store_count(counted, generation, count)
+            if counted:
+                matching = count
+            else:
+                total = count
+
+        page, cursor = page_after(reciprocal_rank_fusion(rankings), k, search_after, window,
+                                  lambda narrower: reciprocal_rank_fusion([ranking[:narrower] for ranking in rankings]))
+        sources = {}
+        if page:
+            source = {"_source": fields} if fields else {"_source_excludes": SOURCE_EXCLUDES}
+            docs = self.es.mget(index=self.index, ids=[doc_id for doc_id, _ in page], **source)["docs"]
+            sources = {doc["_id"]: doc.get("_source", {}) for doc in docs if doc.get("found")}
+        return {
+            "results": [{"id": doc_id, "score": score, **sources[doc_id]} for doc_id, score in page if doc_id in sources],
+            "search_after": cursor,
+            "num_candidates": num_candidates,
+            "matching": matching,
+        }
+
+
+# Vector-only stand-in for when Elasticsearch is unreachable: filters are applied to the local hits
+def local_hybrid_search(local_index, query_vector, k=HYBRID_DEFAULT_K, filters=None,
+                        search_after=None, fields=None, window=HYBRID_RANK_WINDOW):
+    window = rank_window(k, search_after, window)
+    if window is None:
+        return _no_more_results()
+    hits = local_index.search(query_vector, window * (4 if filters else 1))
+    hits = [hit for hit in hits if matches_filters(hit["source"], filters or {})][:window]
+    page, cursor = page_after([(hit["id"], hit["score"]) for hit in hits], k, search_after, window)
+    sources = {hit["id"]: hit["source"] for hit in hits}
+    return {
+        "results": [
+            {"id": doc_id, "score": score,
+             **{field: value for field, value in sources[doc_id].items() if fields is None or field in fields}}
+            for doc_id, score in page
+        ],
+        "search_after": cursor,
+        "num_candidates": None,
+        "matching": None,
+    }
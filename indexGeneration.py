@@ -0,0 +1,83 @@
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Shared by every process on the host that writes to or caches from the product index
+INDEX_GENERATION_PATH = os.getenv(
+    'INDEX_GENERATION_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'index_generation')
+)
+# Set to share the generation between hosts through a Redis-compatible server instead
+INDEX_GENERATION_REDIS_URL = os.getenv('INDEX_GENERATION_REDIS_URL')
+
+
+class WriteGeneration:
+    """
+    Counter bumped after every successful write to the product index. Caches
+    store the generation they were filled at and treat a different value as
+    stale, so a write in any worker invalidates them all.
+    """
+
+    def __init__(self, path=INDEX_GENERATION_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def current(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self):
+        try:
+            with open(f"{self.path}.lock", "ab") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    generation = self.current() + 1
+                    with open(f"{self.path}.tmp", "w") as f:
+                        f.write(str(generation))
+                    os.replace(f"{self.path}.tmp", self.path)
+                    return generation
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except OSError as e:
+            logger.error(f"Error bumping index write generation: {e}")
+            return None
+
+
+class RedisWriteGeneration:
+    """The same counter kept in a Redis key, for workers spread over several hosts."""
+
+    def __init__(self, url=INDEX_GENERATION_REDIS_URL, key="index_generation"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.key = key
+
+    def current(self):
+        try:
+            return int(self.client.get(self.key) or 0)
+        except Exception as e:
+            logger.error(f"Error reading index write generation: {e}")
+            return -1  # Matches no cached entry while Redis is unreachable
+
+    def bump(self):
+        try:
+            return self.client.incr(self.key)
+        except Exception as e:
+            logger.error(f"Error bumping index write generation: {e}")
+            return None
+
+
+def _create_write_generation():
+    if INDEX_GENERATION_REDIS_URL:
+        try:
+            return RedisWriteGeneration()
+        except ImportError as e:
+            logger.error(f"Redis write generation unavailable, using {INDEX_GENERATION_PATH}: {e}")
+    return WriteGeneration()
+
+
+write_generation = _create_write_generation()
@@ -1,44 +1,60 @@
-# Elasticsearch index mapping
-indexMapping = {
-    "mappings": {
-        "properties": {
-            "userId": {
-                "type": "keyword"
-            },
-            "productDescription": {
-                "type": "text"
-            },
-            "DescriptionVector": {
-                "type": "dense_vector",
-                "dims": 768
-            },
-            "imageUrls": {
-                "type": "keyword"
-            },
-            "videoUrls": {
-                "type": "keyword"
-            },
-            "productName": {
-                "type": "text"
-            },
-            "currency": {
-                "type": "keyword"
-            },
-            "productPrice": {
-                "type": "float"
-            },
-            "color": {
-                "type": "keyword"
-            },
-            "size": {
-                "type": "keyword"
-            },
-            "brand": {
-                "type": "keyword"
-            },
-            "category": {
-                "type": "keyword"
+import os
+
+from vectorProfile import profile, vector_mapping
+
+# Read/write alias the services use; the physical indices behind it are versioned (see indexVersions.py)
+PRODUCT_INDEX = os.getenv('PRODUCT_INDEX', 'all_products')
+
+
+# Function to build the Elasticsearch index mapping for a vector profile
+def build_index_mapping(vector_profile=profile):
+    return {
+        "mappings": {
+            "properties": {
+                "userId": {
+                    "type": "keyword"
+                },
+                "productDescription": {
+                    "type": "text"
+                },
+                "DescriptionVector": vector_mapping(vector_profile),
+                "imageUrls": {
+                    "type": "keyword"
+                },
+                "videoUrls": {
+                    "type": "keyword"
+                },
+                "productName": {
+                    "type": "text"
+                },
+                "currency": {
+                    "type": "keyword"
+                },
+                "productPrice": {
+                    "type": "float"
+                },
+                "color": {
+                    "type": "keyword"
+                },
+                "size": {
+                    "type": "keyword"
+                },
+                "brand": {
+                    "type": "keyword"
+                },
+                "category": {
+                    "type": "keyword"
+                },
+                "dedupBands": {
+                    "type": "keyword"
+                },
+                "variantOf": {
+                    "type": "keyword"
+                }
             }
         }
     }
-}
\ No newline at end of file
+
+
+# Elasticsearch index mapping
+indexMapping = build_index_mapping()
@@ -0,0 +1,462 @@
+"""
+Versioned product indices behind the PRODUCT_INDEX read/write alias.
+
+Services only ever name the alias. Physical indices are <alias>_v<n> and
+record the embedding model and vector profile they were built with in their
+mapping _meta, so changing either means building the next version:
+
+    python indexVersions.py --model <model> --vector-profile int8_hnsw:384
+    python indexVersions.py --status
+
+A migration runs while the services keep serving from the current index:
+
+  1. The target index is created without replicas or refreshes, next to a
+     change log reachable through the <alias>_migration alias. While that
+     alias exists, every write made through the indexing queue or
+     /add_products also records its id in the change log (dual-write).
+  2. All documents are copied with a sliced parallel scroll, re-embedding the
+     descriptions with the new model, and written with _bulk. The copy rate is
+     throttled against a probe search so production latency stays flat.
+  3. The change log is replayed: each recorded id is read again from the old
+     index, re-embedded and written to (or deleted from) the target.
+  4. Cutover: writes to the old index are blocked (the indexing queue retries
+     them), the rest of the change log is replayed, and the alias moves to
+     the target in one atomic _aliases request. The old index is kept for
+     rollback unless --delete-old is given.
+
+Queries must be embedded with the model of the index behind the alias;
+/ready answers 503 while they are not, so start instances with the new
+EMBEDDING_MODEL before the cutover and retire the old ones after it.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import BadRequestError, NotFoundError, helpers
+
+from documentPreparation import MODEL_NAME
+from indexMapping import PRODUCT_INDEX, build_index_mapping
+from vectorProfile import VECTOR_PROFILE, parse_profile, to_index_vector
+
+logger = logging.getLogger(__name__)
+
+# How often serving processes look up the index behind the alias
+PRODUCT_INDEX_CHECK_INTERVAL = float(os.getenv('PRODUCT_INDEX_CHECK_INTERVAL', '10'))
+
+# Reindex job tuning
+REINDEX_SLICES = int(os.getenv('REINDEX_SLICES', '4'))
+REINDEX_BATCH_SIZE = int(os.getenv('REINDEX_BATCH_SIZE', '256'))
+REINDEX_MAX_DOCS_PER_SECOND = float(os.getenv('REINDEX_MAX_DOCS_PER_SECOND', '500'))
+REINDEX_MIN_DOCS_PER_SECOND = float(os.getenv('REINDEX_MIN_DOCS_PER_SECOND', '10'))
+# The copy slows down when a probe search takes this many times its latency before the job started
+REINDEX_PROBE_SLOWDOWN = float(os.getenv('REINDEX_PROBE_SLOWDOWN', '1.5'))
+REINDEX_PROBE_INTERVAL = float(os.getenv('REINDEX_PROBE_INTERVAL', '2'))
+# Time for writes accepted just before the cutover block to reach the change log
+REINDEX_CUTOVER_GRACE = float(os.getenv('REINDEX_CUTOVER_GRACE', '2'))
+
+
+def version_name(alias, version):
+    return f"{alias}_v{version}"
+
+
+def migration_alias(alias):
+    return f"{alias}_migration"
+
+
+def change_log_name(alias):
+    return f"{alias}_changes"
+
+
+# Function to build the body of a versioned index, recording what its vectors were made with
+def index_body(model_name=MODEL_NAME, vector_profile=VECTOR_PROFILE):
+    body = build_index_mapping(parse_profile(vector_profile))
+    body["mappings"]["_meta"] = {"embedding_model": model_name, "vector_profile": vector_profile}
+    return body
+
+
+# Function to find the physical index the alias writes to; an index created
+# before versioning has the alias name itself
+def current_index(es, alias=PRODUCT_INDEX):
+    try:
+        aliases = es.indices.get_alias(name=alias).body
+    except NotFoundError:
+        return alias if es.indices.exists(index=alias) else None
+    for index, entry in aliases.items():
+        if entry["aliases"][alias].get("is_write_index", len(aliases) == 1):
+            return index
+    return None
+
+
+# Function to create the first versioned index behind the alias, unless the alias
+# or an unversioned index of that name already exists
+def ensure_product_index(es, alias=PRODUCT_INDEX):
+    if es.indices.exists(index=alias):
+        add_keyword_fields(es, alias)
+        return
+    index = version_name(alias, 1)
+    body = {**index_body(), "aliases": {alias: {"is_write_index": True}}}
+    try:
+        es.indices.create(index=index, body=body)
+        logger.info(f"Index '{index}' created behind alias '{alias}'")
+    except BadRequestError as e:
+        if e.error != "resource_already_exists_exception":
+            raise  # Otherwise another worker created it first
+
+
+# Fields added to the mapping after the first index was built; adding a field
+# needs no reindex, so existing indices get them at startup
+ADDED_FIELDS = ("dedupBands", "variantOf")
+
+
+def add_keyword_fields(es, alias=PRODUCT_INDEX, fields=ADDED_FIELDS):
+    properties = build_index_mapping()["mappings"]["properties"]
+    try:
+        es.indices.put_mapping(index=alias, properties={field: properties[field] for field in fields})
+    except BadRequestError as e:
+        logger.error(f"Could not add {fields} to the mapping of '{alias}': {e}")
+
+
+class ProductIndex:
+    """
+    What a serving process knows about the index behind the alias: the model
+    and vector profile it was built with, and whether a migration is recording
+    changes. Looked up at most every PRODUCT_INDEX_CHECK_INTERVAL seconds;
+    status() backs the /ready endpoints.
+    """
+
+    def __init__(self, es, alias=PRODUCT_INDEX, interval=PRODUCT_INDEX_CHECK_INTERVAL):
+        self.es = es
+        self.alias = alias
+        self.interval = interval
+        self._state = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _check(self):
+        index = current_index(self.es, self.alias)
+        meta = {}
+        if index is not None:
+            meta = self.es.indices.get_mapping(index=index).body[index]["mappings"].get("_meta", {})
+        state = {
+            "alias": self.alias,
+            "index": index,
+            "embedding_model": meta.get("embedding_model"),
+            "vector_profile": meta.get("vector_profile"),
+            "migrating": bool(self.es.indices.exists_alias(name=migration_alias(self.alias))),
+        }
+        # Indices from before versioning carry no _meta and are taken to match
+        state["compatible"] = state["embedding_model"] in (None, MODEL_NAME) and \
+            state["vector_profile"] in (None, VECTOR_PROFILE)
+        if not state["compatible"]:
+            logger.error(f"Index '{index}' holds {state['embedding_model']} {state['vector_profile']} vectors, "
+                         f"this process embeds with {MODEL_NAME} {VECTOR_PROFILE}")
+        return state
+
+    def status(self):
+        with self._lock:
+            if self._state is None or time.monotonic() - self._checked >= self.interval:
+                try:
+                    self._state = self._check()
+                except Exception as e:
+                    logger.error(f"Error looking up the index behind '{self.alias}': {e}")
+                    if self._state is None:
+                        self._state = {"alias": self.alias, "index": None, "migrating": False,
+                                       "compatible": True, "error": str(e)}
+                self._checked = time.monotonic()
+            return self._state
+
+    def migrating(self):
+        return self.status()["migrating"]
+
+    # Record written ids in the change log of a running migration, so the job
+    # replays writes its copy may have missed
+    def record_changes(self, ids):
+        if not ids or not self.migrating():
+            return
+        changed_at = int(time.time() * 1000)
+        actions = [{"_index": migration_alias(self.alias), "_id": doc_id, "_source": {"changed_at": changed_at}}
+                   for doc_id in ids]
+        try:
+            _, errors = helpers.bulk(self.es, actions, raise_on_error=False, raise_on_exception=False,
+                                     require_alias=True)
+        except Exception as e:
+            errors = [str(e)]
+        if errors:
+            # Expected for a moment after a cutover, until the migration alias is looked up again
+            logger.warning(f"Could not record {len(errors)} changes for the migration of '{self.alias}': {errors[0]}")
+            with self._lock:
+                self._checked = 0.0
+
+
+class Throttle:
+    """
+    Documents-per-second budget shared by the copy workers. A probe search
+    through the alias is timed every REINDEX_PROBE_INTERVAL seconds; the rate
+    halves while it is REINDEX_PROBE_SLOWDOWN times slower than before the job
+    started and creeps back up while it is not.
+    """
+
+    def __init__(self, es, alias, max_rate=REINDEX_MAX_DOCS_PER_SECOND, min_rate=REINDEX_MIN_DOCS_PER_SECOND,
+                 slowdown=REINDEX_PROBE_SLOWDOWN, interval=REINDEX_PROBE_INTERVAL):
+        self.es = es
+        self.alias = alias
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.slowdown = slowdown
+        self.interval = interval
+        self.rate = max_rate
+        self.baseline = None
+        self._allowance = 0.0
+        self._last = time.monotonic()
+        self._next_probe = 0.0
+        self._lock = threading.Lock()
+
+    def _probe(self):
+        started = time.perf_counter()
+        self.es.search(index=self.alias, query={"match": {"productDescription": "reindex probe"}},
+                       size=10, request_cache=False)
+        return time.perf_counter() - started
+
+    def calibrate(self, samples=5):
+        self.baseline = sorted(self._probe() for _ in range(samples))[samples // 2]
+        logger.info(f"Probe search baseline {self.baseline * 1000:.1f}ms")
+
+    def _adjust(self):
+        latency = self._probe()
+        if latency > self.baseline * self.slowdown:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logger.info(f"Probe search took {latency * 1000:.1f}ms, copying at {self.rate:.0f} docs/s")
+        else:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+    # Blocks until count documents fit in the budget
+    def acquire(self, count):
+        with self._lock:
+            now = time.monotonic()
+            if self.baseline is not None and now >= self._next_probe:
+                self._adjust()
+                self._next_probe = now + self.interval
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate) - count
+            self._last = now
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class Reindexer:
+    """
+    Builds the next version of the index with another model or vector profile
+    and moves the alias to it; see the module docstring for the steps.
+    """
+
+    def __init__(self, es, alias=PRODUCT_INDEX, model_name=MODEL_NAME, vector_profile=VECTOR_PROFILE,
+                 slices=REINDEX_SLICES, batch_size=REINDEX_BATCH_SIZE, max_rate=REINDEX_MAX_DOCS_PER_SECOND,
+                 encoder=None):
+        self.es = es
+        self.alias = alias
+        self.model_name = model_name
+        self.vector_profile = vector_profile
+        self.profile = parse_profile(vector_profile)
+        self.slices = max(1, slices)
+        self.batch_size = batch_size
+        self.throttle = Throttle(es, alias, max_rate)
+        self.source = None
+        self.target = None
+        self.copied = 0
+        self.replayed = 0
+        self.swapped = False
+        self._encoder = encoder
+        self._encode_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+
+    def _encode(self, texts):
+        with self._encode_lock:
+            if self._encoder is None:
+                from embeddingBackend import load_encoder
+                self._encoder = load_encoder(self.model_name)
+            vectors = self._encoder.encode(texts)
+        return [to_index_vector(vector, self.profile) for vector in vectors]
+
+    # Variants are copied as they are: they are stored without a vector (see duplicateDetection.py)
+    def _reembed(self, sources):
+        embedded = [source for source in sources if not source.get("variantOf")]
+        vectors = iter(self._encode([source.get("productDescription", "") for source in embedded]) if embedded else [])
+        return [source if source.get("variantOf") else {**source, "DescriptionVector": next(vectors)}
+                for source in sources]
+
+    def _next_version(self):
+        prefix = version_name(self.alias, "")
+        versions = [int(name[len(prefix):]) for name in self.es.indices.get(index=prefix + "*").body
+                    if name[len(prefix):].isdigit()]
+        return version_name(self.alias, max(versions, default=0) + 1)
+
+    def _create_target(self):
+        settings = self.es.indices.get_settings(index=self.source).body[self.source]["settings"]["index"]
+        self._replicas = settings.get("number_of_replicas", "1")
+        body = index_body(self.model_name, self.vector_profile)
+        body["settings"] = {"number_of_shards": settings.get("number_of_shards", "1"),
+                            "number_of_replicas": 0, "refresh_interval": "-1"}
+        self.es.indices.create(index=self.target, body=body)
+        self.es.indices.create(index=change_log_name(self.alias), body={
+            "mappings": {"properties": {"changed_at": {"type": "date", "format": "epoch_millis"}}},
+            "aliases": {migration_alias(self.alias): {}},
+        })
+        logger.info(f"Migrating '{self.alias}' from '{self.source}' to '{self.target}' "
+                    f"({self.model_name}, {self.vector_profile})")
+
+    def _write(self, actions):
+        _, errors = helpers.bulk(self.es, actions, chunk_size=self.batch_size,
+                                 raise_on_error=False, raise_on_exception=False)
+        errors = [error for error in errors if next(iter(error.values())).get("status") != 404]
+        if errors:
+            raise RuntimeError(f"{len(errors)} documents could not be written to '{self.target}': {errors[0]}")
+
+    def _copy_batch(self, hits):
+        self.throttle.acquire(len(hits))
+        sources = self._reembed([hit["_source"] for hit in hits])
+        self._write({"_index": self.target, "_id": hit["_id"], "_source": source}
+                    for hit, source in zip(hits, sources))
+        with self._count_lock:
+            before, self.copied = self.copied, self.copied + len(hits)
+        if before // 10000 != self.copied // 10000:
+            logger.info(f"Copied {self.copied} documents ({self.throttle.rate:.0f} docs/s allowed)")
+
+    def _copy_slice(self, slice_id):
+        query = {"query": {"match_all": {}}}
+        if self.slices > 1:
+            query["slice"] = {"id": slice_id, "max": self.slices}
+        batch = []
+        for hit in helpers.scan(self.es, index=self.source, query=query, size=self.batch_size,
+                                _source_excludes=["DescriptionVector"]):
+            batch.append(hit)
+            if len(batch) >= self.batch_size:
+                self._copy_batch(batch)
+                batch = []
+        if batch:
+            self._copy_batch(batch)
+
+    def _copy(self):
+        with ThreadPoolExecutor(max_workers=self.slices, thread_name_prefix="reindex") as pool:
+            for future in [pool.submit(self._copy_slice, slice_id) for slice_id in range(self.slices)]:
+                future.result()
+        logger.info(f"Copied {self.copied} documents into '{self.target}'")
+
+    # One pass over the change log; returns how many ids were replayed
+    def _replay(self):
+        log = migration_alias(self.alias)
+        self.es.indices.refresh(index=log)
+        hits = self.es.search(index=log, size=self.batch_size, seq_no_primary_term=True,
+                              query={"match_all": {}}).body["hits"]["hits"]
+        if not hits:
+            return 0
+        self.throttle.acquire(len(hits))
+        docs = self.es.mget(index=self.source, ids=[hit["_id"] for hit in hits],
+                            _source_excludes=["DescriptionVector"]).body["docs"]
+        found = [doc for doc in docs if doc.get("found")]
+        actions = [{"_index": self.target, "_id": doc["_id"], "_source": source}
+                   for doc, source in zip(found, self._reembed([doc["_source"] for doc in found]))]
+        actions += [{"_op_type": "delete", "_index": self.target, "_id": doc["_id"]}
+                    for doc in docs if not doc.get("found")]
+        self._write(actions)
+
+        # An id written again since this pass read it keeps its entry for the next pass
+        helpers.bulk(self.es, ({"_op_type": "delete", "_index": change_log_name(self.alias), "_id": hit["_id"],
+                                "if_seq_no": hit["_seq_no"], "if_primary_term": hit["_primary_term"]}
+                               for hit in hits), raise_on_error=False, raise_on_exception=False)
+        self.replayed += len(hits)
+        return len(hits)
+
+    # Replays until a pass finds fewer than a batch of changes, or none at all
+    def _catch_up(self, until_empty=False):
+        while True:
+            replayed = self._replay()
+            if replayed == 0 or (replayed < self.batch_size and not until_empty):
+                return
+
+    def _cut_over(self):
+        legacy = self.source == self.alias
+        self.es.indices.put_settings(index=self.target, settings={
+            "index": {"number_of_replicas": self._replicas, "refresh_interval": None}
+        })
+        self.es.cluster.health(index=self.target, wait_for_no_initializing_shards=True, timeout="10m")
+
+        self.es.indices.put_settings(index=self.source, settings={"index": {"blocks": {"write": True}}})
+        try:
+            time.sleep(REINDEX_CUTOVER_GRACE)
+            self._catch_up(until_empty=True)
+            self.es.indices.refresh(index=self.target)
+            self.es.indices.update_aliases(actions=[
+                # An unversioned index has the alias name, so it is deleted in the same request
+                {"remove_index": {"index": self.source}} if legacy else
+                {"remove": {"index": self.source, "alias": self.alias}},
+                {"add": {"index": self.target, "alias": self.alias, "is_write_index": True}},
+                {"remove": {"index": change_log_name(self.alias), "alias": migration_alias(self.alias)}},
+            ])
+            self.swapped = True
+        finally:
+            if not (legacy and self.swapped):
+                self.es.indices.put_settings(index=self.source, settings={"index": {"blocks": {"write": None}}})
+        logger.info(f"Alias '{self.alias}' now points at '{self.target}'")
+
+    def _abort(self):
+        for index in (change_log_name(self.alias), self.target):
+            try:
+                self.es.indices.delete(index=index, ignore_unavailable=True)
+            except Exception as e:
+                logger.error(f"Error removing '{index}' after a failed migration: {e}")
+
+    def run(self, delete_old=False):
+        self.source = current_index(self.es, self.alias)
+        if self.source is None:
+            raise ValueError(f"Nothing to reindex: '{self.alias}' does not exist")
+        if self.es.indices.exists(index=change_log_name(self.alias)):
+            raise RuntimeError(f"A migration of '{self.alias}' is already running (or left '{change_log_name(self.alias)}' behind)")
+        self.target = self._next_version()
+
+        self._create_target()
+        try:
+            # Every serving process notices the migration before the copy takes its snapshot
+            time.sleep(PRODUCT_INDEX_CHECK_INTERVAL + 1)
+            self.es.indices.refresh(index=self.source)
+            self.throttle.calibrate()
+            self._copy()
+            self._catch_up()
+            self._cut_over()
+        except BaseException:
+            if not self.swapped:
+                logger.error(f"Migration of '{self.alias}' to '{self.target}' failed, removing it")
+                self._abort()
+            raise
+        self.es.indices.delete(index=change_log_name(self.alias))
+        if delete_old and self.source != self.alias:
+            self.es.indices.delete(index=self.source)
+        logger.info(f"Migration done: {self.copied} copied, {self.replayed} replayed")
+        return {"source": self.source, "target": self.target, "copied": self.copied, "replayed": self.replayed}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Rebuild the product index behind its alias")
+    parser.add_argument("--es-url", default=os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200'))
+    parser.add_argument("--alias", default=PRODUCT_INDEX)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--vector-profile", default=VECTOR_PROFILE)
+    parser.add_argument("--slices", type=int, default=REINDEX_SLICES)
+    parser.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE)
+    parser.add_argument("--max-rate", type=float, default=REINDEX_MAX_DOCS_PER_SECOND, help="Documents per second")
+    parser.add_argument("--delete-old", action="store_true", help="Delete the previous index after the cutover")
+    parser.add_argument("--status", action="store_true", help="Show the index behind the alias and exit")
+    args = parser.parse_args()
+
+    from elasticsearch import Elasticsearch
+    es = Elasticsearch(args.es_url)
+    if args.status:
+        print(json.dumps(ProductIndex(es, args.alias).status(), indent=2))
+    else:
+        result = Reindexer(es, args.alias, args.model, args.vector_profile, args.slices,
+                           args.batch_size, args.max_rate).run(args.delete_old)
+        print(json.dumps(result, indent=2))
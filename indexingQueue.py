@@ -0,0 +1,354 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from elasticsearch import helpers
+from documentPreparation import prepareDocuments, preparePartialDocuments, validateFields, validateProduct
+from indexGeneration import write_generation
+from indexMapping import PRODUCT_INDEX
+from localVectorIndex import local_index
+
+logger = logging.getLogger(__name__)
+
+# Refresh policy: "none" leaves it to the index refresh_interval, "wait_for" makes each
+# bulk request wait for the next refresh, "interval" refreshes at most every N seconds.
+INDEX_REFRESH_MODE = os.getenv('INDEX_REFRESH_MODE', 'interval')
+INDEX_REFRESH_INTERVAL = float(os.getenv('INDEX_REFRESH_INTERVAL', '1.0'))
+
+# Queue tuning
+INDEX_QUEUE_SIZE = int(os.getenv('INDEX_QUEUE_SIZE', '10000'))
+INDEX_QUEUE_BATCH_SIZE = int(os.getenv('INDEX_QUEUE_BATCH_SIZE', '500'))
+INDEX_QUEUE_LINGER = float(os.getenv('INDEX_QUEUE_LINGER', '0.05'))
+INDEX_QUEUE_PUT_TIMEOUT = float(os.getenv('INDEX_QUEUE_PUT_TIMEOUT', '0.5'))
+INDEX_STATUS_RETENTION = int(os.getenv('INDEX_STATUS_RETENTION', '50000'))
+# Writes rejected by the write block of a reindex cutover are retried this often
+INDEX_BLOCKED_RETRY_DELAY = float(os.getenv('INDEX_BLOCKED_RETRY_DELAY', '0.5'))
+INDEX_BLOCKED_RETRIES = int(os.getenv('INDEX_BLOCKED_RETRIES', '60'))
+
+REFRESH_MODES = ("none", "wait_for", "interval")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class IndexingQueue:
+    """
+    Write-behind indexing queue. Handlers enqueue writes and return a write id;
+    a background worker coalesces them into _bulk requests and applies the
+    configured refresh policy. Successful writes are mirrored into the local
+    vector index; it is never written on its own, since nothing would replay
+    those writes to Elasticsearch (the apps refuse writes without a cluster).
+    During a reindex the written ids are recorded through versions (a
+    ProductIndex). Write statuses are tracked per process.
+    """
+
+    def __init__(self, es, index=PRODUCT_INDEX, refresh_mode=INDEX_REFRESH_MODE,
+                 refresh_interval=INDEX_REFRESH_INTERVAL, maxsize=INDEX_QUEUE_SIZE,
+                 batch_size=INDEX_QUEUE_BATCH_SIZE, linger=INDEX_QUEUE_LINGER, versions=None):
+        if refresh_mode not in REFRESH_MODES:
+            raise ValueError(f"Unknown refresh mode '{refresh_mode}', expected one of {REFRESH_MODES}")
+        self.es = es
+        self.index = index
+        self.versions = versions
+        self.refresh_mode = refresh_mode
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.linger = linger
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._statuses = OrderedDict()
+        self._status_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._dirty = False
+        self._unrefreshed = []
+        self._last_refresh = time.monotonic()
+
+    # Start the worker lazily so it is created in the serving process, not before a fork
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="indexing-queue", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _set_status(self, write_id, state, **details):
+        with self._status_lock:
+            self._statuses[write_id] = {"write_id": write_id, "state": state, **details}
+            self._statuses.move_to_end(write_id)
+            while len(self._statuses) > INDEX_STATUS_RETENTION:
+                self._statuses.popitem(last=False)
+
+    # on_done(op, state, details) is called from the worker once the write is
+    # written, searchable or failed; timeout=None blocks instead of raising QueueFullError
+    def _submit(self, op, on_done=None, timeout=INDEX_QUEUE_PUT_TIMEOUT):
+        self._ensure_started()
+        op["write_id"] = f"{os.getpid()}-{uuid.uuid4().hex}"
+        op["on_done"] = on_done
+        try:
+            self._queue.put(op, timeout=timeout)
+        except queue.Full:
+            raise QueueFullError("Indexing queue is full, retry later")
+        self._set_status(op["write_id"], "queued", id=op["id"])
+        return op["write_id"]
+
+    # Queue a full product (re)index; raises ValueError for invalid products
+    def enqueue_product(self, product_id, product, on_done=None, timeout=INDEX_QUEUE_PUT_TIMEOUT):
+        error = validateProduct(product)
+        if error:
+            raise ValueError(error)
+        return self._submit({"op": "index", "id": str(product_id), "product": product}, on_done, timeout)
+
+    # Queue a partial update of the changed fields only; product, the full merged
+    # product, is indexed instead if the document turns out not to be indexed yet
+    def enqueue_update(self, product_id, fields, product=None, on_done=None, timeout=INDEX_QUEUE_PUT_TIMEOUT):
+        if not isinstance(fields, dict) or not fields:
+            raise ValueError("No fields to update")
+        error = validateFields(fields)
+        if error:
+            raise ValueError(error)
+        return self._submit({"op": "update", "id": str(product_id), "fields": fields, "product": product},
+                            on_done, timeout)
+
+    def enqueue_delete(self, product_id, on_done=None, timeout=INDEX_QUEUE_PUT_TIMEOUT):
+        return self._submit({"op": "delete", "id": str(product_id)}, on_done, timeout)
+
+    def status(self, write_id):
+        with self._status_lock:
+            status = self._statuses.get(write_id)
+            return dict(status) if status else None
+
+    def pending(self):
+        return self._queue.qsize()
+
+    # Block until everything queued so far has been written, or the timeout passes
+    def flush(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            wait = None
+            if self.refresh_mode == "interval" and self._dirty:
+                wait = max(0.0, self._last_refresh + self.refresh_interval - time.monotonic())
+            try:
+                batch = [self._queue.get(timeout=wait)]
+            except queue.Empty:
+                batch = []
+
+            deadline = time.monotonic() + self.linger
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                if batch:
+                    try:
+                        self._write(batch)
+                    except Exception as e:
+                        self._fail_unfinished(batch, e)
+                        raise
+                self._maybe_refresh()
+            except Exception as e:
+                logger.error(f"Indexing queue worker error: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    # Later writes to the same document supersede earlier ones within a batch; a partial
+    # update is folded into the write it follows so neither change is lost
+    def _coalesce(self, batch):
+        latest = OrderedDict()
+        superseded = {}
+        for op in batch:
+            previous = latest.pop(op["id"], None)
+            if previous is not None and op["op"] == "update":
+                if previous["op"] == "delete":
+                    superseded.setdefault(previous["write_id"], []).append(op)
+                    latest[op["id"]] = previous
+                    continue
+                if previous["op"] == "index":
+                    op = {**op, "op": "index", "product": {**previous["product"], **op["fields"]}}
+                else:
+                    product = op.get("product")
+                    if product is None and previous.get("product") is not None:
+                        product = {**previous["product"], **op["fields"]}
+                    op = {**op, "fields": {**previous["fields"], **op["fields"]}, "product": product}
+            if previous is not None:
+                superseded.setdefault(op["write_id"], []).extend(
+                    [previous] + superseded.pop(previous["write_id"], [])
+                )
+            latest[op["id"]] = op
+        return list(latest.values()), superseded
+
+    def _write(self, batch):
+        ops, superseded = self._coalesce(batch)
+        self._write_ops(ops, superseded, len(batch))
+
+    # Writes of a batch that raised are failed rather than left "queued"
+    def _fail_unfinished(self, batch, error):
+        for op in batch:
+            status = self.status(op["write_id"])
+            if status and status["state"] == "queued":
+                self._finish(op, {}, "failed", error=f"Indexing queue worker error: {error}")
+
+    # A batch that fails to prepare is retried one write at a time, so one bad
+    # product fails alone
+    def _prepare(self, ops, superseded, kind, prepare, payload):
+        selected = [op for op in ops if op["op"] == kind]
+        if not selected:
+            return ops, {}
+        try:
+            prepared = prepare([op[payload] for op in selected])
+            return ops, {op["write_id"]: doc for op, doc in zip(selected, prepared)}
+        except Exception as e:
+            if len(selected) == 1:
+                logger.error(f"Error preparing queued document {selected[0]['id']}: {e}")
+                self._finish(selected[0], superseded, "failed", error=str(e))
+                return [op for op in ops if op is not selected[0]], {}
+            logger.error(f"Error preparing {len(selected)} queued documents, retrying one at a time: {e}")
+        docs = {}
+        for op in selected:
+            kept, prepared = self._prepare([op], superseded, kind, prepare, payload)
+            docs.update(prepared)
+            if not kept:
+                ops = [other for other in ops if other is not op]
+        return ops, docs
+
+    def _write_ops(self, ops, superseded, queued):
+        ops, docs = self._prepare(ops, superseded, "index", prepareDocuments, "product")
+        ops, partial = self._prepare(ops, superseded, "update", preparePartialDocuments, "fields")
+        docs.update(partial)
+        self._keep_variants_unembedded(ops, docs)
+
+        # Updates that touch no indexed field (e.g. stock) have nothing to send
+        for op in [op for op in ops if op["op"] == "update" and not docs[op["write_id"]]]:
+            self._finish(op, superseded, "searchable")
+            ops.remove(op)
+
+        actions = []
+        for op in ops:
+            if op["op"] == "index":
+                actions.append({"_op_type": "index", "_index": self.index, "_id": op["id"],
+                                "_source": docs[op["write_id"]]})
+            elif op["op"] == "update":
+                actions.append({"_op_type": "update", "_index": self.index, "_id": op["id"],
+                                "doc": docs[op["write_id"]], "retry_on_conflict": 3})
+            else:
+                actions.append({"_op_type": op["op"], "_index": self.index, "_id": op["id"]})
+        if not actions:
+            return
+
+        kwargs = {"refresh": "wait_for"} if self.refresh_mode == "wait_for" else {}
+        responses = helpers.streaming_bulk(self.es, actions, chunk_size=self.batch_size,
+                                           raise_on_error=False, raise_on_exception=False, **kwargs)
+        written = []
+        fallback = []
+        blocked = []
+        for op, (ok, item) in zip(ops, responses):
+            result = next(iter(item.values()), {})
+            error = result.get("error")
+            if ok or (op["op"] == "delete" and result.get("status") == 404):
+                written.append(op)
+                state = "searchable" if self.refresh_mode == "wait_for" else "written"
+                self._finish(op, superseded, state)
+            elif op["op"] == "update" and result.get("status") == 404 and op.get("product"):
+                # Not indexed yet: index the full product the update was made against
+                error = validateProduct(op["product"])
+                if error:
+                    self._finish(op, superseded, "failed", error=f"Product is not indexed and is invalid: {error}")
+                else:
+                    fallback.append({**op, "op": "index"})
+            elif isinstance(error, dict) and error.get("type") == "cluster_block_exception" \
+                    and op.get("blocked", 0) < INDEX_BLOCKED_RETRIES:
+                blocked.append({**op, "blocked": op.get("blocked", 0) + 1})
+            else:
+                self._finish(op, superseded, "failed", error=str(result.get("error", "Unknown bulk error")))
+
+        if self.versions is not None:
+            self.versions.record_changes([op["id"] for op in written])
+        self._apply_local(written, docs)
+        if written:
+            write_generation.bump()
+        if written and self.refresh_mode == "interval":
+            self._dirty = True
+        logger.info(f"Indexing queue wrote {len(written)} of {len(actions)} actions ({queued} queued writes)")
+        if fallback:
+            self._write_ops(fallback, superseded, len(fallback))
+        if blocked:
+            # The old index is write-blocked while a reindex cuts over; the retry goes to the new one
+            time.sleep(INDEX_BLOCKED_RETRY_DELAY)
+            self._write_ops(blocked, superseded, len(blocked))
+
+    # Variants are stored without a vector (see duplicateDetection.py), so a description
+    # edit re-encodes them for nothing; drop the vector before it brings them back into kNN
+    def _keep_variants_unembedded(self, ops, docs):
+        updates = {op["id"]: op for op in ops if op["op"] == "update" and "DescriptionVector" in docs[op["write_id"]]}
+        if not updates:
+            return
+        try:
+            found = self.es.mget(index=self.index, ids=list(updates), _source_includes=["variantOf"])["docs"]
+        except Exception as e:
+            logger.error(f"Error checking updated products for variants: {e}")
+            return
+        for doc in found:
+            if doc.get("found") and doc["_source"].get("variantOf"):
+                docs[updates[doc["_id"]]["write_id"]].pop("DescriptionVector", None)
+
+    # Updates of products the local index does not hold are skipped
+    def _apply_local(self, ops, docs):
+        if local_index is None:
+            return
+        try:
+            local_index.upsert_many(
+                (op["id"], docs[op["write_id"]]["DescriptionVector"], docs[op["write_id"]])
+                for op in ops if op["op"] == "index" and "DescriptionVector" in docs[op["write_id"]]
+            )
+            for op in ops:
+                # Variants have no vector and are not served from the local index
+                if op["op"] == "delete" or (op["op"] == "index" and "DescriptionVector" not in docs[op["write_id"]]):
+                    local_index.delete(op["id"])
+                elif op["op"] == "update":
+                    fields = {key: value for key, value in docs[op["write_id"]].items() if key != "DescriptionVector"}
+                    local_index.update(op["id"], fields, docs[op["write_id"]].get("DescriptionVector"))
+        except Exception as e:
+            logger.error(f"Error updating local vector index: {e}")
+
+    def _finish(self, op, superseded, state, **details):
+        for done in [op] + superseded.get(op["write_id"], []):
+            self._set_status(done["write_id"], state, id=op["id"], **details)
+            if state == "written" and self.refresh_mode == "interval":
+                self._unrefreshed.append(done["write_id"])
+            if done["on_done"] is not None:
+                try:
+                    done["on_done"](done, state, details)
+                except Exception as e:
+                    logger.error(f"Indexing queue callback error: {e}")
+
+    def _maybe_refresh(self):
+        if not self._dirty or time.monotonic() - self._last_refresh < self.refresh_interval:
+            return
+        # Stamp the attempt first so a failing refresh is retried on the interval, not in a tight loop
+        self._last_refresh = time.monotonic()
+        self.es.indices.refresh(index=self.index)
+        self._dirty = False
+        write_generation.bump()  # Results cached between the write and this refresh are stale too
+        with self._status_lock:
+            for write_id in self._unrefreshed:
+                status = self._statuses.get(write_id)
+                if status and status["state"] == "written":
+                    status["state"] = "searchable"
+        self._unrefreshed = []
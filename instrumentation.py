@@ -0,0 +1,278 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this are logged with a per-stage breakdown (0 = off)
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+# Fraction of request payloads logged, and the most characters logged of each
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0.01'))
+PAYLOAD_LOG_MAX_CHARS = int(os.getenv('PAYLOAD_LOG_MAX_CHARS', '512'))
+
+METRICS_PREFIX = "biashara"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Stage timings of the request being handled in this thread (or task), None outside requests
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram per label set, in seconds."""
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *values):
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {values: {**data, "buckets": list(data["buckets"])} for values, data in self._series.items()}
+        for values, data in sorted(series.items()):
+            labels = _labels(self.labels, values)
+            for bound, count in zip(self.buckets, data["buckets"]):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {data["count"]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {data['sum']:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {data['count']}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter per label set."""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{{{_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+class Metrics:
+    """
+    Request and stage metrics of this process, rendered in the Prometheus text
+    format. Under gunicorn each worker reports its own series; scrape every
+    worker or aggregate them with a pid-per-target setup.
+    """
+
+    def __init__(self):
+        self.requests = Counter(f"{METRICS_PREFIX}_http_requests_total", "HTTP requests handled",
+                                ["method", "route", "status"])
+        self.request_seconds = Histogram(f"{METRICS_PREFIX}_http_request_duration_seconds",
+                                         "HTTP request latency", ["method", "route"])
+        self.slow_requests = Counter(f"{METRICS_PREFIX}_http_slow_requests_total",
+                                     "Requests slower than SLOW_REQUEST_MS", ["method", "route"])
+        self.stage_seconds = Histogram(f"{METRICS_PREFIX}_stage_duration_seconds",
+                                       "Time spent in encode, Elasticsearch, Firestore and generation stages",
+                                       ["stage"])
+        self.stage_errors = Counter(f"{METRICS_PREFIX}_stage_errors_total", "Stages that raised", ["stage"])
+        self._gauges = []
+
+    # Export the numeric top-level values of a stats() dict as gauges on every scrape
+    def register_stats(self, name, stats):
+        self._gauges.append((name, stats))
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.request_seconds, self.slow_requests, self.stage_seconds, self.stage_errors):
+            lines.extend(metric.render())
+        for name, stats in self._gauges:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"Error collecting {name} stats for /metrics: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {METRICS_PREFIX}_{name}_{key} gauge")
+                    lines.append(f"{METRICS_PREFIX}_{name}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# Time a block as a named stage: always into the stage histogram, and into the
+# breakdown of the current request when called from a request handler
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.stage_errors.inc(name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.stage_seconds.observe(elapsed, name)
+        stages = _request_stages.get()
+        if stages is not None:
+            total, count = stages.get(name, (0.0, 0))
+            stages[name] = (total + elapsed, count + 1)
+
+
+def _es_operation(method, target):
+    segments = target.split("?", 1)[0].strip("/").split("/")
+    return next((segment[1:] for segment in reversed(segments) if segment.startswith("_")), method.lower())
+
+
+# Every Elasticsearch API call goes through the client's transport; timing it there
+# covers all call sites, including helpers.bulk and clients made with .options().
+# Works for Elasticsearch and AsyncElasticsearch.
+def instrument_elasticsearch(es):
+    transport = getattr(es, "transport", None)
+    perform_request = getattr(transport, "perform_request", None)
+    if perform_request is None:
+        return es
+
+    if asyncio.iscoroutinefunction(perform_request):
+        async def timed_perform_request(method, target, *args, **kwargs):
+            with stage(f"elasticsearch.{_es_operation(method, target)}"):
+                return await perform_request(method, target, *args, **kwargs)
+    else:
+        def timed_perform_request(method, target, *args, **kwargs):
+            with stage(f"elasticsearch.{_es_operation(method, target)}"):
+                return perform_request(method, target, *args, **kwargs)
+
+    transport.perform_request = timed_perform_request
+    return es
+
+
+# Log a request payload for a sample of requests only, truncated; serializing and
+# logging every full payload costs more than most handlers
+def log_payload(log, message, payload):
+    if PAYLOAD_LOG_SAMPLE_RATE <= 0 or random.random() >= PAYLOAD_LOG_SAMPLE_RATE:
+        return
+    if not log.isEnabledFor(logging.INFO):
+        return
+    text = json.dumps(payload, default=str, ensure_ascii=False)
+    if len(text) > PAYLOAD_LOG_MAX_CHARS:
+        text = f"{text[:PAYLOAD_LOG_MAX_CHARS]}... ({len(text)} chars)"
+    log.info(f"{message} (sampled): {text}")
+
+
+def format_stages(stages, total_seconds):
+    parts = [f"{name}={seconds * 1000:.1f}ms" + (f" x{count}" if count > 1 else "")
+             for name, (seconds, count) in sorted(stages.items(), key=lambda item: -item[1][0])]
+    other = total_seconds - sum(seconds for seconds, _ in stages.values())
+    parts.append(f"other={max(other, 0.0) * 1000:.1f}ms")
+    return ", ".join(parts)
+
+
+def start_request():
+    _request_stages.set({})
+
+
+def record_request(method, route, path, status, elapsed):
+    metrics.requests.inc(method, route, status)
+    metrics.request_seconds.observe(elapsed, method, route)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        metrics.slow_requests.inc(method, route)
+        logger.warning(f"Slow request {method} {path} took {elapsed * 1000:.1f}ms "
+                       f"(status {status}): {format_stages(_request_stages.get() or {}, elapsed)}")
+
+
+# Hook request timing, the stage breakdown and the slow-request log into a Flask app
+def instrument_app(app):
+    from flask import g, request
+    from flask.json.provider import DefaultJSONProvider
+
+    class TimedJSONProvider(DefaultJSONProvider):
+        """Times jsonify() response serialization as the "serialize" stage."""
+
+        def response(self, *args, **kwargs):
+            with stage("serialize"):
+                return super().response(*args, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def _start_request_timer():
+        g.instrumentation_started = time.perf_counter()
+        start_request()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop("instrumentation_started", None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        record_request(request.method, route, request.path, response.status_code, time.perf_counter() - started)
+        return response
+
+    @app.teardown_request
+    def _clear_request_stages(exc):
+        _request_stages.set(None)
+
+    return app
+
+
+class ASGIInstrumentation:
+    """
+    ASGI middleware with the request metrics and slow-request log of
+    instrument_app. Routes are labelled by their path template; streamed
+    responses are timed until the last chunk is sent.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = {route.endpoint: route.path for route in routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        start_request()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self.routes.get(scope.get("endpoint"), "unmatched")
+            record_request(scope["method"], route, scope["path"], status, time.perf_counter() - started)
@@ -0,0 +1,460 @@
+"""
+In-process vector index used as a serving tier for /search and
+/recommendations. Vectors live in a memory-mapped float32 file shared by all
+workers on the host, alongside an append-only JSON log of id/row/_source
+records. Small catalogues are searched exactly; larger ones build an IVF
+coarse quantizer in the background.
+
+Updates and deletes leave superseded records in the log and dead rows in the
+vector file. Once they make up LOCAL_COMPACT_DEAD_RATIO of the log, the worker
+that wrote last rewrites both files with the live products only; the others
+reload when they see the new log. The index holds at most LOCAL_INDEX_MAX_DOCS
+products. While Elasticsearch is up, queries are served from it only after a
+completed --sync, and only while it holds at most LOCAL_SEARCH_MAX_DOCS
+(0, the default, never): otherwise it holds only this host's own writes.
+
+    python localVectorIndex.py --sync       # copy the product index from Elasticsearch
+    python localVectorIndex.py --compact    # drop dead rows and records now
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from indexMapping import PRODUCT_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Local index configuration
+LOCAL_INDEX_ENABLED = os.getenv('LOCAL_INDEX_ENABLED', '1') == '1'
+LOCAL_INDEX_DIR = os.getenv(
+    'LOCAL_INDEX_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'local_index')
+)
+# Serve queries locally, even with Elasticsearch up, while the catalogue is at most this big
+LOCAL_SEARCH_MAX_DOCS = int(os.getenv('LOCAL_SEARCH_MAX_DOCS', '0'))
+# Products beyond this many are not added (the vectors and sources of each are kept per worker)
+LOCAL_INDEX_MAX_DOCS = int(os.getenv('LOCAL_INDEX_MAX_DOCS', '200000'))
+LOCAL_COMPACT_DEAD_RATIO = float(os.getenv('LOCAL_COMPACT_DEAD_RATIO', '0.5'))
+LOCAL_COMPACT_MIN_RECORDS = int(os.getenv('LOCAL_COMPACT_MIN_RECORDS', '1000'))
+LOCAL_IVF_MIN_DOCS = int(os.getenv('LOCAL_IVF_MIN_DOCS', '50000'))
+LOCAL_IVF_NPROBE = int(os.getenv('LOCAL_IVF_NPROBE', '8'))
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class IVFIndex:
+    """Inverted file over k-means centroids; searches only the nprobe closest lists."""
+
+    def __init__(self, centroids, trained_rows):
+        self.centroids = centroids
+        self.trained_rows = trained_rows
+        self.lists = [[] for _ in range(len(centroids))]
+
+    @classmethod
+    def train(cls, matrix, alive, iterations=10, sample_size=20000, seed=0):
+        rows = np.flatnonzero(alive)
+        nlist = int(min(4096, max(1, np.sqrt(len(rows)))))
+        rng = np.random.default_rng(seed)
+        sample = matrix[rng.choice(rows, size=min(sample_size, len(rows)), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+
+        ivf = cls(centroids, len(rows))
+        for start in range(0, len(rows), 10000):
+            chunk = rows[start:start + 10000]
+            for row, c in zip(chunk, np.argmax(matrix[chunk] @ centroids.T, axis=1)):
+                ivf.lists[c].append(int(row))
+        return ivf
+
+    def add(self, row, vector):
+        self.lists[int(np.argmax(self.centroids @ vector))].append(row)
+
+    def candidates(self, query, nprobe):
+        probes = np.argsort(-(self.centroids @ query))[:nprobe]
+        rows = [row for c in probes for row in self.lists[c]]
+        return np.unique(np.asarray(rows, dtype=np.int64))
+
+
+class LocalVectorIndex:
+    def __init__(self, directory, dim, ivf_min_docs=LOCAL_IVF_MIN_DOCS, nprobe=LOCAL_IVF_NPROBE,
+                 max_docs=LOCAL_INDEX_MAX_DOCS, compact_ratio=LOCAL_COMPACT_DEAD_RATIO,
+                 compact_min_records=LOCAL_COMPACT_MIN_RECORDS):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.ivf_min_docs = ivf_min_docs
+        self.nprobe = nprobe
+        self.max_docs = max_docs
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.log_path = os.path.join(directory, "log.jsonl")
+        self.lock_path = os.path.join(directory, "lock")
+        self.synced_path = os.path.join(directory, "synced")  # Written by a completed sync_from_elasticsearch
+        for path in (self.vectors_path, self.log_path, self.lock_path):
+            open(path, "ab").close()
+
+        self._lock = threading.RLock()
+        self._file_locked = 0   # depth of _file_lock in this process, guarded by _lock
+        self._generation = 0    # bumped by _reset, so an IVF trained on the old rows is discarded
+        self._ivf_building = False
+        self._reset()
+        with self._lock:
+            self._sync()
+
+    # Forget everything read from the files, so the next _sync replays the log from the start
+    def _reset(self):
+        self._ids = []          # row -> product id
+        self._rows = {}         # product id -> row
+        self._sources = {}      # product id -> _source without the vector
+        self._alive = np.zeros(0, dtype=bool)
+        self._log_offset = 0
+        self._log_records = 0   # records replayed, live or superseded
+        self._log_inode = os.stat(self.log_path).st_ino
+        self._vectors_inode = os.stat(self.vectors_path).st_ino
+        self._mmap = None
+        self._ivf = None
+        self._generation += 1
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Reentrant, since _sync takes it and writers call _sync with it held
+    @contextmanager
+    def _file_lock(self):
+        if self._file_locked:
+            self._file_locked += 1
+            try:
+                yield
+            finally:
+                self._file_locked -= 1
+            return
+        with open(self.lock_path, "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._file_locked = 1
+            try:
+                yield
+            finally:
+                self._file_locked = 0
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _matrix(self):
+        st = os.stat(self.vectors_path)
+        if st.st_ino != self._vectors_inode:
+            return self._mmap  # Compacted since the last _sync, which reloads both files
+        rows = st.st_size // self.row_bytes
+        if self._mmap is None or self._mmap.shape[0] != rows:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+        return self._mmap
+
+    # Replay log records written by this or any other worker since the last call
+    def _sync(self):
+        st = os.stat(self.log_path)
+        if st.st_ino != self._log_inode:
+            # Another worker compacted the index; wait for it to finish swapping the files
+            with self._file_lock():
+                self._reset()
+                self._replay_log()
+            return
+        if st.st_size <= self._log_offset:
+            return
+        self._replay_log()
+
+    def _replay_log(self):
+        size = os.path.getsize(self.log_path)
+        if size <= self._log_offset:
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read(size - self._log_offset)
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._replay(json.loads(line))
+        self._log_offset += end
+
+    def _replay(self, record):
+        self._log_records += 1
+        product_id = record["id"]
+        if record["op"] == "delete":
+            row = self._rows.pop(product_id, None)
+            if row is not None:
+                self._alive[row] = False
+            self._sources.pop(product_id, None)
+            return
+
+        row = record["row"]
+        previous = self._rows.get(product_id)
+        if previous is not None and previous != row:
+            self._alive[previous] = False
+        if row >= len(self._ids):
+            self._ids.extend([None] * (row + 1 - len(self._ids)))
+        if row >= len(self._alive):
+            self._alive = np.concatenate([self._alive, np.zeros(max(row + 1, 2 * len(self._alive)) - len(self._alive), dtype=bool)])
+        self._ids[row] = product_id
+        self._rows[product_id] = row
+        self._alive[row] = True
+        self._sources[product_id] = record["source"]
+        if self._ivf is not None:
+            self._ivf.add(row, np.array(self._matrix()[row]))
+
+    def _append(self, records):
+        data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+        self._log_offset += len(data)
+
+    # items: iterable of (product_id, vector, source); new products past max_docs are skipped
+    def upsert_many(self, items):
+        with self._lock, self._file_lock():
+            self._sync()
+            records = []
+            added = skipped = 0
+            with open(self.vectors_path, "r+b") as f:
+                for product_id, vector, source in items:
+                    product_id = str(product_id)
+                    if product_id not in self._rows:
+                        if len(self._rows) + added >= self.max_docs:
+                            skipped += 1
+                            continue
+                        added += 1
+                    row = self._rows.get(product_id, len(self._ids))
+                    f.seek(row * self.row_bytes)
+                    f.write(_normalize(vector).reshape(-1).tobytes())
+                    record = {"op": "upsert", "id": product_id, "row": row,
+                              "source": {key: value for key, value in source.items() if key != "DescriptionVector"}}
+                    records.append(record)
+                    self._ids.extend([None] * (row + 1 - len(self._ids)))
+                    self._ids[row] = product_id
+                f.flush()
+            self._mmap = None
+            for record in records:
+                self._replay(record)
+            self._append(records)
+            self._maybe_compact()
+        if skipped:
+            logger.warning(f"Local index is full ({self.max_docs} products), skipped {skipped} new products")
+
+    def upsert(self, product_id, vector, source):
+        self.upsert_many([(product_id, vector, source)])
+
+    # Merge changed fields into a stored product, rewriting its vector only when one is
+    # given; returns False when the product is not in the index
+    def update(self, product_id, fields, vector=None):
+        product_id = str(product_id)
+        with self._lock, self._file_lock():
+            self._sync()
+            row = self._rows.get(product_id)
+            if row is None:
+                return False
+            if vector is not None:
+                with open(self.vectors_path, "r+b") as f:
+                    f.seek(row * self.row_bytes)
+                    f.write(_normalize(vector).reshape(-1).tobytes())
+                self._mmap = None
+            record = {"op": "upsert", "id": product_id, "row": row,
+                      "source": {**self._sources[product_id], **fields}}
+            self._replay(record)
+            self._append([record])
+            self._maybe_compact()
+            return True
+
+    def delete(self, product_id):
+        with self._lock, self._file_lock():
+            self._sync()
+            record = {"op": "delete", "id": str(product_id)}
+            self._replay(record)
+            self._append([record])
+            self._maybe_compact()
+
+    # Called by writers, with both locks held
+    def _maybe_compact(self):
+        dead = self._log_records - len(self._rows)
+        if self._log_records >= self.compact_min_records and dead > self.compact_ratio * self._log_records:
+            self._compact()
+
+    # Rewrite the vector file and the log with the live products only, packed
+    # into rows 0..n-1, then swap them in; returns the number of products kept
+    def compact(self):
+        with self._lock, self._file_lock():
+            self._sync()
+            return self._compact()
+
+    def _compact(self):
+        matrix = self._matrix()
+        live = [(product_id, row) for row, product_id in enumerate(self._ids)
+                if product_id is not None and self._rows.get(product_id) == row]
+        vectors_tmp, log_tmp = self.vectors_path + ".compact", self.log_path + ".compact"
+        with open(vectors_tmp, "wb") as vectors, open(log_tmp, "wb") as log:
+            for start in range(0, len(live), 10000):
+                chunk = live[start:start + 10000]
+                vectors.write(np.ascontiguousarray(matrix[[row for _, row in chunk]]).tobytes())
+                log.write("".join(json.dumps({"op": "upsert", "id": product_id, "row": start + i,
+                                              "source": self._sources[product_id]}) + "\n"
+                                  for i, (product_id, _) in enumerate(chunk)).encode("utf-8"))
+        # The log first: a worker that sees the new log waits for the file lock, so
+        # it never maps the new vectors with the old rows
+        dropped = self._log_records - len(live)
+        os.replace(log_tmp, self.log_path)
+        os.replace(vectors_tmp, self.vectors_path)
+        self._reset()
+        self._replay_log()
+        logger.info(f"Compacted the local index to {len(live)} products, dropping {dropped} dead records")
+        return len(live)
+
+    def ids(self):
+        with self._lock:
+            self._sync()
+            return list(self._rows)
+
+    def get(self, product_id):
+        with self._lock:
+            self._sync()
+            return self._sources.get(str(product_id))
+
+    # Only a copy of the whole catalogue may answer queries while Elasticsearch is up
+    def serves_queries(self):
+        return 0 < len(self) <= LOCAL_SEARCH_MAX_DOCS and os.path.exists(self.synced_path)
+
+    def mark_synced(self, count):
+        with open(self.synced_path, "w") as f:
+            json.dump({"documents": count, "synced_at": time.time()}, f)
+
+    def _maybe_build_ivf(self, matrix, live):
+        if live < self.ivf_min_docs or self._ivf_building:
+            return
+        if self._ivf is not None and live < 2 * self._ivf.trained_rows:
+            return
+        self._ivf_building = True
+        alive = self._alive[:matrix.shape[0]].copy()
+        generation = self._generation
+
+        def build():
+            try:
+                ivf = IVFIndex.train(np.asarray(matrix), alive)
+                with self._lock:
+                    if generation != self._generation:
+                        return  # Compacted while training: the rows have moved
+                    # Rows added while training are not in the lists yet
+                    for row in np.flatnonzero(self._alive[len(alive):]) + len(alive):
+                        ivf.add(int(row), np.array(self._matrix()[row]))
+                    self._ivf = ivf
+                logger.info(f"Built local IVF index with {len(ivf.centroids)} lists over {ivf.trained_rows} vectors")
+            except Exception as e:
+                logger.error(f"Error building local IVF index: {e}")
+            finally:
+                self._ivf_building = False
+
+        threading.Thread(target=build, name="local-ivf-build", daemon=True).start()
+
+    # Returns [{"id", "score", "source"}] ordered by cosine similarity
+    def search(self, vector, k=10):
+        with self._lock:
+            self._sync()
+            matrix = self._matrix()
+            if matrix is None or not self._rows:
+                return []
+            n = min(len(self._ids), matrix.shape[0])
+            query = _normalize(vector).reshape(-1)
+
+            self._maybe_build_ivf(matrix, len(self._rows))
+            if self._ivf is not None:
+                rows = self._ivf.candidates(query, self.nprobe)
+                rows = rows[rows < n]
+            else:
+                rows = np.arange(n)
+            rows = rows[self._alive[rows]]
+            if not len(rows):
+                return []
+
+            scores = matrix[rows] @ query if self._ivf is not None else (matrix[:n] @ query)[rows]
+            k = min(k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                {"id": self._ids[rows[i]], "score": float(scores[i]), "source": self._sources[self._ids[rows[i]]]}
+                for i in top
+            ]
+
+    # Same shape as the _source list /search returns from Elasticsearch
+    def search_sources(self, vector, k, fields, with_id=False):
+        results = []
+        for hit in self.search(vector, k):
+            source = {field: hit["source"][field] for field in fields if field in hit["source"]}
+            results.append({"id": hit["id"], **source} if with_id else source)
+        return results
+
+
+# Function to copy every document of an Elasticsearch index into the local index,
+# dropping the products that are no longer in it
+def sync_from_elasticsearch(es, local, index=PRODUCT_INDEX, chunk_size=1000):
+    from elasticsearch import helpers
+
+    batch = []
+    total = 0
+    stale = set(local.ids())
+    for hit in helpers.scan(es, index=index, query={"query": {"match_all": {}}}, size=chunk_size):
+        source = hit["_source"]
+        if "DescriptionVector" not in source:
+            continue
+        stale.discard(hit["_id"])
+        batch.append((hit["_id"], source["DescriptionVector"], source))
+        if len(batch) >= chunk_size:
+            local.upsert_many(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        local.upsert_many(batch)
+        total += len(batch)
+    for product_id in stale:
+        local.delete(product_id)
+    local.mark_synced(total)
+    logger.info(f"Synced {total} documents from '{index}' into the local index")
+    return total
+
+
+def _create_local_index():
+    if not LOCAL_INDEX_ENABLED:
+        return None
+    from vectorProfile import profile
+    try:
+        return LocalVectorIndex(os.path.join(LOCAL_INDEX_DIR, f"{profile.index_type}-{profile.dims}"), profile.dims)
+    except OSError as e:
+        logger.error(f"Local vector index disabled: {e}")
+        return None
+
+
+local_index = _create_local_index()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the local vector index")
+    parser.add_argument("--sync", action="store_true", help="Copy all documents from Elasticsearch")
+    parser.add_argument("--es-url", default=os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200'))
+    parser.add_argument("--index", default=PRODUCT_INDEX)
+    parser.add_argument("--compact", action="store_true", help="Drop deleted and superseded products")
+    args = parser.parse_args()
+
+    if args.sync and local_index is not None:
+        from elasticsearch import Elasticsearch
+        sync_from_elasticsearch(Elasticsearch(args.es_url), local_index, args.index)
+    if args.compact and local_index is not None:
+        local_index.compact()
+    print(f"Local index holds {len(local_index) if local_index is not None else 0} products")
@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Warm models in the background as soon as a worker starts (0 = load on first use only)
+MODEL_WARMUP = os.getenv('MODEL_WARMUP', '1') == '1'
+
+_PROCESS_STARTED = time.time()
+
+
+# Resident and shared memory of this process in MB, from /proc when available
+def memory_usage():
+    try:
+        with open("/proc/self/statm") as f:
+            fields = f.read().split()
+        page_mb = os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        return {"rss_mb": round(int(fields[1]) * page_mb, 1), "shared_mb": round(int(fields[2]) * page_mb, 1)}
+    except (OSError, ValueError, IndexError):
+        import resource
+        return {"rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "shared_mb": None}
+
+
+class ModelRegistry:
+    """
+    Named model loaders that run on first use. Loading before gunicorn forks
+    (see gunicorn.conf.py) lets every worker share the weights copy-on-write;
+    status() backs the /ready endpoints.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._status = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+            self._status.setdefault(name, {"state": "cold"})
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._locks[name]:
+            if name in self._models:
+                return self._models[name]
+            self._status[name] = {"state": "loading"}
+            before = memory_usage()["rss_mb"]
+            started = time.perf_counter()
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                self._status[name] = {"state": "failed", "error": str(e)}
+                logger.error(f"Loading model '{name}' failed: {e}")
+                raise
+            after = memory_usage()["rss_mb"]
+            self._models[name] = model
+            self._status[name] = {
+                "state": "ready",
+                "load_seconds": round(time.perf_counter() - started, 2),
+                "rss_delta_mb": round(after - before, 1),
+                "pid": os.getpid(),
+            }
+            logger.info(f"Model '{name}' loaded in {self._status[name]['load_seconds']}s (+{self._status[name]['rss_delta_mb']} MB)")
+            return model
+
+    def is_ready(self, name):
+        return self._status.get(name, {}).get("state") == "ready"
+
+    def failed(self, name):
+        return self._status.get(name, {}).get("state") == "failed"
+
+    # Load models now, e.g. in the gunicorn master before workers fork
+    def preload(self, names=None):
+        for name in names or list(self._loaders):
+            try:
+                self.get(name)
+            except Exception:
+                pass
+
+    def warm_up_async(self, names=None):
+        if MODEL_WARMUP:
+            threading.Thread(target=self.preload, args=(names,), name="model-warmup", daemon=True).start()
+
+    def status(self):
+        with self._lock:
+            models = {name: dict(status) for name, status in self._status.items()}
+        return {
+            "ready": all(status["state"] == "ready" for status in models.values()),
+            "pid": os.getpid(),
+            "uptime_seconds": round(time.time() - _PROCESS_STARTED, 1),
+            "models": models,
+            **memory_usage(),
+        }
+
+
+class LazyModel:
+    """Stand-in that resolves to the registered model on first attribute access."""
+
+    def __init__(self, name, models=None):
+        self._name = name
+        self._registry = models or registry
+
+    def __getattr__(self, attribute):
+        return getattr(self._registry.get(self._name), attribute)
+
+    def __call__(self, *args, **kwargs):
+        return self._registry.get(self._name)(*args, **kwargs)
+
+
+registry = ModelRegistry()
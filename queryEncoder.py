@@ -0,0 +1,113 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from documentPreparation import model
+from instrumentation import stage
+from vectorProfile import to_index_vector
+
+logger = logging.getLogger(__name__)
+
+# Micro-batching configuration
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv('QUERY_BATCH_MAX_WAIT_MS', '5'))
+QUERY_BATCH_MAX_SIZE = int(os.getenv('QUERY_BATCH_MAX_SIZE', '32'))
+
+
+class MicroBatchEncoder:
+    """
+    Coalesces concurrent encode requests: waits up to max_wait_ms (or until
+    max_batch strings are pending), runs one batched encode and hands each
+    caller its own vector, passed through transform if one is given.
+    """
+
+    def __init__(self, encode, max_wait_ms=QUERY_BATCH_MAX_WAIT_MS, max_batch=QUERY_BATCH_MAX_SIZE, transform=None):
+        self._encode = encode
+        self._transform = transform
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="query-encoder", daemon=True)
+            self._thread.start()
+
+    def submit(self, text):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    # Blocking helper with the same shape as model.encode(text); the wait, batching
+    # included, is the caller's "encode.query" stage
+    def encode(self, text, timeout=None):
+        with stage("encode.query"):
+            return self.submit(text).result(timeout)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        # Identical concurrent queries are encoded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = self._encode(texts, batch_size=len(texts))
+        except Exception as e:
+            logger.error(f"Error encoding query batch: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        if self._transform is not None:
+            vectors = [self._transform(vector) for vector in vectors]
+        by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            future.set_result(by_text[text])
+        self.batches += 1
+        self.items += len(batch)
+
+
+# Function to encode several queries at once outside the micro-batcher
+def encode_queries(queries):
+    with stage("encode"):
+        vectors = model.encode(queries, batch_size=QUERY_BATCH_MAX_SIZE)
+    return [to_index_vector(vector) for vector in vectors]
+
+
+def _encode_batch(texts, batch_size):
+    with stage("encode"):
+        return model.encode(texts, batch_size=batch_size)
+
+
+# Query vectors come back truncated/quantized to match the index
+query_encoder = MicroBatchEncoder(_encode_batch, transform=to_index_vector)
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from embeddingCache import normalize_text
+from indexGeneration import write_generation
+
+logger = logging.getLogger(__name__)
+
+# Result cache configuration: "memory" (per process), "redis" (any Redis-compatible
+# server, shared by all workers) or "none"
+RESULT_CACHE_BACKEND = os.getenv('RESULT_CACHE_BACKEND', 'memory')
+RESULT_CACHE_REDIS_URL = os.getenv('RESULT_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '60'))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '10000'))
+
+
+def normalize_query(text):
+    return normalize_text(text).lower()
+
+
+class MemoryBackend:
+    """Size-bounded LRU of JSON-able values with a per-entry TTL."""
+
+    def __init__(self, capacity=RESULT_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """
+    Values stored as JSON with an expiry; size is bounded by the server's
+    maxmemory with an allkeys-lru policy. Redis errors count as misses.
+    """
+
+    def __init__(self, url=RESULT_CACHE_REDIS_URL, prefix="results:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.error(f"Result cache read failed: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000))
+        except Exception as e:
+            logger.error(f"Result cache write failed: {e}")
+
+    def size(self):
+        return None
+
+
+class ResultCache:
+    """
+    Caches endpoint results under a key built from the request parts and the
+    index write generation. A write anywhere moves the generation on, so
+    older entries are never read again and simply age out.
+    """
+
+    def __init__(self, backend, generation=write_generation, ttl=RESULT_CACHE_TTL):
+        self.backend = backend
+        self.generation = generation
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def _key(self, kind, generation, parts):
+        digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return f"{kind}:{generation}:{digest}"
+
+    def _count(self, kind, outcome):
+        with self._lock:
+            counters = self._counters.setdefault(kind, {"hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    # Key and cached value for these parts; no key when caching is off or the
+    # generation is unknown, so freshness cannot be checked
+    def _lookup(self, kind, parts):
+        if self.backend is None:
+            return None, None
+        generation = self.generation.current()
+        if generation < 0:
+            return None, None
+        key = self._key(kind, generation, parts)
+        value = self.backend.get(key)
+        self._count(kind, "hits" if value is not None else "misses")
+        return key, value
+
+    # Return the cached value for these parts, or compute, store and return it.
+    # compute() exceptions propagate and nothing is stored.
+    def get_or_compute(self, kind, compute, **parts):
+        key, value = self._lookup(kind, parts)
+        if value is not None:
+            return value
+        value = compute()
+        # Keyed by the generation read before computing: a write in between makes it unreachable
+        if key is not None:
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    # The same for async servers; compute is a coroutine function
+    async def get_or_compute_async(self, kind, compute, **parts):
+        key, value = self._lookup(kind, parts)
+        if value is not None:
+            return value
+        value = await compute()
+        if key is not None:
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def stats(self):
+        with self._lock:
+            kinds = {kind: dict(counters) for kind, counters in self._counters.items()}
+        for counters in kinds.values():
+            lookups = counters["hits"] + counters["misses"]
+            counters["hit_rate"] = counters["hits"] / lookups if lookups else 0.0
+        hits = sum(counters["hits"] for counters in kinds.values())
+        lookups = hits + sum(counters["misses"] for counters in kinds.values())
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "entries": self.backend.size() if self.backend is not None else 0,
+            "generation": self.generation.current(),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "kinds": kinds,
+        }
+
+
+def _create_result_cache():
+    backend = None
+    if RESULT_CACHE_BACKEND == "memory":
+        backend = MemoryBackend()
+    elif RESULT_CACHE_BACKEND == "redis":
+        try:
+            backend = RedisBackend()
+        except ImportError as e:
+            logger.error(f"Redis result cache unavailable, caching in process instead: {e}")
+            backend = MemoryBackend()
+    elif RESULT_CACHE_BACKEND != "none":
+        raise ValueError(f"Unknown RESULT_CACHE_BACKEND '{RESULT_CACHE_BACKEND}', expected memory, redis or none")
+    return ResultCache(backend)
+
+
+result_cache = _create_result_cache()
@@ -0,0 +1,345 @@
+"""
+Write-behind log of the queries users search for, kept in Firestore under
+searchHistory/{userId}/searches.
+
+Handlers call record(), which only puts the event on an in-process queue. A
+background flusher drains it every SEARCH_HISTORY_FLUSH_INTERVAL seconds and
+writes the events in batch commits, sorted by user so a batch touches as few
+users' histories as possible. A commit that fails or takes longer than
+SEARCH_HISTORY_COMMIT_TIMEOUT sends its events to a spill file in
+SEARCH_HISTORY_SPILL_DIR instead, and for SEARCH_HISTORY_RETRY_INTERVAL the
+flusher spills without trying Firestore; spill files are replayed once
+commits succeed again. A worker holds an flock on its spill file, and on the
+file it is replaying, for as long as it has them open: other workers (also in
+other containers sharing the directory) only claim files they can lock, i.e.
+those of exited workers. Events carry their document id, so replaying a
+commit that did land is harmless.
+
+Each history is capped at SEARCH_HISTORY_MAX_ENTRIES. The flusher trims a
+user after every SEARCH_HISTORY_COMPACT_EVERY events it wrote for them, and
+the same compaction runs over every user from the command line:
+
+    python searchHistory.py --keep 100
+"""
+import argparse
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from firebase_admin import firestore
+
+from instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+# Search history configuration
+SEARCH_HISTORY_QUEUE_SIZE = int(os.getenv('SEARCH_HISTORY_QUEUE_SIZE', '10000'))
+SEARCH_HISTORY_FLUSH_INTERVAL = float(os.getenv('SEARCH_HISTORY_FLUSH_INTERVAL', '2'))
+SEARCH_HISTORY_COMMIT_TIMEOUT = float(os.getenv('SEARCH_HISTORY_COMMIT_TIMEOUT', '5'))
+SEARCH_HISTORY_RETRY_INTERVAL = float(os.getenv('SEARCH_HISTORY_RETRY_INTERVAL', '30'))
+SEARCH_HISTORY_MAX_ENTRIES = int(os.getenv('SEARCH_HISTORY_MAX_ENTRIES', '100'))
+SEARCH_HISTORY_COMPACT_EVERY = int(os.getenv('SEARCH_HISTORY_COMPACT_EVERY', '20'))
+SEARCH_HISTORY_TRACKED_USERS = int(os.getenv('SEARCH_HISTORY_TRACKED_USERS', '10000'))
+SEARCH_HISTORY_SPILL_DIR = os.getenv(
+    'SEARCH_HISTORY_SPILL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'search_history')
+)
+HISTORY_COLLECTION = 'searchHistory'
+
+FIRESTORE_BATCH_LIMIT = 500
+
+
+def _searches(db, user_id):
+    return db.collection(HISTORY_COLLECTION).document(user_id).collection('searches')
+
+
+# Function to delete all but the `keep` most recent searches of a user; returns the number deleted
+def compact_user(db, user_id, keep=SEARCH_HISTORY_MAX_ENTRIES):
+    docs = (_searches(db, user_id).order_by('timestamp', direction=firestore.Query.DESCENDING)
+            .offset(keep).stream())
+    deleted = 0
+    batch, pending = db.batch(), 0
+    for doc in docs:
+        batch.delete(doc.reference)
+        pending += 1
+        if pending == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            deleted += pending
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+        deleted += pending
+    return deleted
+
+
+# Function to cap every user's history, including users who only have the subcollection
+def compact_all(db, keep=SEARCH_HISTORY_MAX_ENTRIES):
+    report = {"users": 0, "compacted": 0, "deleted": 0}
+    for reference in db.collection(HISTORY_COLLECTION).list_documents():
+        report["users"] += 1
+        try:
+            deleted = compact_user(db, reference.id, keep)
+        except Exception as e:
+            logger.error(f"Error compacting search history of user {reference.id}: {e}")
+            continue
+        if deleted:
+            report["compacted"] += 1
+            report["deleted"] += deleted
+    logger.info(f"Search history compaction done: {report}")
+    return report
+
+
+class SearchHistoryLog:
+    """
+    Queue and background flusher for search events (see the module
+    docstring). Events are dropped, and counted, only when the queue is full.
+    """
+
+    def __init__(self, db, spill_dir=SEARCH_HISTORY_SPILL_DIR, maxsize=SEARCH_HISTORY_QUEUE_SIZE,
+                 flush_interval=SEARCH_HISTORY_FLUSH_INTERVAL, commit_timeout=SEARCH_HISTORY_COMMIT_TIMEOUT,
+                 retry_interval=SEARCH_HISTORY_RETRY_INTERVAL, max_entries=SEARCH_HISTORY_MAX_ENTRIES,
+                 compact_every=SEARCH_HISTORY_COMPACT_EVERY):
+        self.db = db
+        self.spill_dir = spill_dir
+        self.flush_interval = flush_interval
+        self.commit_timeout = commit_timeout
+        self.retry_interval = retry_interval
+        self.max_entries = max_entries
+        self.compact_every = compact_every
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._since_compaction = OrderedDict()  # user id -> events written since the last trim
+        self._retry_at = 0.0
+        self._spill_file = None  # this process's spill file, open and flocked
+        self._spill_pid = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._counts = {"recorded": 0, "dropped": 0, "written": 0, "commits": 0, "spilled": 0,
+                        "replayed": 0, "compactions": 0, "trimmed": 0}
+
+    # Start the flusher lazily so it is created in the serving process, not before a fork
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="search-history", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    # Queue a search; never waits on Firestore
+    def record(self, user_id, query, timestamp=None):
+        event = {"id": uuid.uuid4().hex, "userId": user_id, "query": query, "timestamp": timestamp or time.time()}
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count("dropped")
+            return
+        self._count("recorded")
+        self._ensure_started()
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        counts["pending"] = self._queue.qsize()
+        counts["spilling"] = time.time() < self._retry_at
+        return counts
+
+    def _drain(self):
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    # Write queued events now; returns the number written to Firestore
+    def flush(self):
+        with self._flush_lock:
+            events = self._drain()
+            if time.time() < self._retry_at:
+                self._spill(events)
+                return 0
+            if not self._replay_spills():
+                self._spill(events)
+                return 0
+            return self._write(events)
+
+    # Commits events sorted by user in batches; the events of a failed batch and
+    # of every later one are spilled
+    def _write(self, events):
+        events.sort(key=lambda event: (event["userId"], event["timestamp"]))
+        written = 0
+        for start in range(0, len(events), FIRESTORE_BATCH_LIMIT):
+            chunk = events[start:start + FIRESTORE_BATCH_LIMIT]
+            if not self._commit(chunk):
+                self._spill(events[start:])
+                break
+            written += len(chunk)
+            self._track(chunk)
+        return written
+
+    def _commit(self, events):
+        batch = self.db.batch()
+        for event in events:
+            batch.set(_searches(self.db, event["userId"]).document(event["id"]), {
+                "query": event["query"],
+                "timestamp": datetime.fromtimestamp(event["timestamp"], tz=timezone.utc),
+            })
+        try:
+            with stage("firestore.commit"):
+                batch.commit(timeout=self.commit_timeout)
+        except Exception as e:
+            logger.error(f"Error writing {len(events)} search events, spilling until "
+                         f"{self.retry_interval:.0f}s from now: {e}")
+            self._retry_at = time.time() + self.retry_interval
+            return False
+        self._count("written", len(events))
+        self._count("commits")
+        return True
+
+    # Unique per process and host, so names never collide on a shared volume
+    def _spill_name(self, prefix):
+        return os.path.join(self.spill_dir, f"{prefix}-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}.ndjson")
+
+    def _spill(self, events):
+        if not events:
+            return
+        try:
+            if self._spill_file is None or self._spill_pid != os.getpid():
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self._spill_file = open(self._spill_name("spill"), "a")
+                fcntl.flock(self._spill_file, fcntl.LOCK_EX)
+                self._spill_pid = os.getpid()
+            self._spill_file.write("".join(json.dumps(event) + "\n" for event in events))
+            self._spill_file.flush()
+            self._count("spilled", len(events))
+        except OSError as e:
+            logger.error(f"Could not spill {len(events)} search events: {e}")
+            self._count("dropped", len(events))
+
+    # Claims spill files by locking and renaming them, so each is replayed by one
+    # worker only; returns [(path, locked file)]. Our own spill file is claimed
+    # too, and the next spill starts a new one
+    def _claim_spills(self):
+        claimed = []
+        own = self._spill_file.name if self._spill_file is not None and self._spill_pid == os.getpid() else None
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, "*.ndjson"))):
+            if path == own:
+                f, self._spill_file = self._spill_file, None
+            else:
+                try:
+                    f = open(path, "rb")
+                except OSError:
+                    continue  # Claimed by another worker first
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                        raise OSError("renamed while locking")
+                except OSError:
+                    f.close()  # Its owner is alive, or another worker claimed it
+                    continue
+            target = self._spill_name("replay")
+            try:
+                os.replace(path, target)
+            except OSError:
+                f.close()
+                continue
+            claimed.append((target, f))
+        return claimed
+
+    # Replays spilled events a batch at a time; False if Firestore is still failing
+    def _replay_spills(self):
+        if not os.path.isdir(self.spill_dir):
+            return True
+        claimed = self._claim_spills()
+        for position, (path, f) in enumerate(claimed):
+            if not self._replay(path):
+                # Released again, to be replayed from the start on a later flush
+                for remaining, held in claimed[position:]:
+                    os.replace(remaining, remaining.replace("replay-", "spill-", 1))
+                    held.close()
+                return False
+            os.remove(path)
+            f.close()
+        return True
+
+    def _replay(self, path):
+        chunk = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    chunk.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Skipping a malformed line in {path}")
+                    continue
+                if len(chunk) == FIRESTORE_BATCH_LIMIT:
+                    if not self._commit(chunk):
+                        return False
+                    self._count("replayed", len(chunk))
+                    chunk = []
+        if chunk:
+            if not self._commit(chunk):
+                return False
+            self._count("replayed", len(chunk))
+        return True
+
+    def _track(self, events):
+        due = []
+        with self._lock:
+            for event in events:
+                user_id = event["userId"]
+                count = self._since_compaction.pop(user_id, 0) + 1
+                if count >= self.compact_every:
+                    due.append(user_id)
+                    count = 0
+                self._since_compaction[user_id] = count
+            while len(self._since_compaction) > SEARCH_HISTORY_TRACKED_USERS:
+                self._since_compaction.popitem(last=False)
+        for user_id in dict.fromkeys(due):
+            try:
+                trimmed = compact_user(self.db, user_id, self.max_entries)
+            except Exception as e:
+                logger.error(f"Error compacting search history of user {user_id}: {e}")
+                continue
+            self._count("compactions")
+            self._count("trimmed", trimmed)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing search history: {e}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Cap every user's search history at the most recent entries")
+    parser.add_argument("--keep", type=int, default=SEARCH_HISTORY_MAX_ENTRIES)
+    parser.add_argument("--firebase-credentials", default=os.getenv('FIREBASE_CREDENTIALS'))
+    args = parser.parse_args()
+    if not args.firebase_credentials:
+        parser.error("--firebase-credentials or FIREBASE_CREDENTIALS is required")
+
+    import firebase_admin
+    from firebase_admin import credentials
+    firebase_admin.initialize_app(credentials.Certificate(args.firebase_credentials))
+    print(json.dumps(compact_all(firestore.client(), args.keep), indent=2))
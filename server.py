@@ -1,16 +1,27 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from elasticsearch import Elasticsearch, exceptions
 from elasticsearch.exceptions import ConnectionError, AuthenticationException
 import firebase_admin
 from firebase_admin import credentials, firestore
-from indexMapping import indexMapping
-from documentPreparation import prepareDocument, model
+from indexMapping import PRODUCT_INDEX
+from indexVersions import ProductIndex, ensure_product_index
+from documentPreparation import validateProduct
+from bulkIngest import extract_products, index_products
+from duplicateDetection import DuplicateDetector, DuplicateProductError
+from indexingQueue import IndexingQueue, QueueFullError
+from queryEncoder import query_encoder
+from hybridSearch import HybridSearcher, adaptive_num_candidates, local_hybrid_search, parse_search_request
+from localVectorIndex import local_index
+from resultCache import result_cache, normalize_query
+from modelRegistry import registry
+from instrumentation import METRICS_CONTENT_TYPE, instrument_app, instrument_elasticsearch, metrics
 
 app = Flask(__name__)
+instrument_app(app)
 
 # Initialize Elasticsearch connection
 try:
-    es = Elasticsearch("http://localhost:9200")
+    es = instrument_elasticsearch(Elasticsearch("http://localhost:9200"))
     if es.ping():
         print("Connected to Elasticsearch")
     else:
@@ -30,49 +41,156 @@ try:
 except Exception as e:
     print(f"An error occurred with Firestore: {e}")
 
-# Create the index with the mapping if it doesn't exist
-if not es.indices.exists(index="all_products"):
-    es.indices.create(index="all_products", body=indexMapping)
+# Create the first versioned index behind the alias if neither exists
+ensure_product_index(es)
+product_index = ProductIndex(es)
 
-# Function to index a new product in Elasticsearch
+# Fields returned by /search
+SEARCH_FIELDS = ["productName", "productDescription", "currency", "imageUrls", "videoUrls", "userId", "productPrice"]
+
+# Writes are coalesced into bulk requests by a background worker
+indexing_queue = IndexingQueue(es, versions=product_index)
+
+# Filtered BM25 + kNN search behind /search/hybrid
+hybrid_searcher = HybridSearcher(es)
+
+# Reposts of a seller's product are rejected, merged or linked as variants
+duplicate_detector = DuplicateDetector(es, db)
+
+# Function to queue a new product for indexing in Elasticsearch
 def index_new_product(product):
-    doc = prepareDocument(product)
-    res = es.index(index="all_products", id=product["id"], document=doc)
-    es.indices.refresh(index="all_products")  # Refresh the index to make the document searchable immediately
-    print(res['result'])
+    product_id, product, duplicate = duplicate_detector.resolve(product["id"], product)
+    write_id = indexing_queue.enqueue_product(product_id, product)
+    print(f"Product {product_id} queued for indexing: {write_id}")
+    return product_id, write_id, duplicate
 
 # API route to add a new product
 @app.route('/add_product', methods=['POST'])
 def add_product():
     try:
         product = request.json
-        index_new_product(product)
-        return jsonify({"message": "Product added and indexed successfully"}), 201
+        error = validateProduct(product)
+        if error:
+            return jsonify({"error": error}), 400
+        product_id, write_id, duplicate = index_new_product(product)
+        body = {"message": "Product queued for indexing", "id": product_id, "write_id": write_id}
+        if duplicate:
+            body["duplicate_of"] = duplicate
+        return jsonify(body), 202
+    except DuplicateProductError as e:
+        return jsonify({"error": str(e), "duplicate_of": e.duplicate}), 409
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": f"Error adding product: {e}"}), 500
 
+# API route to add many products in one request
+@app.route('/add_products', methods=['POST'])
+def add_products():
+    try:
+        products = extract_products(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        results = index_products(es, products, versions=product_index, duplicates=duplicate_detector)
+        failed = sum(1 for result in results if result["status"] == "failed")
+        status = 201 if not failed else (400 if failed == len(results) else 207)
+        return jsonify({"indexed": len(results) - failed, "failed": failed, "results": results}), status
+    except Exception as e:
+        return jsonify({"error": f"Error adding products: {e}"}), 500
+
+# API route to look up the status of a queued write
+@app.route('/index_status/<write_id>', methods=['GET'])
+def index_status(write_id):
+    status = indexing_queue.status(write_id)
+    if status is None:
+        return jsonify({"error": "Unknown write id"}), 404
+    return jsonify(status), 200
+
+# Function to run the /search kNN query
+def search_products(keyword, k=4):
+    vector_of_input_keyword = query_encoder.encode(keyword)
+
+    # Small catalogues are served from the local index
+    if local_index is not None and local_index.serves_queries():
+        return local_index.search_sources(vector_of_input_keyword, k, SEARCH_FIELDS)
+
+    knn_query = {
+        "field": "DescriptionVector",
+        "query_vector": vector_of_input_keyword,
+        "k": k,
+        "num_candidates": adaptive_num_candidates(k)
+    }
+    res = es.knn_search(index=PRODUCT_INDEX, knn=knn_query, _source=SEARCH_FIELDS)
+    return [hit["_source"] for hit in res["hits"]["hits"]]
+
+# Function to run a hybrid search
+def search_products_hybrid(params):
+    query_vector = query_encoder.encode(params["keyword"])
+    if local_index is not None and local_index.serves_queries():
+        return local_hybrid_search(local_index, query_vector, params["k"], params["filters"],
+                                   params["search_after"], SEARCH_FIELDS)
+    return hybrid_searcher.search(params["keyword"], query_vector, params["k"], params["filters"],
+                                  params["search_after"], SEARCH_FIELDS)
+
 # API route to perform KNN search
 @app.route('/search', methods=['POST'])
 def knn_search():
     try:
         input_keyword = request.json.get('keyword')
-        vector_of_input_keyword = model.encode(input_keyword)
 
-        knn_query = {
-            "field": "DescriptionVector",
-            "query_vector": vector_of_input_keyword,
-            "k": 4,
-            "num_candidates": 500
-        }
+        # Repeated queries are answered from the result cache until the next index write
+        try:
+            results = result_cache.get_or_compute("search", lambda: search_products(input_keyword),
+                                                  query=normalize_query(input_keyword), k=4)
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            print(f"Elasticsearch unreachable, searching the local index: {e}")
+            results = local_index.search_sources(query_encoder.encode(input_keyword), 4, SEARCH_FIELDS)
 
-        res = es.knn_search(index="all_products", knn=knn_query,
-                            _source=["productName", "productDescription", "currency", "imageUrls", "videoUrls",
-                                     "userId", "productPrice"])
-
-        results = [hit["_source"] for hit in res["hits"]["hits"]]
         return jsonify(results), 200
     except Exception as e:
         return jsonify({"error": f"Error performing KNN search: {e}"}), 500
 
+# API route for filtered hybrid search: BM25 and kNN fused with reciprocal rank fusion,
+# paged with the search_after cursor of the previous response
+@app.route('/search/hybrid', methods=['POST'])
+def hybrid_search():
+    try:
+        params = parse_search_request(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        try:
+            result = result_cache.get_or_compute("hybrid", lambda: search_products_hybrid(params),
+                                                 query=normalize_query(params["keyword"]), k=params["k"],
+                                                 filters=params["filters"], search_after=params["search_after"])
+        except ConnectionError as e:
+            if local_index is None:
+                raise
+            print(f"Elasticsearch unreachable, searching the local index: {e}")
+            result = local_hybrid_search(local_index, query_encoder.encode(params["keyword"]), params["k"],
+                                         params["filters"], params["search_after"], SEARCH_FIELDS)
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({"error": f"Error performing hybrid search: {e}"}), 500
+
+# API route exposing request latency and per-stage timings for Prometheus
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+# API route reporting model warm-up state, startup time and memory of this worker
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = registry.status()
+    status["index"] = product_index.status()
+    status["ready"] = status["ready"] and status["index"]["compatible"]
+    return jsonify(status), 200 if status["ready"] else 503
+
 if __name__ == '__main__':
+    registry.warm_up_async()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import re
+
+import numpy as np
+
+# MinHash configuration; DEDUP_BANDS must divide DEDUP_NUM_PERM
+DEDUP_SHINGLE_SIZE = int(os.getenv('DEDUP_SHINGLE_SIZE', '3'))
+DEDUP_NUM_PERM = int(os.getenv('DEDUP_NUM_PERM', '64'))
+DEDUP_BANDS = int(os.getenv('DEDUP_BANDS', '16'))
+
+_TOKEN = re.compile(r"\w+")
+_PRIME = (1 << 31) - 1
+_EMPTY = np.full(DEDUP_NUM_PERM, _PRIME, dtype=np.uint64)
+
+# Fixed seed: signatures are stored in the index and must match across processes
+_random = np.random.RandomState(20240529)
+_A = _random.randint(1, _PRIME, size=DEDUP_NUM_PERM).astype(np.uint64)
+_B = _random.randint(0, _PRIME, size=DEDUP_NUM_PERM).astype(np.uint64)
+
+
+# Function to reduce a description to lowercase word tokens, so case and punctuation do not matter
+def normalize_text(text):
+    return _TOKEN.findall((text or "").lower())
+
+
+# Function to build the set of word shingles; texts shorter than one shingle are one shingle
+def shingles(text, size=DEDUP_SHINGLE_SIZE):
+    tokens = normalize_text(text)
+    if len(tokens) <= size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+# Function to compute the MinHash signature of a description
+def minhash(text):
+    values = shingles(text)
+    if not values:
+        return _EMPTY
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=4).digest(), "little") for value in values),
+        dtype=np.uint64, count=len(values)
+    )
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+# Function to cut a signature into LSH band keys; two descriptions share a key with
+# high probability once their Jaccard similarity passes about (1 / bands) ** (1 / rows)
+def band_keys(signature, bands=DEDUP_BANDS):
+    rows = len(signature) // bands
+    return [f"{band}:{hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=6).hexdigest()}"
+            for band in range(bands)]
+
+
+# Function to compute the band keys stored with a product document
+def signature_bands(text):
+    return band_keys(minhash(text))
+
+
+def estimated_jaccard(signature, other):
+    return float(np.mean(signature == other))
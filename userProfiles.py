@@ -0,0 +1,227 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+from firebase_admin import firestore
+
+from instrumentation import stage
+from vectorProfile import VECTOR_PROFILE, to_index_vector
+
+logger = logging.getLogger(__name__)
+
+# Profile configuration
+PROFILE_HALF_LIFE_HOURS = float(os.getenv('PROFILE_HALF_LIFE_HOURS', '72'))
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_FLUSH_INTERVAL = float(os.getenv('PROFILE_FLUSH_INTERVAL', '5'))
+PROFILE_BOOTSTRAP_QUERIES = int(os.getenv('PROFILE_BOOTSTRAP_QUERIES', '20'))
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '60'))  # re-read profiles other workers may have folded into
+PROFILE_COLLECTION = 'userProfiles'
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class UserProfileStore:
+    """
+    Recency-weighted centroid of each user's query vectors. Recorded searches
+    are only queued on the request thread; the flusher folds them into the
+    stored profile with an exponential time decay inside a Firestore
+    transaction, so workers sharing a user never overwrite each other's
+    searches. Profiles are cached in process for PROFILE_CACHE_TTL seconds,
+    so recommendations never scan search history.
+    """
+
+    def __init__(self, db, encode, half_life_hours=PROFILE_HALF_LIFE_HOURS,
+                 capacity=PROFILE_CACHE_SIZE, flush_interval=PROFILE_FLUSH_INTERVAL, ttl=PROFILE_CACHE_TTL):
+        self.db = db
+        self._encode = encode  # list of queries -> list of index-space vectors, used only to bootstrap
+        self.half_life = half_life_hours * 3600
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._profiles = OrderedDict()  # user_id -> (state, loaded at)
+        self._pending = {}              # user_id -> searches folded since the last flush
+        self._seeds = {}                # user_id -> bootstrapped state not yet written
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="profile-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    # Decay both states to the later of their timestamps and add them; folding is
+    # linear, so searches can be combined before they are applied to the profile
+    def _merge(self, state, other):
+        if state is None or other is None:
+            return state if other is None else other
+        updated = max(state["updated"], other["updated"])
+        decay = 0.5 ** ((updated - state["updated"]) / self.half_life)
+        other_decay = 0.5 ** ((updated - other["updated"]) / self.half_life)
+        return {
+            "vector": state["vector"] * decay + other["vector"] * other_decay,
+            "weight": state["weight"] * decay + other["weight"] * other_decay,
+            "updated": updated,
+            "queries": state["queries"] + other["queries"],
+        }
+
+    def _fold(self, state, vector, timestamp):
+        return self._merge(state, {"vector": _unit(vector), "weight": 1.0, "updated": timestamp, "queries": 1})
+
+    def _remember(self, user_id, state):
+        self._profiles[user_id] = (state, time.time())
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.capacity:
+            self._profiles.popitem(last=False)
+
+    # Queue a search that has already been encoded; no I/O on the request thread
+    def record_search(self, user_id, query_vector, timestamp=None):
+        with self._lock:
+            self._pending[user_id] = self._fold(self._pending.get(user_id), query_vector, timestamp or time.time())
+        self._ensure_started()
+
+    # Index-space vector for the user's kNN query, or None for users without history
+    def profile_vector(self, user_id):
+        state = self._load(user_id)
+        if state is None:
+            return None
+        return to_index_vector(state["vector"])
+
+    # Changes whenever a flush or another worker folds in a search, so cached
+    # recommendations can be keyed on it
+    def profile_version(self, user_id):
+        state = self._load(user_id)
+        return None if state is None else f"{state['queries']}:{state['updated']}"
+
+    def _load(self, user_id):
+        with self._lock:
+            cached = self._profiles.get(user_id)
+            if cached is not None and time.time() - cached[1] < self.ttl:
+                self._profiles.move_to_end(user_id)
+                return cached[0]
+
+        state = self._read_firestore(user_id)
+        if state is None and cached is not None:
+            return cached[0]  # Unreadable right now; serve the stale profile
+        if state is None:
+            state = self._bootstrap(user_id)
+            if state is not None:
+                with self._lock:
+                    self._seeds.setdefault(user_id, state)
+                self._ensure_started()
+        if state is not None:
+            with self._lock:
+                self._remember(user_id, state)
+        return state
+
+    def _read_firestore(self, user_id):
+        try:
+            with stage("firestore.get"):
+                snapshot = self.db.collection(PROFILE_COLLECTION).document(user_id).get()
+        except Exception as e:
+            logger.error(f"Error reading profile for user {user_id}: {e}")
+            return None
+        return self._from_snapshot(snapshot)
+
+    def _from_snapshot(self, snapshot):
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        if data.get("profile") != VECTOR_PROFILE:
+            return None  # Written for another vector layout; rebuild from history
+        updated = data["updatedAt"]
+        return {
+            "vector": np.asarray(data["vector"], dtype=np.float32) * data["weight"],
+            "weight": data["weight"],
+            "updated": updated.timestamp() if hasattr(updated, "timestamp") else float(updated),
+            "queries": data.get("queries", 0),
+        }
+
+    # One-off: fold the most recent searches for users who predate profiles
+    def _bootstrap(self, user_id):
+        try:
+            with stage("firestore.query"):
+                docs = (self.db.collection('searchHistory').document(user_id).collection('searches')
+                        .order_by('timestamp', direction=firestore.Query.DESCENDING)
+                        .limit(PROFILE_BOOTSTRAP_QUERIES).stream())
+                history = [doc.to_dict() for doc in docs]
+        except Exception as e:
+            logger.error(f"Error bootstrapping profile for user {user_id}: {e}")
+            return None
+        history = [entry for entry in reversed(history) if entry.get('query')]
+        if not history:
+            return None
+
+        vectors = self._encode([entry['query'] for entry in history])
+        state = None
+        for entry, vector in zip(history, vectors):
+            timestamp = entry.get('timestamp')
+            state = self._fold(state, vector, timestamp.timestamp() if hasattr(timestamp, "timestamp") else time.time())
+        logger.info(f"Bootstrapped profile for user {user_id} from {len(history)} searches")
+        return state
+
+    # Read-fold-write one profile in a transaction, which Firestore retries if
+    # another worker wrote the profile in between
+    def _apply(self, user_id, searches, seed):
+        reference = self.db.collection(PROFILE_COLLECTION).document(user_id)
+        bootstrapped = []
+
+        @firestore.transactional
+        def fold(transaction):
+            state = self._from_snapshot(reference.get(transaction=transaction))
+            if state is None:
+                if not bootstrapped:
+                    bootstrapped.append(seed if seed is not None else self._bootstrap(user_id))
+                state = bootstrapped[0]
+            state = self._merge(state, searches)
+            if state is not None:
+                transaction.set(reference, {
+                    "vector": (state["vector"] / state["weight"]).tolist(),
+                    "weight": state["weight"],
+                    "queries": state["queries"],
+                    "updatedAt": datetime.fromtimestamp(state["updated"], tz=timezone.utc),
+                    "profile": VECTOR_PROFILE,
+                })
+            return state
+
+        return fold(self.db.transaction())
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            seeds, self._seeds = self._seeds, {}
+        written = 0
+        for user_id in list(pending) + [user_id for user_id in seeds if user_id not in pending]:
+            try:
+                with stage("firestore.commit"):
+                    state = self._apply(user_id, pending.get(user_id), seeds.get(user_id))
+            except Exception as e:
+                logger.error(f"Error persisting profile for user {user_id}: {e}")
+                with self._lock:
+                    if user_id in pending:
+                        self._pending[user_id] = self._merge(self._pending.get(user_id), pending[user_id])
+                    if user_id in seeds:
+                        self._seeds.setdefault(user_id, seeds[user_id])
+                continue
+            if state is not None:
+                written += 1
+                with self._lock:
+                    self._remember(user_id, state)
+        return written
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -0,0 +1,54 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# One setting picks the index type and the (Matryoshka-truncated) vector size,
+# e.g. "hnsw:768", "int8_hnsw:256", "int4_hnsw:256", "byte:128"
+VECTOR_PROFILE = os.getenv('VECTOR_PROFILE', 'hnsw:768')
+
+INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "flat", "int8_flat", "byte")
+
+VectorProfile = namedtuple("VectorProfile", ["index_type", "dims"])
+
+
+def parse_profile(value):
+    index_type, _, dims = value.partition(":")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown vector index type '{index_type}', expected one of {INDEX_TYPES}")
+    try:
+        dims = int(dims)
+    except ValueError:
+        raise ValueError(f"Vector profile '{value}' must look like '<index type>:<dims>'")
+    if dims <= 0:
+        raise ValueError(f"Vector profile '{value}' needs a positive dimension count")
+    return VectorProfile(index_type, dims)
+
+
+profile = parse_profile(VECTOR_PROFILE)
+
+
+# Function to build the dense_vector mapping for a profile
+def vector_mapping(vector_profile=profile):
+    mapping = {
+        "type": "dense_vector",
+        "dims": vector_profile.dims,
+        "index": True,
+        "similarity": "cosine"
+    }
+    if vector_profile.index_type == "byte":
+        # Byte vectors are quantized client side (see to_index_vector)
+        mapping["element_type"] = "byte"
+    else:
+        mapping["index_options"] = {"type": vector_profile.index_type}
+    return mapping
+
+
+# Function to truncate an embedding to the profile size and renormalize it,
+# as Matryoshka-trained models expect; byte profiles are scaled to int8
+def to_index_vector(vector, vector_profile=profile):
+    vector = np.asarray(vector, dtype=np.float32)[:vector_profile.dims]
+    vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+    if vector_profile.index_type == "byte":
+        return np.clip(np.rint(vector * 127), -128, 127).astype(int).tolist()
+    return vector.tolist()